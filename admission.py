@@ -0,0 +1,250 @@
+"""
+This module keeps a flooding source from starving other sources and listeners.
+"""
+import time
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+from tornado import gen
+from tornado.ioloop import PeriodicCallback
+
+import fanout
+import metrics
+import source_protocol
+
+REJECT = 'reject'
+PAUSE = 'pause'
+policies = {REJECT, PAUSE}
+
+# reasons of throttling
+SOURCE = 'source'
+CONNECTION = 'connection'
+INFLIGHT = 'inflight'
+
+# how often a paused source checks if listeners have caught up
+PAUSE_STEP_S = 0.005
+# how often limits of sources back within them are dropped
+SWEEP_INTERVAL_MS = 10000
+
+
+class TokenBucket:
+    """
+    Allows rate of tokens per second on average and up to burst of them at once.
+    >>> bucket = TokenBucket(rate=10, burst=2, now=0.0)
+    >>> bucket.has(2, now=0.0), bucket.take(2, now=0.0), bucket.has(1, now=0.0), bucket.has(1, now=0.1)
+    (True, 0.0, False, True)
+    >>> bucket.take(3, now=0.1)
+    0.2
+    """
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = now
+
+    def has(self, count: int, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= count
+
+    def take(self, count: int, now: float) -> float:
+        """
+        Takes count tokens even if they aren't available yet.
+        :return: seconds until the debt is repaid
+        """
+        self._refill(now)
+        self._tokens -= count
+        return max(0.0, -self._tokens / self._rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self._burst
+
+    def _refill(self, now: float):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+
+class _Limits:
+    """ Buckets of messages and records of a single source or connection """
+
+    def __init__(self, msgs_per_s: Optional[float], records_per_s: Optional[float], burst_s: float, now: float):
+        self._buckets = []
+        if msgs_per_s is not None:
+            self._buckets.append((TokenBucket(msgs_per_s, max(1.0, msgs_per_s * burst_s), now), False))
+        if records_per_s is not None:
+            # a frame has up to 255 records, and a frame of any size has to pass eventually
+            self._buckets.append((TokenBucket(records_per_s, max(255.0, records_per_s * burst_s), now), True))
+
+    def has(self, records: int, now: float) -> bool:
+        return all(bucket.has(records if of_records else 1, now) for bucket, of_records in self._buckets)
+
+    def take(self, records: int, now: float) -> float:
+        """ :return: seconds until the debt is repaid """
+        return max(bucket.take(records if of_records else 1, now) for bucket, of_records in self._buckets)
+
+    def is_full(self, now: float) -> bool:
+        return all(bucket.is_full(now) for bucket, _ in self._buckets)
+
+
+class RateLimiter:
+    """
+    Limits messages and records per second of every source id and of every connection
+    by token buckets holding burst_s seconds of their rates, and bytes put to
+    listener queues and not written yet by all sources together.
+
+    With REJECT policy a frame over a limit is answered as failed and thrown away.
+    With PAUSE policy a source over a limit isn't answered and read until
+    it's back within its limits, so it's slowed down by TCP flow control.
+    Limits, which are None, aren't checked.
+
+    Limits of a source are kept only while it's over them,
+    as they are swept every sweep_interval_ms once they are full again,
+    so a churning fleet of source ids doesn't pile them up.
+    """
+
+    def __init__(self,
+                 source_msgs_per_s: float = None,
+                 source_records_per_s: float = None,
+                 connection_msgs_per_s: float = None,
+                 connection_records_per_s: float = None,
+                 burst_s: float = 1.0,
+                 max_inflight_bytes: int = None,
+                 policy: str = REJECT,
+                 sweep_interval_ms: int = SWEEP_INTERVAL_MS):
+        if policy not in policies:
+            raise ValueError(f'unknown throttle policy {policy}')
+        self.policy = policy
+        self._source_rates = (source_msgs_per_s, source_records_per_s)
+        self._connection_rates = (connection_msgs_per_s, connection_records_per_s)
+        self._burst_s = burst_s
+        self._max_inflight_bytes = max_inflight_bytes
+        self._by_source: Dict[str, _Limits] = {}
+        self._by_connection: Dict[Hashable, _Limits] = {}
+        self.throttled: Dict[str, int] = {SOURCE: 0, CONNECTION: 0, INFLIGHT: 0}
+        self.paused_seconds = 0.0
+        self._sweeper = PeriodicCallback(self.sweep, sweep_interval_ms)
+        metrics.REGISTRY.gauge(
+            'dispatcher_frames_throttled_total', 'Frames of sources over their limits',
+            lambda: self.throttled, label='reason', type_='counter',
+        )
+        metrics.REGISTRY.gauge(
+            'dispatcher_sources_paused_seconds_total', 'Time sources were not read for being over their limits',
+            lambda: self.paused_seconds, type_='counter',
+        )
+
+    def start(self):
+        self._sweeper.start()
+
+    def stop(self):
+        self._sweeper.stop()
+
+    def admit(self,
+              connection: Hashable,
+              parsed_frames: Sequence[Optional[source_protocol.SourceFrame]],
+              inflight_bytes: int,
+              now: float = None) -> List[Optional[source_protocol.SourceFrame]]:
+        """
+        Takes frames within limits into account, for REJECT policy.
+        :param parsed_frames: frames of a connection, None for corrupted ones
+        :return: the frames with None instead of throttled ones
+        """
+        if now is None:
+            now = time.monotonic()
+        overloaded = self._is_overloaded(inflight_bytes)
+        admitted = []
+        for parsed in parsed_frames:
+            if parsed is not None:
+                reason = INFLIGHT if overloaded else self._admit_frame(connection, parsed, now)
+                if reason is not None:
+                    self.throttled[reason] += 1
+                    parsed = None
+            admitted.append(parsed)
+        return admitted
+
+    async def hold(self,
+                   connection: Hashable,
+                   parsed_frames: Sequence[Optional[source_protocol.SourceFrame]],
+                   inflight: fanout.InflightBytes):
+        """
+        Takes frames into account even if they are over limits, for PAUSE policy,
+        and waits until the connection is back within its limits and listeners
+        have caught up. The source isn't read meanwhile.
+        """
+        started = now = time.monotonic()
+        delay, reason = 0.0, None
+        for parsed in parsed_frames:
+            if parsed is not None:
+                frame_delay, frame_reason = self._take_frame(connection, parsed, now)
+                if frame_delay > delay:
+                    delay, reason = frame_delay, frame_reason
+        if delay:
+            self.throttled[reason] += 1
+            await gen.sleep(delay)
+        if self._is_overloaded(inflight.value):
+            self.throttled[INFLIGHT] += 1
+            while self._is_overloaded(inflight.value):
+                await gen.sleep(PAUSE_STEP_S)
+        self.paused_seconds += time.monotonic() - started
+
+    def _is_overloaded(self, inflight_bytes: int) -> bool:
+        return self._max_inflight_bytes is not None and inflight_bytes >= self._max_inflight_bytes
+
+    def _admit_frame(self, connection: Hashable, parsed: source_protocol.SourceFrame, now: float) -> Optional[str]:
+        """ :return: reason the frame is throttled for or None if it's admitted """
+        records = len(parsed.msgs)
+        connection_limits = self._get_limits(self._by_connection, connection, self._connection_rates, now)
+        if connection_limits is not None and not connection_limits.has(records, now):
+            return CONNECTION
+        # limits of a source are taken only after the connection passes, so rejected ids don't pile them up
+        source_limits = self._get_limits(self._by_source, parsed.source_id, self._source_rates, now)
+        if source_limits is not None and not source_limits.has(records, now):
+            return SOURCE
+        for limits in (connection_limits, source_limits):
+            if limits is not None:
+                limits.take(records, now)
+        return None
+
+    def _take_frame(self, connection: Hashable, parsed: source_protocol.SourceFrame, now: float) -> Tuple[float, str]:
+        """ :return: (seconds until limits are repaid, reason of the longest wait) """
+        delays = [
+            (limits.take(len(parsed.msgs), now), reason)
+            for limits, reason in (
+                (self._get_limits(self._by_connection, connection, self._connection_rates, now), CONNECTION),
+                (self._get_limits(self._by_source, parsed.source_id, self._source_rates, now), SOURCE),
+            )
+            if limits is not None
+        ]
+        return max(delays, default=(0.0, None))
+
+    def forget(self, connection: Hashable, source_ids: Iterable[str], now: float = None):
+        """
+        Drops limits of a closed connection and of its sources, unless they are
+        still over them, so a source can't get rid of its debt by reconnecting.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._by_connection.pop(connection, None)
+        for source_id in source_ids:
+            limits = self._by_source.get(source_id)
+            if limits is not None and limits.is_full(now):
+                del self._by_source[source_id]
+
+    def sweep(self, now: float = None) -> int:
+        """
+        Drops limits of sources, which are back within them.
+        :return: count of dropped limits
+        """
+        if now is None:
+            now = time.monotonic()
+        full = [source_id for source_id, limits in self._by_source.items() if limits.is_full(now)]
+        for source_id in full:
+            del self._by_source[source_id]
+        return len(full)
+
+    def _get_limits(self, index: Dict[Any, _Limits], key: Hashable, rates, now: float) -> Optional[_Limits]:
+        if rates == (None, None):
+            return None
+        limits = index.get(key)
+        if limits is None:
+            limits = index[key] = _Limits(*rates, burst_s=self._burst_s, now=now)
+        return limits
@@ -0,0 +1,300 @@
+"""
+This module serves sources and listeners with raw asyncio protocols instead of tornado streams.
+
+Servers here drive the same callbacks as app.SourcesServer and app.ListenersServer,
+but skip the per read futures and buffers of IOStream: received data is handed
+to a protocol by the event loop directly, and it's written to a transport right away.
+They run on any asyncio loop, so uvloop can be used to speed up the loop itself.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Coroutine, List, Optional, Sequence
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+
+import listener_protocol
+import source_protocol
+import tracing
+
+TORNADO = 'tornado'
+ASYNCIO = 'asyncio'
+transports = {TORNADO, ASYNCIO}
+
+
+class ProtocolStream:
+    """
+    The part of IOStream interface used by Dispatcher on top of an asyncio transport.
+
+    Writes go to the transport immediately. The future of a write is already done
+    unless the transport asked to pause writing, then it's done once the transport
+    is drained below its low-water mark, as asyncio.StreamWriter.drain() does.
+    Once the connection is lost, writes raise StreamClosedError like IOStream ones.
+    """
+
+    def __init__(self, transport: asyncio.WriteTransport):
+        self._transport = transport
+        self._loop = asyncio.get_running_loop()
+        self._closed = False
+        # shared by all writes while writing isn't paused, so no future is created per write
+        self._drained = self._loop.create_future()
+        self._drained.set_result(None)
+
+    def write(self, data: bytes) -> Awaitable:
+        # a closing transport throws writes away and only warns about them
+        if self._closed or self._transport.is_closing():
+            raise StreamClosedError()
+        self._transport.write(data)
+        return self._drained
+
+    def closed(self) -> bool:
+        return self._closed or self._transport.is_closing()
+
+    def close(self):
+        self._transport.close()
+
+    def set_nodelay(self, value: bool):
+        # asyncio sets TCP_NODELAY on every TCP transport itself
+        pass
+
+    def pause_writing(self):
+        if self._drained.done():
+            self._drained = self._loop.create_future()
+
+    def resume_writing(self):
+        if not self._drained.done():
+            self._drained.set_result(None)
+
+    def connection_lost(self):
+        self._closed = True
+        if not self._drained.done():
+            self._drained.set_exception(StreamClosedError())
+            # nobody may be waiting for it
+            self._drained.exception()
+
+
+class _Server:
+    """ Same listen/add_sockets/stop interface as tornado's TCPServer """
+
+    def __init__(self):
+        self._servers: List[asyncio.AbstractServer] = []
+
+    def listen(self, port: int, address: str = None, reuse_port: bool = False):
+        # sockets are bound and listening synchronously, so connects wait in the backlog
+        # until the loop starts serving them
+        self.add_sockets(bind_sockets(port, address=address, reuse_port=reuse_port))
+
+    def add_sockets(self, sockets):
+        for sock in sockets:
+            IOLoop.current().spawn_callback(self._serve, sock)
+
+    def stop(self):
+        for server in self._servers:
+            server.close()
+        self._servers.clear()
+
+    async def _serve(self, sock):
+        self._servers.append(await asyncio.get_running_loop().create_server(self._create_protocol, sock=sock))
+
+    def _create_protocol(self) -> asyncio.Protocol:
+        raise NotImplementedError
+
+
+class SourcesServer(_Server):
+    """
+    Manages connects to sources.
+
+    All complete frames received at once are handed to on_msgs at once.
+    on_msgs of a source is run right in data_received and usually finishes there,
+    as there is nothing to wait for. Otherwise, reading of the source is paused,
+    until it's finished, so frames of a source are handled in order.
+    """
+
+    def __init__(self,
+                 on_connect: Callable[[ProtocolStream], Coroutine],
+                 on_msgs: Callable[[ProtocolStream, Sequence[bytes], Optional[tracing.Trace]], Coroutine],
+                 on_close: Callable[[ProtocolStream], Coroutine],
+                 read_buffer_size: int = 65536,
+                 tracer: tracing.Tracer = None):
+        super().__init__()
+        self._on_connect = on_connect
+        self._on_msgs = on_msgs
+        self._on_close = on_close
+        self._read_buffer_size = read_buffer_size
+        self._tracer = tracing.Tracer() if tracer is None else tracer
+
+    def _create_protocol(self) -> asyncio.Protocol:
+        return _SourceProtocol(self)
+
+
+class _SourceProtocol(asyncio.BufferedProtocol):
+
+    def __init__(self, server: SourcesServer):
+        self._server = server
+        self._transport = None
+        self._stream: Optional[ProtocolStream] = None
+        # the buffer must be able to hold at least one frame of any size
+        self._buffer = bytearray(max(server._read_buffer_size, 2 * source_protocol.MAX_FRAME_SIZE))
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+        # a callback of the server is running
+        self._busy = False
+        self._lost = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._stream = ProtocolStream(transport)
+        self._run(self._server._on_connect(self._stream))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        # the socket is read right into the buffer
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        if not self._busy:
+            self._handle_buffer()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._lost = True
+        self._stream.connection_lost()
+        if not self._busy:
+            self._close()
+
+    def pause_writing(self):
+        self._stream.pause_writing()
+
+    def resume_writing(self):
+        self._stream.resume_writing()
+
+    def _handle_buffer(self):
+        trace = self._server._tracer.begin()
+        msgs, consumed = source_protocol.split_frames(self._view[self._start:self._end])
+        self._start += consumed
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < source_protocol.MAX_FRAME_SIZE:
+            # move an incomplete frame to the beginning of the buffer
+            self._buffer[:self._end - self._start] = bytes(self._view[self._start:self._end])
+            self._start, self._end = 0, self._end - self._start
+        if msgs:
+            if trace is not None:
+                trace.mark('read')
+            self._run(self._server._on_msgs(self._stream, msgs, trace))
+
+    def _run(self, coro: Coroutine):
+        self._busy = True
+        self._step(coro)
+
+    def _step(self, coro: Coroutine):
+        """
+        Runs a coroutine like asyncio.Task does, but without creating a task,
+        as the callbacks usually finish without waiting for anything.
+        """
+        try:
+            awaited = coro.send(None)
+        except (StopIteration, StreamClosedError):
+            self._on_done()
+            return
+        except Exception:
+            logging.exception('error handling a source')
+            self._transport.close()
+            self._on_done()
+            return
+        if not self._lost and self._transport.is_reading():
+            # nothing more is read from the source until the callback is finished
+            self._transport.pause_reading()
+        if awaited is None:
+            # bare yield, e.g. of asyncio.sleep(0)
+            asyncio.get_running_loop().call_soon(self._step, coro)
+        else:
+            awaited._asyncio_future_blocking = False
+            awaited.add_done_callback(lambda _: self._step(coro))
+
+    def _on_done(self):
+        self._busy = False
+        if self._lost:
+            self._close()
+            return
+        if not self._transport.is_reading():
+            self._transport.resume_reading()
+        # frames received before reading was paused
+        if self._end - self._start >= source_protocol.HEADER_STRUCT.size:
+            self._handle_buffer()
+
+    def _close(self):
+        asyncio.ensure_future(self._server._on_close(self._stream))
+
+
+class ListenersServer(_Server):
+    """
+    Manages connects to listeners.
+    """
+
+    def __init__(self,
+                 on_connect: Callable[[ProtocolStream, Optional[bytes]], Coroutine],
+                 on_close: Callable[[ProtocolStream], Coroutine],
+                 handshake_timeout_ms: int = 0):
+        super().__init__()
+        self._on_connect = on_connect
+        self._on_close = on_close
+        self._handshake_timeout = handshake_timeout_ms / 1000
+
+    def _create_protocol(self) -> asyncio.Protocol:
+        return _ListenerProtocol(self)
+
+
+class _ListenerProtocol(asyncio.Protocol):
+
+    def __init__(self, server: ListenersServer):
+        self._server = server
+        self._transport = None
+        self._stream: Optional[ProtocolStream] = None
+        self._handshake = bytearray()
+        self._handshake_timer = None
+        self._connected = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._stream = ProtocolStream(transport)
+        if self._server._handshake_timeout:
+            # a listener has handshake_timeout to send its options, otherwise it's served without them
+            self._handshake_timer = asyncio.get_running_loop().call_later(
+                self._server._handshake_timeout, self._connect, None)
+        else:
+            self._connect(None)
+
+    def data_received(self, data: bytes):
+        if self._connected:
+            # we don't expect any data from a listener besides handshake, so it's thrown away
+            return
+        self._handshake += data
+        end = self._handshake.find(b'\n', 0, listener_protocol.MAX_HANDSHAKE_SIZE)
+        if end >= 0:
+            self._handshake_timer.cancel()
+            self._connect(bytes(self._handshake[:end + 1]))
+        elif len(self._handshake) >= listener_protocol.MAX_HANDSHAKE_SIZE:
+            # too long handshake closes the stream
+            self._handshake_timer.cancel()
+            self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._stream.connection_lost()
+        if self._connected:
+            # scheduled after on_connect, so it runs after it
+            asyncio.ensure_future(self._server._on_close(self._stream))
+        elif self._handshake_timer is not None:
+            self._handshake_timer.cancel()
+
+    def pause_writing(self):
+        self._stream.pause_writing()
+
+    def resume_writing(self):
+        self._stream.resume_writing()
+
+    def _connect(self, handshake: Optional[bytes]):
+        self._connected = True
+        self._handshake = None
+        asyncio.ensure_future(self._server._on_connect(self._stream, handshake))
+
@@ -1,14 +1,36 @@
+import asyncio
+import contextlib
 import datetime
+import functools
+import itertools
 import logging
-from typing import Callable, Sequence, Tuple, Any
+import signal
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Any
 
-from tornado.iostream import StreamClosedError, IOStream
+from tornado import gen
+from tornado.iostream import StreamClosedError, IOStream, UnsatisfiableReadError
 from tornado.ioloop import IOLoop
 from tornado.tcpserver import TCPServer
+from tornado.util import TimeoutError
 
+import admission
 import config
+import eviction
+import fanout
+import listener_protocol
+import metrics
+import registry
+import replay
 import source_protocol
 import store
+import subscriptions
+import tracing
+
+if TYPE_CHECKING:
+    # imported where used, so a process starts without the ones its config doesn't need
+    import journal
+    import offload
 
 
 class Dispatcher:
@@ -20,126 +42,563 @@ class Dispatcher:
     Notifies listeners about existed sources.
     """
 
-    def __init__(self):
-        self._sources_server = SourcesServer(
+    def __init__(self,
+                 listener_queue_size: int = 1024,
+                 listener_overflow_policy: str = fanout.DROP_OLDEST,
+                 source_read_buffer_size: int = 65536,
+                 listener_flush_delay_us: int = 0,
+                 listener_flush_bytes: int = 65536,
+                 snapshot_chunk_size: int = 1000,
+                 tracer: tracing.Tracer = None,
+                 sources_journal: 'journal.Journal' = None,
+                 replay_buffer_bytes: int = 0,
+                 listener_handshake_timeout_ms: int = 0,
+                 ack_await_write: bool = True,
+                 evictor: eviction.Evictor = None,
+                 transport: str = 'tornado',
+                 parse_pool: 'offload.ParsePool' = None,
+                 rate_limiter: admission.RateLimiter = None):
+        """
+        :param transport: 'tornado' to serve connects with tornado streams,
+            'asyncio' to serve them with raw asyncio protocols of aio_server
+        :param parse_pool: pool to parse big frames out of the loop, they are parsed in place if None
+        :param rate_limiter: limits of sources, they aren't limited if None
+        """
+        self._parse_pool = parse_pool
+        self._rate_limiter = rate_limiter
+        # bytes queued to listeners and not written yet
+        self._inflight = fanout.InflightBytes()
+        self._evictor = evictor
+        # if answers to a source aren't awaited, its next messages are read and handled meanwhile,
+        # and only the answer of the previous batch is waited for before writing the next one
+        self._ack_await_write = ack_await_write
+        # source stream -> write of answers, which is not finished yet
+        self._pending_answers: Dict[IOStream, Any] = {}
+        self._replay_buffer = replay.ReplayBuffer(replay_buffer_bytes) if replay_buffer_bytes else None
+        self._sources_journal = sources_journal
+        self._tracer = tracing.Tracer() if tracer is None else tracer
+        self._snapshot_chunk_size = snapshot_chunk_size
+        self._listener_queue_size = listener_queue_size
+        self._listener_overflow_policy = listener_overflow_policy
+        self._listener_flush_delay_us = listener_flush_delay_us
+        self._listener_flush_bytes = listener_flush_bytes
+        if transport == 'tornado':
+            sources_server_class, listeners_server_class = SourcesServer, ListenersServer
+        else:
+            import aio_server
+
+            if transport not in aio_server.transports:
+                raise ValueError(f'unknown transport {transport}')
+            sources_server_class, listeners_server_class = aio_server.SourcesServer, aio_server.ListenersServer
+        self._sources_server = sources_server_class(
             on_connect=self._on_source_connect,
-            on_msg=self._on_source_msg,
+            on_msgs=self._on_source_msgs,
             on_close=self._on_source_close,
+            read_buffer_size=source_read_buffer_size,
+            tracer=self._tracer,
         )
-        self._listeners_server = ListenersServer(
+        self._listeners_server = listeners_server_class(
             on_connect=self._on_listener_connect,
             on_close=self._on_listener_close,
+            handshake_timeout_ms=listener_handshake_timeout_ms,
+        )
+        self._binary_listeners_server = listeners_server_class(
+            on_connect=self._on_binary_listener_connect,
+            on_close=self._on_listener_close,
+            handshake_timeout_ms=listener_handshake_timeout_ms,
+        )
+        self._sources_connects = registry.Registry()
+        self._listeners_connects = registry.Registry(on_remove=self._on_listener_removed)
+        self._subscriptions = subscriptions.SubscriptionIndex()
+        self._bus = None
+        self._init_metrics()
+
+    def _init_metrics(self):
+        self._frames_parsed = metrics.REGISTRY.counter(
+            'dispatcher_frames_parsed_total', 'Frames from sources parsed successfully')
+        self._frames_rejected = metrics.REGISTRY.counter(
+            'dispatcher_frames_rejected_total', 'Corrupted frames from sources')
+        self._parse_seconds = metrics.REGISTRY.histogram(
+            'dispatcher_parse_seconds', 'Time of parsing a frame from a source')
+        self._ack_write_seconds = metrics.REGISTRY.histogram(
+            'dispatcher_ack_write_seconds', 'Time of writing answers to a source')
+        self._fanout_seconds = metrics.REGISTRY.histogram(
+            'dispatcher_fanout_seconds', 'Time of putting a message to queues of all listeners')
+        metrics.REGISTRY.gauge(
+            'dispatcher_sources', 'Known sources', lambda: len(store.SourcesStore))
+        metrics.REGISTRY.gauge(
+            'dispatcher_listeners', 'Connected listeners', lambda: len(self._listeners_connects))
+        metrics.REGISTRY.gauge(
+            'dispatcher_listener_queue_depth', 'Messages in queue of a listener',
+            lambda: {id_: len(queue) for id_, queue in self._listeners_connects.items()},
+            label='listener',
+        )
+        metrics.REGISTRY.gauge(
+            'dispatcher_listener_written_bytes_total', 'Bytes written to a listener',
+            lambda: {id_: queue.bytes_written for id_, queue in self._listeners_connects.items()},
+            label='listener',
+            type_='counter',
+        )
+        metrics.REGISTRY.gauge(
+            'dispatcher_listener_dropped_total', 'Messages dropped by overflow of the queue of a listener',
+            lambda: {id_: queue.dropped for id_, queue in self._listeners_connects.items()},
+            label='listener',
+            type_='counter',
         )
-        self._sources_connects = {}
-        self._listeners_connects = {}
+        # statistics of coalesced writes of listeners: name, help, key of FlushStats.as_dict(), type
+        for name, help_, key, type_ in (
+            ('dispatcher_listener_flushes_total', 'Coalesced writes to a listener', 'flushes', 'counter'),
+            ('dispatcher_listener_flushed_msgs_total', 'Messages written to a listener', 'items', 'counter'),
+            ('dispatcher_listener_flush_max_msgs', 'Most messages in a write to a listener', 'max_items', 'gauge'),
+            ('dispatcher_listener_flush_avg_latency_seconds',
+             'Average time from queueing the first message of a write to a listener till the write', 'avg_latency', 'gauge'),
+            ('dispatcher_listener_flush_max_latency_seconds',
+             'Longest time from queueing the first message of a write to a listener till the write', 'max_latency', 'gauge'),
+        ):
+            metrics.REGISTRY.gauge(
+                name, help_,
+                functools.partial(self._get_flush_stat, key),
+                label='listener',
+                type_=type_,
+            )
+        metrics.REGISTRY.gauge(
+            'dispatcher_fanout_inflight_bytes', 'Bytes queued to listeners and not written yet',
+            lambda: self._inflight.value)
+
+    def _get_flush_stat(self, key: str) -> Dict[int, float]:
+        return {id_: queue.flush_stats.as_dict()[key] for id_, queue in self._listeners_connects.items()}
+
+    def listen(self, sources_port, listeners_port, reuse_port=False, binary_listeners_port=None):
+        """
+        :param binary_listeners_port: port for listeners receiving binary messages without negotiation
+        """
+        self._sources_server.listen(sources_port, reuse_port=reuse_port)
+        self._listeners_server.listen(listeners_port, reuse_port=reuse_port)
+        if binary_listeners_port is not None:
+            self._binary_listeners_server.listen(binary_listeners_port, reuse_port=reuse_port)
 
-    def listen(self, sources_port, listeners_port):
-        self._sources_server.listen(sources_port)
-        self._listeners_server.listen(listeners_port)
+    def configure_listeners(self,
+                            queue_size: int,
+                            overflow_policy: str,
+                            flush_delay_us: int,
+                            flush_bytes: int,
+                            snapshot_chunk_size: int):
+        """ Changes limits of queues of listeners, both new and connected ones """
+        if overflow_policy not in fanout.overflow_policies:
+            raise ValueError(f'unknown overflow policy {overflow_policy}')
+        self._listener_queue_size = queue_size
+        self._listener_overflow_policy = overflow_policy
+        self._listener_flush_delay_us = flush_delay_us
+        self._listener_flush_bytes = flush_bytes
+        self._snapshot_chunk_size = snapshot_chunk_size
+        for _, listener_queue in self._listeners_connects.items():
+            listener_queue.configure(queue_size, overflow_policy, flush_delay_us, flush_bytes)
+
+    async def join_bus(self, path: str, worker_id: int, workers_count: int):
+        """
+        Exchanges messages of sources with other worker processes
+        """
+        import bus
+
+        self._bus = bus.Bus(
+            path=path,
+            worker_id=worker_id,
+            workers_count=workers_count,
+            on_msgs=self._on_bus_msgs,
+        )
+        await self._bus.start()
 
     async def _on_source_connect(self, source_stream: IOStream):
         pass
 
-    async def _on_source_msg(self, source_stream: IOStream, msg: bytes):
+    async def _on_source_msgs(self,
+                              source_stream: IOStream,
+                              msgs: Sequence[bytes],
+                              trace: Optional[tracing.Trace] = None):
+        """
+        Handles a batch of messages read from a source at once.
+        All of them are validated and answered with a single write first,
+        and only then stored and redirected to listeners, so answers don't wait for fan-out.
+        """
+        if self._parse_pool is not None and any(map(self._parse_pool.is_big, msgs)):
+            parsed_frames = await self._parse_offloaded(msgs, trace)
+        elif source_protocol.is_batch_faster(msgs):
+            parsed_frames = self._parse_source_batch(msgs, trace)
+        else:
+            parsed_frames = [self._parse_source_msg(msg, trace) for msg in msgs]
+        if self._rate_limiter is not None:
+            if self._rate_limiter.policy == admission.PAUSE:
+                await self._rate_limiter.hold(source_stream, parsed_frames, self._inflight)
+            else:
+                # frames over limits are answered as corrupted ones
+                parsed_frames = self._rate_limiter.admit(source_stream, parsed_frames, self._inflight.value)
+        answer_to_source = b''.join(
+            source_protocol.FAILURE_ANSWER if parsed is None
+            else source_protocol.gen_success_answer(parsed.num)
+            for parsed in parsed_frames
+        )
+        if trace is not None:
+            trace.skip()
+        started = time.perf_counter()
+        # an answer of the previous batch, which is still not written, limits memory
+        # taken by a source, which doesn't read answers
+        pending = self._pending_answers.pop(source_stream, None)
+        if pending is not None:
+            with contextlib.suppress(StreamClosedError):
+                await pending
+        # the next read finds out that the source is closed
+        answer_write = None if source_stream.closed() else source_stream.write(answer_to_source)
+        ack_seconds = time.perf_counter() - started
+        if trace is not None:
+            trace.mark('ack')
+        logging.debug('source notified with %s', answer_to_source)
+
+        accepted = []
+        for msg, parsed in zip(msgs, parsed_frames):
+            if parsed is None:
+                continue
+            if self._sources_connects.get(parsed.source_id) is not source_stream:
+                self._sources_connects.add(parsed.source_id, source_stream)
+            accepted.append(msg)
+            self._apply_source_frame(parsed, msg, trace)
+        if accepted and self._bus is not None:
+            self._bus.publish(b''.join(accepted))
+        if accepted and self._sources_journal is not None:
+            self._sources_journal.append(accepted, time.time_ns())
+
+        if answer_write is not None and not answer_write.done():
+            if self._ack_await_write:
+                if trace is not None:
+                    trace.skip()
+                started = time.perf_counter()
+                await answer_write
+                ack_seconds += time.perf_counter() - started
+                if trace is not None:
+                    trace.mark('ack')
+            else:
+                self._pending_answers[source_stream] = answer_write
+        self._ack_write_seconds.observe(ack_seconds)
+        if trace is not None:
+            trace.frames = len(msgs)
+            self._tracer.finish(trace)
+
+    def _on_bus_msgs(self, msgs: Sequence[bytes]):
+        """
+        Messages received by other workers are already answered,
+        they only need to be stored and redirected to listeners.
+        """
+        for msg in msgs:
+            self._on_source_msg(msg)
+
+    def _on_source_msg(self,
+                       msg: bytes,
+                       trace: Optional[tracing.Trace] = None) -> Optional[source_protocol.SourceFrame]:
         """
         Every message from sources has to be redirected to listeners.
         And every listener wants to receive a state of every source - so we
         need to update this state every time.
+        :return: parsed message or None if it is corrupted
         """
-        logging.debug(f'received from source {msg}')
-        parsed = source_protocol.parse_source_bytes(msg)
-        if not parsed:
-            answer_to_source = source_protocol.gen_answer_to_source(success=False)
-            await source_stream.write(answer_to_source)
-            return
-        logging.debug(f'parsed to {parsed}')
-        source_id = parsed['source_id']
+        parsed = self._parse_source_msg(msg, trace)
+        if parsed is not None:
+            self._apply_source_frame(parsed, msg, trace)
+        return parsed
+
+    def _parse_source_msg(self,
+                          msg: bytes,
+                          trace: Optional[tracing.Trace] = None) -> Optional[source_protocol.SourceFrame]:
+        """ :return: parsed message or None if it is corrupted """
+        logging.debug('received from source %s', msg)
+        if trace is not None:
+            trace.skip()
+        started = time.perf_counter()
+        parsed = source_protocol.parse_source_frame(msg)
+        self._parse_seconds.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('parse')
+        if parsed is None:
+            self._frames_rejected.inc()
+            return None
+        self._frames_parsed.inc()
+        logging.debug('parsed to %s', parsed)
+        return parsed
+
+    def _parse_source_batch(self,
+                            msgs: Sequence[bytes],
+                            trace: Optional[tracing.Trace] = None) -> List[Optional[source_protocol.SourceFrame]]:
+        """ Parses a burst of many records at once with numpy, :return: parsed frames or None for corrupted ones """
+        if trace is not None:
+            trace.skip()
+        started = time.perf_counter()
+        parsed_frames = source_protocol.parse_source_frames(msgs).frames
+        # the histogram is of single frames
+        frame_seconds = (time.perf_counter() - started) / len(msgs)
+        for _ in msgs:
+            self._parse_seconds.observe(frame_seconds)
+        if trace is not None:
+            trace.mark('parse')
+        rejected = parsed_frames.count(None)
+        self._frames_rejected.inc(rejected)
+        self._frames_parsed.inc(len(parsed_frames) - rejected)
+        return parsed_frames
+
+    async def _parse_offloaded(self,
+                               msgs: Sequence[bytes],
+                               trace: Optional[tracing.Trace] = None) -> List[Optional[source_protocol.SourceFrame]]:
+        """ Parses big frames of a batch in the pool and the rest of them in place """
+        if trace is not None:
+            trace.skip()
+        offloaded = iter(await self._parse_pool.parse([msg for msg in msgs if self._parse_pool.is_big(msg)]))
+        if trace is not None:
+            trace.mark('parse')
+        parsed_frames = []
+        for msg in msgs:
+            if not self._parse_pool.is_big(msg):
+                parsed_frames.append(self._parse_source_msg(msg, trace))
+                continue
+            parsed = next(offloaded)
+            if parsed is None:
+                self._frames_rejected.inc()
+            else:
+                self._frames_parsed.inc()
+            parsed_frames.append(parsed)
+        return parsed_frames
+
+    def _apply_source_frame(self,
+                            parsed: source_protocol.SourceFrame,
+                            msg: bytes,
+                            trace: Optional[tracing.Trace] = None):
+        """ Updates state of the source and redirects the message to listeners """
+        if trace is not None:
+            trace.skip()
         store.SourcesStore.update_state(
-            source_id=source_id,
-            serial_num=parsed['num'],
-            state=parsed['source_state'],
-            last_received=datetime.datetime.now(),
-        )
-        if source_id not in self._sources_connects:
-            self._sources_connects[source_id] = source_stream
-        answer_to_source = source_protocol.gen_answer_to_source(
-            success=True,
-            serial_num=parsed['num'],
+            source_id=parsed.source_id,
+            serial_num=parsed.num,
+            state=parsed.source_state,
+            last_received=time.monotonic_ns(),
         )
-        await source_stream.write(answer_to_source)
-        logging.debug(f'sources {source_id} notified with {answer_to_source} ')
-        await self._send_to_listeners(parsed['msgs'], source_id)
+        if trace is not None:
+            trace.mark('store')
+        started = time.perf_counter()
+        self._send_to_listeners(parsed.msgs, parsed.source_id, msg)
+        self._fanout_seconds.observe(time.perf_counter() - started)
+        if trace is not None:
+            trace.mark('fanout')
 
     async def _on_source_close(self, source_stream: IOStream):
         """
         Need to delete pointer to the stream
         """
         logging.debug('closed source')
-        source_id = next(
-            (k for k, v in self._sources_connects.items() if v is source_stream),
-            None,
-        )
-        if source_id:
-            logging.debug(f'source had id {source_id}')
-            self._sources_connects.pop(source_id)
+        self._pending_answers.pop(source_stream, None)
+        source_ids = self._sources_connects.remove_stream(source_stream)
+        if self._rate_limiter is not None:
+            self._rate_limiter.forget(source_stream, source_ids or ())
+        if source_ids:
+            logging.debug('source had ids %s', source_ids)
+            if self._evictor is not None:
+                self._evictor.on_source_close(source_ids)
 
-    async def _on_listener_connect(self, listener_stream: IOStream):
+    async def _on_listener_connect(self,
+                                   listener_stream: IOStream,
+                                   handshake: bytes = None,
+                                   default_format: str = listener_protocol.TEXT):
         """
         Registers a listener in the system
+        :param handshake: optional line with options sent by the listener right after connect
+        :param default_format: format of messages if the listener hasn't chosen it by handshake
+        """
+        try:
+            options = listener_protocol.parse_handshake(handshake)
+        except ValueError as e:
+            logging.warning('Wrong handshake of listener %r: %s', handshake, e)
+            options = listener_protocol.parse_handshake(None)
+        subscription = subscriptions.from_handshake(options, default_format)
+        # the listener will be notified about all current sources by the snapshot,
+        # and about sources registered later - by their first messages.
+        # Sources of other states are announced too: the listener is marked as notified
+        # about all of them, and a source can change its state later.
+        # The store is read lazily by chunks of the snapshot, so it isn't copied per listener
+        last_seq = store.SourcesStore.last_seq
+        sources = store.SourcesStore.iter_sources(last_seq)
+        if subscriptions.is_filtered_by_source(subscription):
+            sources = (source for source in sources if subscriptions.match_source(subscription, source.id_))
+        # replayed messages are taken at once with the snapshot, so live messages continue them without gaps
+        replayed = self._get_replayed(options, subscription)
+        id_ = store.ListenersStore.add_listener(notified_seq=last_seq)
+        self._subscriptions.add(id_, subscription)
+        listener_queue = fanout.ListenerQueue(
+            listener_stream,
+            maxsize=self._listener_queue_size,
+            overflow_policy=self._listener_overflow_policy,
+            flush_delay_us=self._listener_flush_delay_us,
+            flush_bytes=self._listener_flush_bytes,
+            inflight=self._inflight,
+        )
+        self._listeners_connects.add(id_, listener_stream, listener_queue)
+        logging.debug('Listener %s connected to system', id_)
+        IOLoop.current().spawn_callback(
+            self._notify_about_sources, id_, listener_queue, sources, replayed, subscription.binary)
+
+    async def _on_binary_listener_connect(self, listener_stream: IOStream, handshake: bytes = None):
+        await self._on_listener_connect(listener_stream, handshake, default_format=listener_protocol.BINARY)
+
+    def _get_replayed(self,
+                      options: listener_protocol.Handshake,
+                      subscription: subscriptions.Subscription) -> Sequence[bytes]:
+        """
+        Replayed messages are filtered like live ones. Filters of states and fields
+        are applied to replayed frames, as they keep the state of the source at the moment
+        of every message, so the messages are rendered again for such listeners.
         """
-        id_ = store.ListenersStore.add_listener()
-        self._listeners_connects[id_] = listener_stream
-        await self._notify_about_sources(id_, listener_stream)
+        if self._replay_buffer is None:
+            return ()
+        match_source = (
+            functools.partial(subscriptions.match_source, subscription)
+            if subscriptions.is_filtered_by_source(subscription) else None)
+        filtered = subscription.states is not None or subscription.fields is not None
+        binary = subscription.binary or filtered
+        if options.replay_last is not None:
+            replayed = self._replay_buffer.last(options.replay_last, match_source, binary)
+        elif options.replay_seconds is not None:
+            since = time.monotonic_ns() - int(options.replay_seconds * 1e9)
+            replayed = self._replay_buffer.since(since, match_source, binary)
+        else:
+            return ()
+        if not filtered:
+            return replayed
+        msgs = (_gen_replayed_msg(frame, subscription) for frame in replayed)
+        return [msg for msg in msgs if msg]
 
     async def _on_listener_close(self, listener_stream: IOStream):
         """
         Need to delete pointer to the stream
         """
-        listener_id = next(
-            (k for k, v in self._listeners_connects.items() if v is listener_stream),
-            None,
-        )
-        if listener_id:
-            self._listeners_connects.pop(listener_id)
-
-    @staticmethod
-    async def _notify_about_sources(listener_id: int, listener_stream: IOStream):
-        sources = store.SourcesStore.get_all()
-        str_per_source = (
-            _gen_notify_about_source_msg(source)
-            for source in sources
+        self._listeners_connects.remove_stream(listener_stream)
+
+    def _on_listener_removed(self, listener_id: int, listener_queue: fanout.ListenerQueue):
+        listener_queue.close()
+        self._subscriptions.remove(listener_id)
+        store.ListenersStore.remove_listener(listener_id)
+
+    async def _notify_about_sources(self,
+                                    listener_id: int,
+                                    listener_queue: fanout.ListenerQueue,
+                                    sources: Iterable[store.Source],
+                                    replayed: Iterable[bytes] = (),
+                                    binary: bool = False):
+        """
+        Streams state of all sources and then replayed messages to a new listener
+        by chunks, waiting for every chunk to be written, so memory per listener stays bounded.
+        Messages for the listener are queued meanwhile and written after.
+        """
+        msgs = itertools.chain(
+            (_gen_notify_about_source_msg(source, binary) for source in sources),
+            replayed,
         )
-        logging.debug(f'Listener {listener_id} connected to system')
-        await listener_stream.write(b''.join(str_per_source))
-        # Need to store notified state, cuz while we notify current sources -
-        # more of them can connect.
-        # So on every received message we will check if a listener was
-        # notified about a source of the message
-        for source in sources:
-            logging.debug(f'Listener {listener_id} notified about source {source.id_}')
-            store.ListenersStore.set_notified(listener_id, source.id_)
-
-    async def _send_to_listeners(self, msgs: Sequence[Tuple[str, int]], source_id):
-        for listener in store.ListenersStore.get_all():
-            listener_stream = self._listeners_connects[listener.id_]
-
-            # ensure listener knows about source before sending him current messages
-            if source_id not in listener.sources_notified:
-                source = store.SourcesStore.get_state(source_id)
-                await listener_stream.write(_gen_notify_about_source_msg(source))
-                logging.debug(f'Listener {listener.id_} notified about source {source_id}')
-
-            listener_msg = b''.join(
-                bytes(f'[{source_id}] {str(key, encoding="ascii")} | {value}\r\n', encoding='ascii')
-                for key, value in msgs
-            )
-            await listener_stream.write(listener_msg)
-            logging.debug(f'To listener {listener.id_} sent {listener_msg}')
+        try:
+            while not listener_queue.closed:
+                chunk = list(itertools.islice(msgs, self._snapshot_chunk_size))
+                if not chunk:
+                    break
+                await listener_queue.stream.write(b''.join(chunk))
+                logging.debug('Listener %s got %s messages of snapshot', listener_id, len(chunk))
+                # let other coroutines run between chunks
+                await gen.sleep(0)
+        except StreamClosedError:
+            return
+        if not listener_queue.closed:
+            listener_queue.start()
+
+    def _send_to_listeners(self, msgs: Sequence[Tuple[str, int]], source_id, frame: bytes):
+        """
+        Puts messages to queues of subscribed listeners without waiting for them to be written.
+        The text message is rendered once and the same bytes are shared by all text listeners,
+        binary listeners get the validated frame itself.
+        Listeners filtering fields share a message rendered once per filter and format.
+        """
+        listener_msg = None
+        if self._replay_buffer is not None:
+            listener_msg = _gen_listener_msg(source_id, msgs)
+            if listener_msg:
+                self._replay_buffer.append(listener_msg, frame, source_id)
+        source = store.SourcesStore.get_state(source_id)
+        # by binary flag of listeners
+        notify_msgs = {}
+        filtered_msgs = None
+        # checked once, so nothing is logged or formatted per listener if debug is off
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for listener_id, subscription in self._subscriptions.subscribers(source_id):
+            listener_queue = self._listeners_connects[listener_id]
+
+            # ensure listener knows about source before sending him current messages,
+            # even if they are filtered out by its state - the seq of a listener only grows,
+            # so a source skipped here would never be announced after a later one
+            if not store.ListenersStore.is_notified(listener_id, source.seq):
+                notify_msg = notify_msgs.get(subscription.binary)
+                if notify_msg is None:
+                    notify_msg = notify_msgs[subscription.binary] = _gen_notify_about_source_msg(
+                        source, subscription.binary)
+                listener_queue.put(notify_msg)
+                store.ListenersStore.set_notified(listener_id, source.seq)
+                if debug:
+                    logging.debug('Listener %s notified about source %s', listener_id, source_id)
+
+            if subscription.states is not None and source.state not in subscription.states:
+                continue
+            if subscription.fields is not None:
+                if filtered_msgs is None:
+                    filtered_msgs = {}
+                key = subscription.fields, subscription.binary
+                msg = filtered_msgs.get(key)
+                if msg is None:
+                    msg = filtered_msgs[key] = _gen_filtered_msg(source_id, msgs, frame, subscription)
+                if not msg:
+                    continue
+            elif subscription.binary:
+                msg = frame
+            else:
+                if listener_msg is None:
+                    listener_msg = _gen_listener_msg(source_id, msgs)
+                msg = listener_msg
+            listener_queue.put(msg)
+            if debug:
+                logging.debug('To listener %s sent %s', listener_id, msg)
+
+
+def _gen_listener_msg(source_id: str, msgs: Sequence[Tuple[bytes, int]]) -> bytes:
+    prefix = f'[{source_id}] '.encode('ascii')
+    return b''.join(
+        b'%s%s | %d\r\n' % (prefix, key, value)
+        for key, value in msgs
+    )
+
+
+def _gen_filtered_msg(source_id: str,
+                      msgs: Sequence[Tuple[bytes, int]],
+                      frame: bytes,
+                      subscription: subscriptions.Subscription) -> bytes:
+    """ :return: message with matching fields only or empty bytes if none of them match """
+    if subscription.binary:
+        frame = listener_protocol.filter_frame(frame, subscription.fields)
+        return frame if frame[source_protocol.HEADER_STRUCT.size - 1] else b''
+    return _gen_listener_msg(source_id, subscription.fields.filter(msgs))
+
+
+def _gen_replayed_msg(frame: bytes, subscription: subscriptions.Subscription) -> bytes:
+    """ :return: replayed frame rendered for a listener filtering states or fields, empty bytes if it's filtered out """
+    parsed = source_protocol.parse_source_frame(frame)
+    if not subscriptions.match_state(subscription, parsed.source_state):
+        return b''
+    if subscription.fields is not None:
+        return _gen_filtered_msg(parsed.source_id, parsed.msgs, frame, subscription)
+    return frame if subscription.binary else _gen_listener_msg(parsed.source_id, parsed.msgs)
 
 
-def _gen_notify_about_source_msg(source: store.Source):
-    time_since_last_msg = datetime.datetime.now() - source.last_received
-    ms_since_last_msg = time_since_last_msg.total_seconds() * 1000.0
+def _gen_notify_about_source_msg(source: store.Source, binary: bool = False):
+    ms_since_last_msg = (time.monotonic_ns() - source.last_received) / 1e6
+    if binary:
+        return listener_protocol.gen_binary_status(source.id_, source.serial_num, source.state, ms_since_last_msg)
     msg = f'[{source.id_}] {source.serial_num} | {source.state} | {ms_since_last_msg}\r\n'
     return bytes(msg, encoding='ascii')
 
@@ -147,25 +606,51 @@ def _gen_notify_about_source_msg(source: store.Source):
 class SourcesServer(TCPServer):
     """
     Manages connects to sources.
+
+    Reads from a source by big chunks into a reusable buffer and hands
+    all complete frames of a chunk to on_msgs at once.
+    If tracing is enabled, a trace of the chunk is handed to on_msgs too.
     """
 
     def __init__(self,
                  on_connect: Callable[[IOStream], Any],
-                 on_msg: Callable[[IOStream, bytes], Any],
+                 on_msgs: Callable[[IOStream, Sequence[bytes], Optional[tracing.Trace]], Any],
                  on_close: Callable[[IOStream], Any],
-                 *args, **kwargs):
+                 *args,
+                 read_buffer_size: int = 65536,
+                 tracer: tracing.Tracer = None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         self._on_connect = on_connect
-        self._on_msg = on_msg
+        self._on_msgs = on_msgs
+        self._tracer = tracing.Tracer() if tracer is None else tracer
         self._on_close = on_close
+        # the buffer must be able to hold at least one frame of any size
+        self._read_buffer_size = max(read_buffer_size, 2 * source_protocol.MAX_FRAME_SIZE)
 
     async def handle_stream(self, stream: IOStream, address: str):
+        # answers are tiny, Nagle's algorithm would hold them until previous ones are acknowledged
+        stream.set_nodelay(True)
         await self._on_connect(stream)
+        buffer = bytearray(self._read_buffer_size)
+        view = memoryview(buffer)
+        start = end = 0
         try:
             while True:
-                meta = await stream.read_bytes(13)
-                msgs = await stream.read_bytes(meta[-1] * 13)
-                await self._on_msg(stream, meta+msgs)
+                end += await stream.read_into(view[end:], partial=True)
+                trace = self._tracer.begin()
+                msgs, consumed = source_protocol.split_frames(view[start:end])
+                start += consumed
+                if start == end:
+                    start = end = 0
+                elif len(buffer) - end < source_protocol.MAX_FRAME_SIZE:
+                    # move an incomplete frame to the beginning of the buffer
+                    buffer[:end - start] = bytes(view[start:end])
+                    start, end = 0, end - start
+                if msgs:
+                    if trace is not None:
+                        trace.mark('read')
+                    await self._on_msgs(stream, msgs, trace)
         except StreamClosedError:
             await self._on_close(stream)
 
@@ -176,34 +661,193 @@ class ListenersServer(TCPServer):
     """
 
     def __init__(self,
-                 on_connect: Callable[[IOStream], Any],
+                 on_connect: Callable[[IOStream, Optional[bytes]], Any],
                  on_close: Callable[[IOStream], Any],
-                 *args, **kwargs):
+                 *args,
+                 handshake_timeout_ms: int = 0,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         self._on_connect = on_connect
         self._on_close = on_close
+        self._handshake_timeout = datetime.timedelta(milliseconds=handshake_timeout_ms)
 
     async def handle_stream(self, stream: IOStream, address: str):
-        await self._on_connect(stream)
+        handshake = None
+        reading = None
+        if self._handshake_timeout:
+            # a listener has handshake_timeout to send its options, otherwise it's served without them
+            reading = stream.read_until(b'\n', max_bytes=listener_protocol.MAX_HANDSHAKE_SIZE)
+            try:
+                handshake = await gen.with_timeout(
+                    self._handshake_timeout, reading, quiet_exceptions=(StreamClosedError, UnsatisfiableReadError))
+                reading = None
+            except TimeoutError:
+                pass
+            except (StreamClosedError, UnsatisfiableReadError):
+                # too long handshake closes the stream too
+                return
+        await self._on_connect(stream, handshake)
         try:
+            if reading is not None:
+                await reading
             while True:
-                # just wait until close - we don't expect any data from a listener
-                await stream.read_until_close()
-        except StreamClosedError:
+                # just wait until close - we don't expect any data from a listener besides handshake,
+                # so it's read and thrown away.
+                # read_until_close can't be used: it returns instead of raising
+                # once the stream is closed
+                await stream.read_bytes(65536, partial=True)
+        except (StreamClosedError, UnsatisfiableReadError):
             await self._on_close(stream)
 
 
 def main():
     conf = config.get_config()
     logging.basicConfig(
-        level=logging.DEBUG if conf['debug'] else logging.INFO,
+        level=logging.DEBUG if conf.debug else logging.INFO,
         format='%(levelname)s:%(asctime)s:%(message)s',
     )
-    disp = Dispatcher()
+    if conf.uvloop:
+        # the policy has to be set before tornado creates a loop
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    store.init_sources_store(conf.sources_store)
+    journal_path = conf.journal_path
+    if journal_path:
+        import journal
+
+        # workers inherit the restored store
+        started = time.perf_counter()
+        restored = journal.restore_sources(journal_path)
+        logging.info('%d sources restored from journal in %.2f s', restored, time.perf_counter() - started)
+        # so the next start scans only the states of sources and frames of this run
+        compacted = journal.compact(journal_path)
+        logging.info('%d journal segments compacted', compacted)
+    workers_count = conf.workers
+    if workers_count > 1:
+        # needed by workers only, so a single process starts without them
+        import tempfile
+        from tornado.process import fork_processes
+
+        bus_path = tempfile.mkdtemp(prefix='dispatcher-bus-')
+        worker_id = fork_processes(workers_count)
+    tracer = tracing.Tracer(
+        enabled=conf.tracing,
+        sample_every=conf.trace_sample_every,
+        dump_path=conf.trace_dump_path,
+        profile_path=conf.profile_path,
+    )
+    sources_journal = None
+    if journal_path:
+        sources_journal = journal.Journal(
+            path=journal_path,
+            worker_id=worker_id if workers_count > 1 else 0,
+            segment_size=conf.journal_segment_size,
+            buffer_size=conf.journal_buffer_size,
+            flush_interval_ms=conf.journal_flush_interval_ms,
+        )
+        sources_journal.start()
+    evictor = eviction.Evictor(
+        ttl_s=conf.source_ttl_s,
+        max_sources=conf.max_sources,
+        evict_on_close=conf.source_evict_on_close,
+        interval_ms=conf.eviction_interval_ms,
+        batch_size=conf.eviction_batch_size,
+        sources_journal=sources_journal,
+    )
+    evictor.start()
+    rate_limiter = None
+    limits = dict(
+        source_msgs_per_s=conf.source_msgs_per_s,
+        source_records_per_s=conf.source_records_per_s,
+        connection_msgs_per_s=conf.connection_msgs_per_s,
+        connection_records_per_s=conf.connection_records_per_s,
+    )
+    if any(limit is not None for limit in limits.values()) or conf.max_inflight_bytes is not None:
+        rate_limiter = admission.RateLimiter(
+            **limits,
+            burst_s=conf.rate_limit_burst_s,
+            max_inflight_bytes=conf.max_inflight_bytes,
+            policy=conf.throttle_policy,
+        )
+        rate_limiter.start()
+    parse_pool = None
+    if conf.parse_offload_min_size:
+        import offload
+
+        parse_pool = offload.ParsePool(
+            min_size=conf.parse_offload_min_size,
+            executor=conf.parse_offload_executor,
+            workers=conf.parse_offload_workers,
+        )
+    disp = Dispatcher(
+        listener_queue_size=conf.listener_queue_size,
+        listener_overflow_policy=conf.listener_overflow_policy,
+        source_read_buffer_size=conf.source_read_buffer_size,
+        listener_flush_delay_us=conf.listener_flush_delay_us,
+        listener_flush_bytes=conf.listener_flush_bytes,
+        snapshot_chunk_size=conf.snapshot_chunk_size,
+        tracer=tracer,
+        sources_journal=sources_journal,
+        replay_buffer_bytes=conf.replay_buffer_bytes,
+        listener_handshake_timeout_ms=conf.listener_handshake_timeout_ms,
+        ack_await_write=conf.source_ack_await_write,
+        evictor=evictor,
+        transport=conf.transport,
+        parse_pool=parse_pool,
+        rate_limiter=rate_limiter,
+    )
     disp.listen(
-        sources_port=conf['sources_port'],
-        listeners_port=conf['listeners_port'],
+        sources_port=conf.sources_port,
+        listeners_port=conf.listeners_port,
+        reuse_port=workers_count > 1,
+        binary_listeners_port=conf.binary_listeners_port,
     )
+    if workers_count > 1:
+        IOLoop.current().spawn_callback(disp.join_bus, bus_path, worker_id, workers_count)
+    if conf.metrics_port:
+        # every worker serves its own metrics on the next port
+        metrics.start_http_server(conf.metrics_port + (worker_id if workers_count > 1 else 0))
+    # SIGUSR1 switches tracing, SIGUSR2 switches profiling of a running process
+    IOLoop.current().asyncio_loop.add_signal_handler(signal.SIGUSR1, tracer.toggle)
+    IOLoop.current().asyncio_loop.add_signal_handler(signal.SIGUSR2, tracer.toggle_profiling)
+
+    def stop():
+        # frames buffered by the journal are lost on a kill otherwise
+        if sources_journal is not None:
+            sources_journal.close()
+        # workers of the pool don't notice that the app is gone
+        if parse_pool is not None:
+            parse_pool.close()
+        IOLoop.current().stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        IOLoop.current().asyncio_loop.add_signal_handler(signum, stop)
+
+    def reload_config():
+        old = config.get_config()
+        try:
+            new = config.reload()
+            disp.configure_listeners(
+                queue_size=new.listener_queue_size,
+                overflow_policy=new.listener_overflow_policy,
+                flush_delay_us=new.listener_flush_delay_us,
+                flush_bytes=new.listener_flush_bytes,
+                snapshot_chunk_size=new.snapshot_chunk_size,
+            )
+        except (OSError, ValueError) as e:
+            logging.error('config is not reloaded: %s', e)
+            return
+        # only once it's applied, and options needing a restart keep the values the app runs with
+        config.set_config(new)
+        logging.getLogger().setLevel(logging.DEBUG if new.debug else logging.INFO)
+        changed = config.changed(old, new)
+        logging.info('config reloaded, changed %s', [name for name in changed if name in config.RELOADABLE])
+        not_applied = [name for name in changed if name not in config.RELOADABLE]
+        if not_applied:
+            logging.warning('changes of %s need a restart', not_applied)
+
+    # SIGHUP applies tunables of the config without a restart
+    IOLoop.current().asyncio_loop.add_signal_handler(signal.SIGHUP, reload_config)
     IOLoop.current().start()
 
 
@@ -0,0 +1,4 @@
+"""
+Benchmarks of the system.
+Every module can be ran as `python -m bench.<module>`.
+"""
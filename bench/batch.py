@@ -0,0 +1,34 @@
+"""
+Compares validation of a burst of frames one by one with parse_source_frame
+and at once with parse_source_frames.
+"""
+import timeit
+
+import source_protocol
+from bench.parser import gen_frame
+
+BURST_SIZE = 1000
+RECORDS_COUNTS = (1, 10, 50, 255)
+
+
+def main():
+    # numpy is imported on first call
+    source_protocol.parse_source_frames(b'')
+    print(f'{"records":>8} {"one by one, us/frame":>21} {"batch, us/frame":>16} {"speedup":>8}')
+    for records_count in RECORDS_COUNTS:
+        frames = [gen_frame(records_count) for _ in range(BURST_SIZE)]
+        buffer = b''.join(frames)
+        number = 5
+        one_by_one = timeit.timeit(
+            lambda: [source_protocol.parse_source_frame(frame) for frame in frames],
+            number=number,
+        ) / number / BURST_SIZE
+        batch = timeit.timeit(
+            lambda: source_protocol.parse_source_frames(buffer),
+            number=number,
+        ) / number / BURST_SIZE
+        print(f'{records_count:>8} {one_by_one * 1e6:>21.2f} {batch * 1e6:>16.2f} {one_by_one / batch:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
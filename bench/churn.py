@@ -0,0 +1,96 @@
+"""
+Connects and disconnects 100k listeners and sources with different numbers
+of already connected clients to show that cost per event doesn't depend on it
+and nothing is left in stores after clients are gone.
+"""
+import asyncio
+import time
+
+from tornado.concurrent import Future
+
+import app
+import store
+from bench.parser import gen_frame
+
+CONNECTED_COUNTS = (1000, 10000, 100000)
+CHURN_COUNT = 100000
+
+
+class FakeStream:
+    """ Stream with the part of IOStream interface used by Dispatcher, writes of which are done at once """
+
+    def __init__(self):
+        self._closed = False
+
+    def write(self, data) -> Future:
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+
+async def _listeners_churn(disp: app.Dispatcher, connected_count: int) -> float:
+    connected = [FakeStream() for _ in range(connected_count)]
+    for stream in connected:
+        await disp._on_listener_connect(stream)
+    started = time.perf_counter()
+    for _ in range(CHURN_COUNT):
+        stream = FakeStream()
+        await disp._on_listener_connect(stream)
+        await disp._on_listener_close(stream)
+    per_event = (time.perf_counter() - started) / CHURN_COUNT / 2
+    for stream in connected:
+        await disp._on_listener_close(stream)
+    # let writer tasks of closed listeners finish
+    await asyncio.sleep(0.1)
+    return per_event
+
+
+async def _sources_churn(disp: app.Dispatcher, connected_count: int) -> float:
+    frame = bytearray(gen_frame(1))
+    connected = [FakeStream() for _ in range(connected_count)]
+    for i, stream in enumerate(connected):
+        frame[3:11] = b'%08d' % i
+        await disp._on_source_msgs(stream, [bytes(frame)])
+    frames = []
+    for i in range(CHURN_COUNT):
+        frame[3:11] = b'%08d' % (connected_count + i)
+        frames.append(bytes(frame))
+    started = time.perf_counter()
+    for frame in frames:
+        stream = FakeStream()
+        await disp._on_source_msgs(stream, [frame])
+        await disp._on_source_close(stream)
+    per_event = (time.perf_counter() - started) / CHURN_COUNT / 2
+    for stream in connected:
+        await disp._on_source_close(stream)
+    return per_event
+
+
+async def _main():
+    print(f'{"connected":>10} {"listener, us/event":>19} {"source, us/event":>17} {"leaked":>7}')
+    for connected_count in CONNECTED_COUNTS:
+        store.ListenersStore = store._ListenersStore()
+        store.init_sources_store('dict')
+        disp = app.Dispatcher()
+        listener = await _listeners_churn(disp, connected_count)
+        source = await _sources_churn(disp, connected_count)
+        leaked = (
+            len(store.ListenersStore.get_all())
+            + len(disp._listeners_connects)
+            + len(disp._sources_connects)
+        )
+        print(f'{connected_count:>10} {listener * 1e6:>19.2f} {source * 1e6:>17.2f} {leaked:>7}')
+
+
+def main():
+    asyncio.run(_main())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Measures cost of fan-out of a single source message to listeners.
+Compares rendering the listener message once per source message
+with rendering it for every listener, and fan-out when only 1% of
+listeners are subscribed to the source.
+"""
+import time
+import timeit
+
+import app
+import fanout
+import store
+import subscriptions
+from bench.parser import gen_frame
+
+LISTENERS_COUNTS = (1, 10, 100, 1000, 10000)
+SOURCE_ID = 'benchsrc'
+MSGS = [(b'field%03d' % i, i * 1000) for i in range(10)]
+FRAME = gen_frame(len(MSGS))
+
+
+class NullStream:
+    """ Stream which is never written, the queue is never started """
+
+    def close(self):
+        pass
+
+
+def _setup(listeners_count: int, subscribed_share: float = 1.0) -> app.Dispatcher:
+    store.ListenersStore = store._ListenersStore()
+    store.init_sources_store('dict')
+    store.SourcesStore.update_state(SOURCE_ID, 1, 'IDLE', time.monotonic_ns())
+    disp = app.Dispatcher(
+        listener_queue_size=1,
+        listener_overflow_policy=fanout.DROP_OLDEST,
+    )
+    subscribed_every = round(1 / subscribed_share)
+    for i in range(listeners_count):
+        id_ = store.ListenersStore.add_listener(notified_seq=store.SourcesStore.last_seq)
+        if i % subscribed_every == 0:
+            subscription = subscriptions.ALL
+        else:
+            subscription = subscriptions.ALL._replace(source_ids=frozenset({'othersrc'}))
+        disp._subscriptions.add(id_, subscription)
+        stream = NullStream()
+        disp._listeners_connects.add(id_, stream, fanout.ListenerQueue(
+            stream, maxsize=1, overflow_policy=fanout.DROP_OLDEST,
+        ))
+    return disp
+
+
+def _render_per_listener(disp: app.Dispatcher):
+    """ Fan-out as it was done before: the message is rendered for every listener """
+    for listener in store.ListenersStore.get_all():
+        listener_msg = b''.join(
+            bytes(f'[{SOURCE_ID}] {str(key, encoding="ascii")} | {value}\r\n', encoding='ascii')
+            for key, value in MSGS
+        )
+        disp._listeners_connects[listener.id_].put(listener_msg)
+
+
+def main():
+    print(f'{"listeners":>10} {"render once, us":>16} {"per listener, us":>17} {"1% subscribed, us":>18}')
+    for listeners_count in LISTENERS_COUNTS:
+        disp = _setup(listeners_count)
+        number = max(1, 20000 // listeners_count)
+        once = timeit.timeit(lambda: disp._send_to_listeners(MSGS, SOURCE_ID, FRAME), number=number)
+        per_listener = timeit.timeit(lambda: _render_per_listener(disp), number=number)
+        disp = _setup(listeners_count, subscribed_share=0.01)
+        subscribed = timeit.timeit(lambda: disp._send_to_listeners(MSGS, SOURCE_ID, FRAME), number=number)
+        print(
+            f'{listeners_count:>10} {once / number * 1e6:>16.1f} {per_listener / number * 1e6:>17.1f} '
+            f'{subscribed / number * 1e6:>18.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
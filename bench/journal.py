@@ -0,0 +1,47 @@
+"""
+Measures restoring of sources store from a journal
+with millions of frames of 10k sources.
+"""
+import os
+import tempfile
+import time
+
+import journal
+import store
+from bench.parser import gen_frame
+
+FRAMES_COUNTS = (100000, 1000000, 3000000)
+SOURCES_COUNT = 10000
+BATCH_SIZE = 100
+
+
+def _measure(frames_count: int):
+    template = gen_frame(5)
+    frames = [template[:3] + b'%08d' % source_no + template[11:] for source_no in range(SOURCES_COUNT)]
+    with tempfile.TemporaryDirectory() as path:
+        sources_journal = journal.Journal(path)
+        sources_journal.start()
+        started = time.perf_counter()
+        for i in range(0, frames_count, BATCH_SIZE):
+            batch = [frames[(i + j) % SOURCES_COUNT] for j in range(BATCH_SIZE)]
+            sources_journal.append(batch, time.time_ns())
+        sources_journal.close()
+        append_time = time.perf_counter() - started
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        started = time.perf_counter()
+        restored = journal.restore_sources(path, store._SourcesStore())
+        restore_time = time.perf_counter() - started
+    assert restored == SOURCES_COUNT
+    return size, append_time, restore_time
+
+
+def main():
+    print(f'{"frames":>8} {"size, MiB":>10} {"append, s":>10} {"restore, s":>11}')
+    for frames_count in FRAMES_COUNTS:
+        size, append_time, restore_time = _measure(frames_count)
+        print(f'{frames_count:>8} {size / 2 ** 20:>10.1f} {append_time:>10.2f} {restore_time:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
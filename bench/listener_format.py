@@ -0,0 +1,60 @@
+"""
+Compares text and binary listener formats by bytes on the wire
+and dispatcher CPU per source message.
+"""
+import time
+import timeit
+
+import app
+import fanout
+import listener_protocol
+import source_protocol
+import store
+import subscriptions
+from bench.fanout import NullStream
+from bench.parser import gen_frame
+
+RECORDS_COUNTS = (1, 10, 50)
+LISTENERS_COUNTS = (1, 100)
+
+
+def _setup(listeners_count: int, binary: bool) -> app.Dispatcher:
+    store.ListenersStore = store._ListenersStore()
+    store.init_sources_store('dict')
+    disp = app.Dispatcher(listener_queue_size=1)
+    for _ in range(listeners_count):
+        id_ = store.ListenersStore.add_listener()
+        disp._subscriptions.add(id_, subscriptions.ALL._replace(binary=binary))
+        stream = NullStream()
+        disp._listeners_connects.add(id_, stream, fanout.ListenerQueue(
+            stream, maxsize=1, overflow_policy=fanout.DROP_OLDEST,
+        ))
+    return disp
+
+
+def main():
+    print(f'{"records":>8} {"format":>7} {"bytes/msg":>10}', *(
+        f'{f"cpu/msg {listeners_count} l., us":>20}' for listeners_count in LISTENERS_COUNTS
+    ))
+    for records_count in RECORDS_COUNTS:
+        frame = gen_frame(records_count)
+        parsed = source_protocol.parse_source_frame(frame)
+        sizes = {
+            listener_protocol.TEXT: len(app._gen_listener_msg(parsed.source_id, parsed.msgs)),
+            listener_protocol.BINARY: len(frame),
+        }
+        for format_, size in sizes.items():
+            cpus = []
+            for listeners_count in LISTENERS_COUNTS:
+                disp = _setup(listeners_count, binary=format_ == listener_protocol.BINARY)
+                number = 200000 // (listeners_count + 50)
+                # the first message notifies listeners about the source
+                disp._on_source_msg(frame)
+                started = time.process_time()
+                timeit.timeit(lambda: disp._on_source_msg(frame), number=number)
+                cpus.append((time.process_time() - started) / number)
+            print(f'{records_count:>8} {format_:>7} {size:>10}', *(f'{cpu * 1e6:>20.1f}' for cpu in cpus))
+
+
+if __name__ == '__main__':
+    main()
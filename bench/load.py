@@ -0,0 +1,286 @@
+"""
+Load generator for the dispatcher.
+Simulates asyncio sources and listeners on loopback and reports throughput,
+latency of answers to sources and latency of delivery to listeners.
+
+The dispatcher is started in-process (on the same event loop as clients)
+or as app.py subprocess. Run `python -m bench --help` for options.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import source_protocol
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+TIMESTAMP_FIELD = b'bench_ts'
+
+
+class Stats:
+    """ Counters and latencies (ns) collected by clients """
+
+    def __init__(self):
+        self.recording = False
+        self.sent = 0
+        self.acked = 0
+        self.rejected = 0
+        self.delivered = 0
+        self.ack_latencies: List[int] = []
+        self.delivery_latencies: List[int] = []
+
+
+def percentile(sorted_values: List[int], share: float) -> float:
+    """
+    >>> percentile([1, 2, 3, 4], 0.5)
+    3
+    >>> percentile([], 0.5)
+    0
+    """
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
+
+
+def _record(name: bytes, value: int) -> bytes:
+    record = name + value.to_bytes(4, byteorder=source_protocol.BYTE_ORDER)
+    return record + source_protocol.xor(record)
+
+
+def _now_us() -> int:
+    return time.perf_counter_ns() // 1000
+
+
+async def _source(source_no: int, args, stats: Stats):
+    reader, writer = await asyncio.open_connection(args.host, args.sources_port)
+    meta = bytes([0x01]), b'src%05d' % source_no + bytes([0x02, args.records])
+    # the first record carries time of sending, so listeners can measure delivery latency
+    static_records = b''.join(_record(b'field%03d' % i, i) for i in range(1, args.records))
+    sent = {}
+
+    async def read_answers():
+        while True:
+            answer = await reader.readexactly(4)
+            received = time.perf_counter_ns()
+            if not stats.recording:
+                continue
+            if answer[0] != 0x11:
+                stats.rejected += 1
+                continue
+            sent_at = sent.pop(answer[1:3], None)
+            stats.acked += 1
+            if sent_at is not None:
+                stats.ack_latencies.append(received - sent_at)
+
+    answers_reader = asyncio.ensure_future(read_answers())
+    interval = 1.0 / args.rate
+    next_at = time.monotonic()
+    serial_num = 0
+    try:
+        while True:
+            serial_num = (serial_num + 1) & 0xffff
+            b_serial_num = serial_num.to_bytes(2, byteorder=source_protocol.BYTE_ORDER)
+            records = _record(TIMESTAMP_FIELD, _now_us() & 0xffffffff) + static_records
+            sent[b_serial_num] = time.perf_counter_ns()
+            writer.write(meta[0] + b_serial_num + meta[1] + records)
+            if stats.recording:
+                stats.sent += 1
+            await writer.drain()
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    finally:
+        answers_reader.cancel()
+        writer.close()
+
+
+async def _listener(args, stats: Stats):
+    reader, writer = await asyncio.open_connection(args.host, args.listeners_port)
+    marker = b'] ' + TIMESTAMP_FIELD + b' | '
+    tail = b''
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            received = _now_us()
+            lines = (tail + data).split(b'\r\n')
+            tail = lines.pop()
+            if stats.recording:
+                for line in lines:
+                    if marker in line:
+                        sent_at = int(line.rsplit(b'| ', 1)[1])
+                        stats.delivered += 1
+                        stats.delivery_latencies.append(((received - sent_at) & 0xffffffff) * 1000)
+            if args.listener_delay:
+                await asyncio.sleep(args.listener_delay)
+    finally:
+        writer.close()
+
+
+@contextlib.contextmanager
+def run_app_process(conf: dict):
+    """ Runs app.py with given config in a subprocess """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'config.json'), 'w') as fh:
+            json.dump(conf, fh)
+        app = subprocess.Popen([sys.executable, APP_PATH], cwd=tmp_dir, start_new_session=True)
+        try:
+            time.sleep(1.0 + 0.2 * conf.get('workers', 1))
+            yield app
+        finally:
+            # stop the parent first, otherwise it restarts killed workers
+            app.terminate()
+            app.wait()
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(app.pid, signal.SIGTERM)
+
+
+def process_group_cpu(pgid: int) -> Optional[float]:
+    """ :return: user and system CPU seconds of all processes of the group or None if unknown """
+    total = 0
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except FileNotFoundError:
+        return None
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as fh:
+                # the name of a process may contain spaces, fields after it are fixed
+                fields = fh.read().rsplit(')', 1)[1].split()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        if int(fields[2]) == pgid:
+            total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def _start_in_process(args):
+    import app
+    import store
+
+    store.init_sources_store(args.sources_store)
+    disp = app.Dispatcher(transport=args.transport)
+    disp.listen(sources_port=args.sources_port, listeners_port=args.listeners_port)
+    return disp
+
+
+async def _run(args, app_pid: int = None) -> dict:
+    """ :param app_pid: pid of subprocess app to measure its CPU """
+    if args.mode == 'inprocess':
+        _start_in_process(args)
+    stats = Stats()
+    listeners = [asyncio.ensure_future(_listener(args, stats)) for _ in range(args.listeners)]
+    await asyncio.sleep(0.1)
+    sources = [asyncio.ensure_future(_source(i, args, stats)) for i in range(args.sources)]
+    await asyncio.sleep(args.warmup)
+    stats.recording = True
+    started = time.monotonic()
+    cpu_started = None if app_pid is None else process_group_cpu(app_pid)
+    await asyncio.sleep(args.duration)
+    stats.recording = False
+    duration = time.monotonic() - started
+    app_cpu = None
+    if cpu_started is not None:
+        app_cpu = process_group_cpu(app_pid) - cpu_started
+    for task in sources + listeners:
+        task.cancel()
+    await asyncio.gather(*sources, *listeners, return_exceptions=True)
+    return _report(args, stats, duration, app_cpu)
+
+
+def _report(args, stats: Stats, duration: float, app_cpu: float = None) -> dict:
+    ack_latencies = sorted(stats.ack_latencies)
+    delivery_latencies = sorted(stats.delivery_latencies)
+    return dict(
+        config=dict(
+            mode=args.mode,
+            sources=args.sources,
+            listeners=args.listeners,
+            rate=args.rate,
+            records=args.records,
+            listener_delay=args.listener_delay,
+            duration=args.duration,
+        ),
+        sent=stats.sent,
+        acked=stats.acked,
+        rejected=stats.rejected,
+        delivered=stats.delivered,
+        msgs_per_s=stats.acked / duration,
+        delivered_per_s=stats.delivered / duration,
+        ack_latency_ms={
+            name: percentile(ack_latencies, share) / 1e6
+            for name, share in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+        },
+        delivery_latency_ms={
+            name: percentile(delivery_latencies, share) / 1e6
+            for name, share in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+        },
+        app_cpu_us_per_msg=None if app_cpu is None or not stats.acked else app_cpu / stats.acked * 1e6,
+    )
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('inprocess', 'subprocess'), default='subprocess')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--sources-port', type=int, default=18888)
+    parser.add_argument('--listeners-port', type=int, default=18889)
+    parser.add_argument('--sources', type=int, default=100, help='number of sources')
+    parser.add_argument('--listeners', type=int, default=10, help='number of listeners')
+    parser.add_argument('--rate', type=float, default=10.0, help='messages per second of every source')
+    parser.add_argument('--records', type=int, default=5, help='records per message, 1..255')
+    parser.add_argument('--listener-delay', type=float, default=0.0,
+                        help='seconds a listener sleeps after every read')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of subprocess app')
+    parser.add_argument('--sources-store', default='dict')
+    parser.add_argument('--transport', choices=('tornado', 'asyncio'), default='tornado',
+                        help='how the app serves connects')
+    parser.add_argument('--uvloop', action='store_true', help='run the app on uvloop')
+    parser.add_argument('--app-config', type=json.loads, default={},
+                        help='json with extra config of subprocess app')
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--json', action='store_true', help='print machine-readable report')
+    args = parser.parse_args(argv)
+    if not 1 <= args.records <= 255:
+        parser.error('--records has to be in 1..255')
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.mode == 'subprocess':
+        conf = dict(
+            sources_port=args.sources_port,
+            listeners_port=args.listeners_port,
+            debug=False,
+            workers=args.workers,
+            sources_store=args.sources_store,
+            transport=args.transport,
+            uvloop=args.uvloop,
+            **args.app_config,
+        )
+        with run_app_process(conf) as app:
+            report = asyncio.run(_run(args, app.pid))
+    else:
+        if args.uvloop:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        report = asyncio.run(_run(args))
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f'sent {report["sent"]}, acked {report["acked"]}, rejected {report["rejected"]}, '
+          f'delivered {report["delivered"]}')
+    print(f'throughput: {report["msgs_per_s"]:.0f} msgs/s, {report["delivered_per_s"]:.0f} deliveries/s')
+    for name in ('ack_latency_ms', 'delivery_latency_ms'):
+        print(f'{name}: ' + ', '.join(f'{k} {v:.3f}' for k, v in report[name].items()))
+    if report['app_cpu_us_per_msg'] is not None:
+        print(f'app cpu per message: {report["app_cpu_us_per_msg"]:.1f} us')
@@ -0,0 +1,74 @@
+"""
+Compares parse_source_frame with the previous implementation of
+parse_source_bytes on frames of 0, 1, 50 and 255 records.
+"""
+import timeit
+
+import source_protocol
+
+RECORDS_COUNTS = (0, 1, 50, 255)
+
+
+def gen_frame(records_count: int) -> bytes:
+    records = b''.join(
+        _with_xor(b'field%03d' % i + (i * 1000).to_bytes(4, byteorder=source_protocol.BYTE_ORDER))
+        for i in range(records_count)
+    )
+    return bytes([0x01, 0x00, 0x01, *b'benchsrc', 0x02, records_count]) + records
+
+
+def _with_xor(bytes_obj: bytes) -> bytes:
+    return bytes_obj + source_protocol.xor(bytes_obj)
+
+
+def legacy_parse_source_bytes(bytes_obj: bytes) -> dict:
+    """ parse_source_bytes as it was before the single-pass parser """
+    if len(bytes_obj) < 13 or bytes_obj[0] != 0x01:
+        return {}
+    num = int.from_bytes(bytes_obj[1:3], byteorder=source_protocol.BYTE_ORDER, signed=False)
+    source_id = str(bytes_obj[3:11], encoding='ascii')
+    source_state = source_protocol.state_translate.get(bytes_obj[11])
+    if source_state is None:
+        return {}
+    num_of_msgs = int.from_bytes(bytes([bytes_obj[12]]), byteorder=source_protocol.BYTE_ORDER, signed=False)
+    byte_msgs = bytes_obj[13:]
+    if len(byte_msgs) != num_of_msgs*13:
+        return {}
+    msgs = [msg for msg in _legacy_iter_source_msgs(byte_msgs)]
+    if any(it is None for it in msgs):
+        return {}
+    return dict(
+        header=0x01,
+        num=num,
+        source_id=source_id,
+        source_state=source_state,
+        msgs=[msg for msg in _legacy_iter_source_msgs(byte_msgs)],
+    )
+
+
+def _legacy_iter_source_msgs(byte_msgs: bytes):
+    cur_pos = 0
+    while cur_pos+8 < len(byte_msgs):
+        name = byte_msgs[cur_pos:cur_pos+8]
+        value = int.from_bytes(byte_msgs[cur_pos+8:cur_pos+12], byteorder=source_protocol.BYTE_ORDER)
+        xor_byte = source_protocol.xor(byte_msgs[cur_pos:cur_pos+12])
+        if xor_byte != bytes([byte_msgs[cur_pos+12]]):
+            yield None
+        else:
+            yield (name, value)
+        cur_pos += 13
+
+
+def main():
+    print(f'{"records":>8} {"legacy, us":>11} {"single-pass, us":>16} {"speedup":>8}')
+    for records_count in RECORDS_COUNTS:
+        frame = gen_frame(records_count)
+        assert legacy_parse_source_bytes(frame) == source_protocol.parse_source_bytes(frame)
+        number = max(100, 100000 // (records_count + 1))
+        legacy = timeit.timeit(lambda: legacy_parse_source_bytes(frame), number=number) / number
+        new = timeit.timeit(lambda: source_protocol.parse_source_frame(frame), number=number) / number
+        print(f'{records_count:>8} {legacy * 1e6:>11.2f} {new * 1e6:>16.2f} {legacy / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares memory and update cost of sources store backends
+at 10k, 100k and 1M sources.
+"""
+import gc
+import time
+import tracemalloc
+
+import store
+
+SOURCES_COUNTS = (10000, 100000, 1000000)
+STATES = ('IDLE', 'ACTIVE', 'RECHARGE')
+
+
+def _measure(backend: str, sources_count: int):
+    ids = ['%08d' % i for i in range(sources_count)]
+    gc.collect()
+    tracemalloc.start()
+    sources_store = store.sources_backends[backend]()
+    for i, id_ in enumerate(ids):
+        sources_store.update_state(id_, 0, STATES[i % 3], time.monotonic_ns())
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    for i, id_ in enumerate(ids):
+        sources_store.update_state(id_, i & 0xffff, STATES[i % 3], time.monotonic_ns())
+    update = (time.perf_counter() - started) / sources_count
+
+    # a snapshot for a new listener reads the store lazily
+    started = time.perf_counter()
+    snapshot_count = sum(1 for _ in sources_store.iter_sources(sources_store.last_seq))
+    snapshot_time = time.perf_counter() - started
+    assert snapshot_count == sources_count
+    return memory, update, snapshot_time
+
+
+def main():
+    print(f'{"sources":>8} {"backend":>7} {"memory, MiB":>12} {"update, ns":>11} {"snapshot, ms":>13}')
+    for sources_count in SOURCES_COUNTS:
+        for backend in store.sources_backends:
+            memory, update, snapshot_time = _measure(backend, sources_count)
+            print(
+                f'{sources_count:>8} {backend:>7} {memory / 2 ** 20:>12.1f} '
+                f'{update * 1e9:>11.0f} {snapshot_time * 1e3:>13.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
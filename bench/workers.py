@@ -0,0 +1,86 @@
+"""
+Measures throughput of source messages with different numbers of worker processes.
+Starts app.py as a subprocess for every number of workers and floods it
+from several client processes, one listener drains messages meanwhile.
+"""
+import multiprocessing
+import socket
+import sys
+import time
+
+from bench.load import run_app_process
+from bench.parser import gen_frame
+
+SOURCES_PORT = 18888
+LISTENERS_PORT = 18889
+CLIENTS_COUNT = 8
+DURATION = 5.0
+WINDOW = 64
+
+
+def _source_client(client_id: int, duration: float, results):
+    frame = bytearray(gen_frame(5))
+    frame[3:11] = b'bench%03d' % client_id
+    burst = bytes(frame) * WINDOW
+    sock = socket.create_connection(('localhost', SOURCES_PORT))
+    acked = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        sock.sendall(burst)
+        expected = WINDOW * 4
+        while expected:
+            expected -= len(sock.recv(expected))
+        acked += WINDOW
+    sock.close()
+    results.put(acked)
+
+
+def _listener_client(stop):
+    sock = socket.create_connection(('localhost', LISTENERS_PORT))
+    sock.settimeout(0.5)
+    while not stop.is_set():
+        try:
+            sock.recv(1 << 16)
+        except socket.timeout:
+            pass
+    sock.close()
+
+
+def run(workers_count: int) -> float:
+    conf = dict(
+        sources_port=SOURCES_PORT,
+        listeners_port=LISTENERS_PORT,
+        debug=False,
+        workers=workers_count,
+    )
+    with run_app_process(conf):
+        stop = multiprocessing.Event()
+        listener = multiprocessing.Process(target=_listener_client, args=(stop,))
+        listener.start()
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(target=_source_client, args=(i, DURATION, results))
+            for i in range(CLIENTS_COUNT)
+        ]
+        for client in clients:
+            client.start()
+        acked = sum(results.get() for _ in clients)
+        for client in clients:
+            client.join()
+        stop.set()
+        listener.join()
+    return acked / DURATION
+
+
+def main():
+    workers_counts = [int(it) for it in sys.argv[1:]] or [1, 2, 4]
+    print(f'{"workers":>8} {"msgs/s":>10} {"scaling":>8}')
+    base = None
+    for workers_count in workers_counts:
+        throughput = run(workers_count)
+        base = base or throughput
+        print(f'{workers_count:>8} {throughput:>10.0f} {throughput / base:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
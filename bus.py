@@ -0,0 +1,146 @@
+"""
+This module exchanges source messages between worker processes.
+"""
+import logging
+import os
+import socket
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamBufferFullError, StreamClosedError, IOStream
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+import metrics
+import source_protocol
+
+CONNECT_ATTEMPTS = 50
+CONNECT_RETRY_DELAY = 0.1
+# frames not written to a peer yet, more of them are dropped for the peer
+MAX_WRITE_BUFFER_SIZE = 16 * 2 ** 20
+
+
+class Bus:
+    """
+    Connects worker processes with each other by unix sockets.
+
+    Every worker publishes validated source frames to all other workers
+    and receives theirs with on_msgs, so every listener sees every source
+    no matter which worker it is connected to.
+
+    A peer, which is gone, is connected again until it's back,
+    as a crashed worker is restarted on the same socket path.
+    Frames aren't awaited to be written, and ones over max_write_buffer_size
+    not written to a stalled peer yet are dropped for it.
+    """
+
+    def __init__(self,
+                 path: str,
+                 worker_id: int,
+                 workers_count: int,
+                 on_msgs: Callable[[Sequence[bytes]], Any],
+                 max_write_buffer_size: int = MAX_WRITE_BUFFER_SIZE):
+        self._path = path
+        self._worker_id = worker_id
+        self._workers_count = workers_count
+        self._server = _BusServer(on_msgs)
+        self._max_write_buffer_size = max_write_buffer_size
+        # None while a peer is being connected
+        self._peers: Dict[int, Optional[IOStream]] = {}
+        self._stopped = False
+        self.dropped_bytes = 0
+        metrics.REGISTRY.gauge(
+            'dispatcher_bus_dropped_bytes_total', 'Bytes of frames not published to stalled workers',
+            lambda: self.dropped_bytes, type_='counter',
+        )
+
+    async def start(self):
+        self._server.add_socket(bind_unix_socket(self._socket_path(self._worker_id)))
+        await gen.multi([
+            self._connect(peer_id, CONNECT_ATTEMPTS)
+            for peer_id in range(self._workers_count)
+            if peer_id != self._worker_id
+        ])
+        logging.info(f'worker {self._worker_id} connected to bus')
+
+    def stop(self):
+        self._stopped = True
+        self._server.stop()
+        for peer in self._peers.values():
+            if peer is not None:
+                peer.close()
+
+    def publish(self, frames: bytes):
+        """ Sends already validated frames to all other workers """
+        for peer in self._peers.values():
+            if peer is not None and not peer.closed():
+                try:
+                    peer.write(frames)
+                except StreamBufferFullError:
+                    self.dropped_bytes += len(frames)
+
+    def _socket_path(self, worker_id: int) -> str:
+        return os.path.join(self._path, f'worker-{worker_id}.sock')
+
+    async def _connect(self, peer_id: int, attempts: int = None):
+        """
+        :param attempts: how many times to try, forever if None
+        :raise ConnectionError: if the peer isn't available after all attempts
+        """
+        self._peers[peer_id] = None
+        attempt = 0
+        # peers start simultaneously, so their sockets may be not bound yet
+        while not self._stopped:
+            stream = IOStream(
+                socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                max_write_buffer_size=self._max_write_buffer_size,
+            )
+            try:
+                await stream.connect(self._socket_path(peer_id))
+            except StreamClosedError:
+                attempt += 1
+                if attempts is not None and attempt >= attempts:
+                    raise ConnectionError(f'worker {peer_id} is not available on bus')
+                await gen.sleep(CONNECT_RETRY_DELAY)
+                continue
+            self._peers[peer_id] = stream
+            stream.set_close_callback(lambda: self._on_peer_close(peer_id, stream))
+            return
+
+    def _on_peer_close(self, peer_id: int, stream: IOStream):
+        if self._stopped or self._peers.get(peer_id) is not stream:
+            return
+        logging.warning(f'worker {peer_id} left bus, reconnecting')
+        IOLoop.current().spawn_callback(self._connect, peer_id)
+
+
+class _BusServer(TCPServer):
+    """
+    Receives frames published by other workers.
+    """
+
+    def __init__(self, on_msgs: Callable[[Sequence[bytes]], Any], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_msgs = on_msgs
+        self._streams = set()
+
+    def stop(self):
+        super().stop()
+        for stream in self._streams:
+            stream.close()
+
+    async def handle_stream(self, stream: IOStream, address: str):
+        buffer = bytearray()
+        self._streams.add(stream)
+        try:
+            while True:
+                buffer += await stream.read_bytes(65536, partial=True)
+                msgs, consumed = source_protocol.split_frames(buffer)
+                del buffer[:consumed]
+                if msgs:
+                    self._on_msgs(msgs)
+        except StreamClosedError:
+            logging.info('worker disconnected from bus')
+        finally:
+            self._streams.discard(stream)
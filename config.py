@@ -1,13 +1,219 @@
-import copy
+"""
+This module loads the config of the app.
+
+The config is read once and kept as an immutable Config, so reading it costs
+nothing. Every option can be overridden by an environment variable
+DISPATCHER_<OPTION IN UPPER CASE>, the value of which is parsed as JSON,
+e.g. DISPATCHER_WORKERS=4 or DISPATCHER_BINARY_LISTENERS_PORT=8890.
+The path of the config file itself is taken from DISPATCHER_CONFIG if it's set.
+"""
 import json
+import os
+import typing
+from typing import List, Mapping, NamedTuple, Optional
 
-_config = None
+ENV_PREFIX = 'DISPATCHER_'
+PATH_ENV = 'DISPATCHER_CONFIG'
 default_config_path = './config.json'
 
 
-def get_config(path=default_config_path):
-    global _config
+class Config(NamedTuple):
+    sources_port: int = 8888
+    listeners_port: int = 8889
+    binary_listeners_port: Optional[int] = None
+    debug: bool = False
+    workers: int = 1
+    transport: str = 'tornado'
+    uvloop: bool = False
+    metrics_port: Optional[int] = None
+    sources_store: str = 'dict'
+    source_read_buffer_size: int = 65536
+    source_ack_await_write: bool = True
+    listener_queue_size: int = 1024
+    listener_overflow_policy: str = 'drop_oldest'
+    listener_flush_delay_us: int = 0
+    listener_flush_bytes: int = 65536
+    listener_handshake_timeout_ms: int = 0
+    snapshot_chunk_size: int = 1000
+    replay_buffer_bytes: int = 0
+    tracing: bool = False
+    trace_sample_every: int = 0
+    trace_dump_path: str = 'trace.jsonl'
+    profile_path: str = 'dispatcher.prof'
+    journal_path: Optional[str] = None
+    journal_segment_size: int = 64 * 2 ** 20
+    journal_buffer_size: int = 2 ** 20
+    journal_flush_interval_ms: int = 1000
+    source_ttl_s: Optional[float] = None
+    max_sources: Optional[int] = None
+    source_evict_on_close: bool = False
+    eviction_interval_ms: int = 1000
+    eviction_batch_size: int = 1000
+    parse_offload_min_size: Optional[int] = None
+    parse_offload_executor: str = 'process'
+    parse_offload_workers: int = 2
+    source_msgs_per_s: Optional[float] = None
+    source_records_per_s: Optional[float] = None
+    connection_msgs_per_s: Optional[float] = None
+    connection_records_per_s: Optional[float] = None
+    rate_limit_burst_s: float = 1.0
+    max_inflight_bytes: Optional[int] = None
+    throttle_policy: str = 'reject'
+
+
+# options applied to a running app on SIGHUP, others need a restart
+RELOADABLE = frozenset({
+    'debug',
+    'listener_queue_size',
+    'listener_overflow_policy',
+    'listener_flush_delay_us',
+    'listener_flush_bytes',
+    'snapshot_chunk_size',
+})
+
+# values allowed besides types, the modules using them check them too,
+# but they aren't imported here, so the config can be loaded before the app
+CHOICES = {
+    'transport': ('tornado', 'asyncio'),
+    'sources_store': ('dict', 'array'),
+    'listener_overflow_policy': ('drop_oldest', 'drop_newest', 'disconnect'),
+    'parse_offload_executor': ('process', 'thread'),
+    'throttle_policy': ('reject', 'pause'),
+}
+# options, which can't be negative or zero if they are set
+POSITIVE = frozenset({
+    'workers',
+    'source_read_buffer_size',
+    'listener_queue_size',
+    'listener_flush_bytes',
+    'snapshot_chunk_size',
+    'journal_segment_size',
+    'journal_buffer_size',
+    'journal_flush_interval_ms',
+    'source_ttl_s',
+    'max_sources',
+    'eviction_interval_ms',
+    'eviction_batch_size',
+    'parse_offload_min_size',
+    'parse_offload_workers',
+    'source_msgs_per_s',
+    'source_records_per_s',
+    'connection_msgs_per_s',
+    'connection_records_per_s',
+    'rate_limit_burst_s',
+    'max_inflight_bytes',
+})
+# options, which can't be negative
+NOT_NEGATIVE = frozenset({
+    'listener_flush_delay_us',
+    'listener_handshake_timeout_ms',
+    'replay_buffer_bytes',
+    'trace_sample_every',
+})
+
+_types = typing.get_type_hints(Config)
+_config: Optional[Config] = None
+_config_path: Optional[str] = None
+
+
+def get_config(path: str = None) -> Config:
+    """ Loads the config on the first call, later calls return the same one """
+    global _config, _config_path
     if _config is None:
-        with open(path, 'r') as fh:
-            _config = json.load(fh)
-    return copy.deepcopy(_config)
+        _config_path = path or os.environ.get(PATH_ENV, default_config_path)
+        _config = load(_config_path)
+    return _config
+
+
+def reload() -> Config:
+    """
+    Loads the config again from where it was loaded first.
+    It doesn't become current until it's applied to the app and passed to set_config.
+    """
+    return load(_config_path or os.environ.get(PATH_ENV, default_config_path))
+
+
+def set_config(new: Config) -> Config:
+    """ Makes reloadable options of new config current, others keep values the app runs with """
+    global _config
+    _config = merge(get_config(), new)
+    return _config
+
+
+def merge(old: Config, new: Config) -> Config:
+    """
+    :return: old config with reloadable options of new one
+    >>> merge(Config(), Config(debug=True, workers=4))[3:5]
+    (True, 1)
+    """
+    return old._replace(**{name: getattr(new, name) for name in RELOADABLE})
+
+
+def load(path: str, environ: Mapping[str, str] = None) -> Config:
+    """
+    Reads the config file and applies overrides from environ (os.environ by default).
+    :raise ValueError: if there are unknown options or options of wrong types or values
+    """
+    if environ is None:
+        environ = os.environ
+    with open(path, 'r') as fh:
+        options = json.load(fh)
+    unknown = sorted(set(options) - set(Config._fields))
+    if unknown:
+        raise ValueError(f'unknown options {unknown} in {path}')
+    for name in Config._fields:
+        value = environ.get(ENV_PREFIX + name.upper())
+        if value is not None:
+            options[name] = _parse_env_value(value)
+    return Config(**{name: _check(name, value) for name, value in options.items()})
+
+
+def changed(old: Config, new: Config) -> List[str]:
+    """
+    >>> changed(Config(), Config(debug=True, workers=1))
+    ['debug']
+    """
+    return [name for name in Config._fields if getattr(old, name) != getattr(new, name)]
+
+
+def _parse_env_value(value: str):
+    """
+    >>> _parse_env_value('4'), _parse_env_value('null'), _parse_env_value('array')
+    (4, None, 'array')
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        # plain strings are allowed without quotes
+        return value
+
+
+def _check(name: str, value):
+    """
+    >>> _check('source_ttl_s', 5)
+    5.0
+    >>> _check('workers', '4')
+    Traceback (most recent call last):
+    ...
+    ValueError: workers has to be int, not '4'
+    >>> _check('listener_queue_size', 0)
+    Traceback (most recent call last):
+    ...
+    ValueError: listener_queue_size has to be positive, not 0
+    >>> _check('throttle_policy', 'drop')
+    Traceback (most recent call last):
+    ...
+    ValueError: throttle_policy has to be one of reject, pause, not 'drop'
+    """
+    allowed = typing.get_args(_types[name]) or (_types[name],)
+    if float in allowed and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    # bool is int too, but not the other way around
+    if not isinstance(value, allowed) or (isinstance(value, bool) and bool not in allowed):
+        expected = ' or '.join('null' if type_ is type(None) else type_.__name__ for type_ in allowed)
+        raise ValueError(f'{name} has to be {expected}, not {value!r}')
+    if name in CHOICES and value not in CHOICES[name]:
+        raise ValueError(f'{name} has to be one of {", ".join(CHOICES[name])}, not {value!r}')
+    if value is not None and (name in POSITIVE and value <= 0 or name in NOT_NEGATIVE and value < 0):
+        raise ValueError(f'{name} has to be {"positive" if name in POSITIVE else "not negative"}, not {value!r}')
+    return value
@@ -0,0 +1,97 @@
+"""
+This module forgets sources, which are not needed anymore.
+"""
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+import metrics
+import store
+
+if TYPE_CHECKING:
+    import journal
+
+TTL = 'ttl'
+MAX_SOURCES = 'max_sources'
+CLOSE = 'close'
+
+
+class Evictor:
+    """
+    Evicts sources idle for longer than ttl_s and the least recently
+    updated sources over max_sources, also sources of closed connections
+    if evict_on_close is set.
+
+    Stores keep sources in order of their updates, so a sweep looks only
+    at the sources to evict and stops at the first one to keep.
+    A sweep evicts at most batch_size sources at once and continues
+    on the next iteration of the IOLoop, so the loop is never blocked for long.
+    Evicted sources are recorded by the journal, so they aren't restored on restart.
+    """
+
+    def __init__(self,
+                 ttl_s: Optional[float] = None,
+                 max_sources: Optional[int] = None,
+                 evict_on_close: bool = False,
+                 interval_ms: int = 1000,
+                 batch_size: int = 1000,
+                 sources_journal: 'journal.Journal' = None):
+        self._ttl_ns = None if ttl_s is None else int(ttl_s * 1e9)
+        self._max_sources = max_sources
+        self.evict_on_close = evict_on_close
+        self._batch_size = batch_size
+        self._sources_journal = sources_journal
+        self._sweeper = PeriodicCallback(self.sweep, interval_ms)
+        self.evicted: Dict[str, int] = {TTL: 0, MAX_SOURCES: 0, CLOSE: 0}
+        metrics.REGISTRY.gauge(
+            'dispatcher_sources_evicted_total', 'Sources evicted from the store',
+            lambda: self.evicted, label='reason', type_='counter',
+        )
+
+    def start(self):
+        if self._ttl_ns is not None or self._max_sources is not None:
+            self._sweeper.start()
+
+    def stop(self):
+        self._sweeper.stop()
+
+    def sweep(self) -> int:
+        """
+        Evicts a batch of sources and schedules the next batch if there are more to evict.
+        :return: count of evicted sources
+        """
+        sources_store = store.SourcesStore
+        evicted = []
+        over_max = 0 if self._max_sources is None else max(0, len(sources_store) - self._max_sources)
+        deadline = None if self._ttl_ns is None else time.monotonic_ns() - self._ttl_ns
+        for source_id, last_received in sources_store.get_oldest(self._batch_size):
+            if over_max > 0:
+                over_max -= 1
+                reason = MAX_SOURCES
+            elif deadline is not None and last_received < deadline:
+                reason = TTL
+            else:
+                break
+            sources_store.remove_source(source_id)
+            self.evicted[reason] += 1
+            evicted.append(source_id)
+        if evicted:
+            self._journal_removed(evicted)
+            logging.info('%d sources evicted, %d left', len(evicted), len(sources_store))
+        if len(evicted) == self._batch_size:
+            IOLoop.current().add_callback(self.sweep)
+        return len(evicted)
+
+    def on_source_close(self, source_ids: Iterable[str]):
+        if not self.evict_on_close:
+            return
+        evicted = [source_id for source_id in source_ids if store.SourcesStore.remove_source(source_id)]
+        self.evicted[CLOSE] += len(evicted)
+        if evicted:
+            self._journal_removed(evicted)
+
+    def _journal_removed(self, source_ids: List[str]):
+        if self._sources_journal is not None:
+            self._sources_journal.remove(source_ids, time.time_ns())
@@ -0,0 +1,195 @@
+"""
+This module delivers messages to listeners.
+"""
+import collections
+import logging
+
+from tornado.iostream import StreamClosedError, IOStream
+from tornado.ioloop import IOLoop
+from tornado.locks import Event
+from tornado.util import TimeoutError
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+overflow_policies = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+
+class FlushStats:
+    """
+    Accumulates statistics of coalesced writes of a listener queue.
+    >>> stats = FlushStats()
+    >>> stats.add(items=3, bytes_=30, latency=0.002)
+    >>> stats.add(items=1, bytes_=10, latency=0.001)
+    >>> stats.as_dict()
+    {'flushes': 2, 'items': 4, 'bytes': 40, 'max_items': 3, 'avg_latency': 0.0015, 'max_latency': 0.002}
+    """
+
+    def __init__(self):
+        self.flushes = 0
+        self.items = 0
+        self.bytes = 0
+        self.max_items = 0
+        self.latency_sum = 0.0
+        self.max_latency = 0.0
+
+    def add(self, items: int, bytes_: int, latency: float):
+        self.flushes += 1
+        self.items += items
+        self.bytes += bytes_
+        self.max_items = max(self.max_items, items)
+        self.latency_sum += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return dict(
+            flushes=self.flushes,
+            items=self.items,
+            bytes=self.bytes,
+            max_items=self.max_items,
+            avg_latency=self.latency_sum / self.flushes if self.flushes else 0.0,
+            max_latency=self.max_latency,
+        )
+
+
+class InflightBytes:
+    """ Bytes put to listener queues and not written yet, shared by all queues """
+
+    def __init__(self):
+        self.value = 0
+
+
+class ListenerQueue:
+    """
+    Bounded outbound queue of a single listener.
+
+    Messages are put without waiting and written to the stream by a separate
+    task, so a slow listener doesn't stall sources and other listeners.
+    When the queue is full the overflow policy decides what happens:
+    drop the oldest queued message, drop the new one or disconnect the listener.
+
+    Queued bytes and bytes being written are counted in inflight.
+
+    If flush_delay_us is set, queued messages are gathered and written at once
+    when flush_bytes are queued or flush_delay_us passed since the first of them
+    was queued, whichever happens first.
+    """
+
+    def __init__(self,
+                 stream: IOStream,
+                 maxsize: int,
+                 overflow_policy: str = DROP_OLDEST,
+                 flush_delay_us: int = 0,
+                 flush_bytes: int = 65536,
+                 inflight: InflightBytes = None):
+        self.stream = stream
+        self.configure(maxsize, overflow_policy, flush_delay_us, flush_bytes)
+        self._items = collections.deque()
+        self._bytes = 0
+        self._inflight = InflightBytes() if inflight is None else inflight
+        self._first_put_time = 0.0
+        self._has_items = Event()
+        self._flush_now = Event()
+        self._closed = False
+        self.dropped = 0
+        self.bytes_written = 0
+        self.flush_stats = FlushStats()
+
+    def __len__(self):
+        return len(self._items)
+
+    def configure(self, maxsize: int, overflow_policy: str, flush_delay_us: int, flush_bytes: int):
+        """ Changes limits of the queue, messages already queued over a new maxsize are kept """
+        if overflow_policy not in overflow_policies:
+            raise ValueError(f'unknown overflow policy {overflow_policy}')
+        self._maxsize = maxsize
+        self._overflow_policy = overflow_policy
+        self._flush_delay = flush_delay_us / 1e6
+        self._flush_bytes = flush_bytes
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self):
+        IOLoop.current().spawn_callback(self._write_loop)
+
+    def put(self, data: bytes):
+        if self._closed:
+            return
+        if len(self._items) >= self._maxsize:
+            if self._overflow_policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self._overflow_policy == DROP_OLDEST:
+                dropped = len(self._items.popleft())
+                self._bytes -= dropped
+                self._inflight.value -= dropped
+                self.dropped += 1
+            else:
+                logging.debug('listener queue is full, disconnecting')
+                self.close()
+                self.stream.close()
+                return
+        if not self._items:
+            self._first_put_time = IOLoop.current().time()
+        self._items.append(data)
+        self._bytes += len(data)
+        self._inflight.value += len(data)
+        self._has_items.set()
+        if self._bytes >= self._flush_bytes:
+            self._flush_now.set()
+
+    def close(self):
+        self._closed = True
+        self._items.clear()
+        self._inflight.value -= self._bytes
+        self._bytes = 0
+        # wake the writer up so it can exit
+        self._has_items.set()
+        self._flush_now.set()
+
+    async def _write_loop(self):
+        try:
+            while not self._closed:
+                await self._has_items.wait()
+                if self._flush_delay:
+                    await self._coalesced_write()
+                else:
+                    while self._items:
+                        data = self._items.popleft()
+                        self._bytes -= len(data)
+                        try:
+                            await self.stream.write(data)
+                        finally:
+                            self._inflight.value -= len(data)
+                        self.bytes_written += len(data)
+                if not self._items:
+                    self._has_items.clear()
+        except StreamClosedError:
+            self.close()
+
+    async def _coalesced_write(self):
+        first_put_time = self._first_put_time
+        try:
+            await self._flush_now.wait(timeout=first_put_time + self._flush_delay)
+        except TimeoutError:
+            pass
+        self._flush_now.clear()
+        if not self._items:
+            return
+        items_count = len(self._items)
+        data = b''.join(self._items)
+        self._items.clear()
+        self._bytes = 0
+        self.flush_stats.add(
+            items=items_count,
+            bytes_=len(data),
+            latency=IOLoop.current().time() - first_put_time,
+        )
+        try:
+            await self.stream.write(data)
+        finally:
+            self._inflight.value -= len(data)
+        self.bytes_written += len(data)
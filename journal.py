@@ -0,0 +1,226 @@
+"""
+This module keeps validated frames of sources on disk, so the state
+of sources survives restarts.
+
+Journal is a directory of append-only segments. Every record of a segment is:
+8 bytes - time of receiving the frame, ns since epoch
+2 bytes - size of the frame
+the frame as it was received from a source
+A record of a removed source keeps only 8 bytes of its id instead of a frame,
+as frames are never shorter than their header.
+
+The journal is compacted on start: the latest state of every source
+is written to a single segment, and older segments are deleted,
+so it grows only with frames of a single run.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from tornado.ioloop import PeriodicCallback
+
+import source_protocol
+import store
+
+SEGMENT_SUFFIX = '.journal'
+
+# received_ns, frame size
+_record_header_struct = struct.Struct('>QH')
+_source_id_size = 8
+_state_codes = {state: code for code, state in source_protocol.state_translate.items()}
+
+
+class Journal:
+    """
+    Appends frames to the current segment of a worker.
+
+    Segments are opened lazily, so a run without frames leaves no empty ones.
+    Frames are collected in memory and written by big chunks when
+    buffer_size is reached or every flush_interval_ms, so up to
+    flush_interval_ms of frames may be lost on a crash.
+    A segment is rotated once it grows over segment_size.
+    """
+
+    def __init__(self,
+                 path: str,
+                 worker_id: int = 0,
+                 segment_size: int = 64 * 2 ** 20,
+                 buffer_size: int = 2 ** 20,
+                 flush_interval_ms: int = 1000):
+        self._path = path
+        self._worker_id = worker_id
+        self._segment_size = segment_size
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._file = None
+        self._segment_index = 0
+        self._flusher = PeriodicCallback(self.flush, flush_interval_ms)
+
+    def start(self):
+        os.makedirs(self._path, exist_ok=True)
+        # a new segment is started on every run, so a torn tail of a crashed run stays the last record of its segment
+        own_indexes = [
+            index for worker_id, index in map(_parse_segment_name, _segment_names(self._path))
+            if worker_id == self._worker_id
+        ]
+        self._segment_index = max(own_indexes, default=0)
+        self._flusher.start()
+
+    def append(self, frames: Sequence[bytes], received_ns: int):
+        for frame in frames:
+            self._buffer += _record_header_struct.pack(received_ns, len(frame))
+            self._buffer += frame
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def remove(self, source_ids: Iterable[str], removed_ns: int):
+        """ Records that sources are forgotten, so they aren't restored """
+        for source_id in source_ids:
+            self._buffer += _record_header_struct.pack(removed_ns, _source_id_size)
+            self._buffer += source_id.encode('ascii')
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._open_next_segment()
+        self._file.write(self._buffer)
+        self._buffer.clear()
+        if self._file.tell() >= self._segment_size:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._flusher.stop()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open_next_segment(self):
+        self._segment_index += 1
+        name = f'{self._worker_id:03d}-{self._segment_index:08d}{SEGMENT_SUFFIX}'
+        # the buffer is already big, so the file doesn't need its own one
+        self._file = open(os.path.join(self._path, name), 'ab', buffering=0)
+
+
+def read_records(path: str) -> Iterator[Tuple[int, bytes]]:
+    """
+    Scans all segments of the journal.
+    A torn record at the end of a segment is skipped.
+    :return: pairs of (received_ns, frame), or of (removed_ns, source id) for removed sources
+    """
+    for name in _segment_names(path):
+        for received_ns, mapped, start, end in _scan_segment(os.path.join(path, name)):
+            yield received_ns, mapped[start:end]
+
+
+def restore_sources(path: str, sources_store=None) -> int:
+    """
+    Fills the store with the last state of every source found in the journal.
+    Sources are restored in order of their last messages, as the store keeps them.
+    :return: count of restored sources
+    """
+    if sources_store is None:
+        sources_store = store.SourcesStore
+    if not os.path.isdir(path):
+        return 0
+    # source_id -> (received_ns, num, state), num and state are None for removed sources
+    last_states: Dict[bytes, Tuple[int, Optional[int], Optional[int]]] = {}
+    for name in _segment_names(path):
+        # frames were validated before journaling, so only their headers are needed
+        for received_ns, mapped, start, end in _scan_segment(os.path.join(path, name)):
+            if end - start == _source_id_size:
+                b_source_id, num, b_state = mapped[start:end], None, None
+            else:
+                _, num, b_source_id, b_state, _ = source_protocol.HEADER_STRUCT.unpack_from(mapped, start)
+            last = last_states.get(b_source_id)
+            if last is None or last[0] <= received_ns:
+                last_states[b_source_id] = (received_ns, num, b_state)
+    last_states = {b_source_id: last for b_source_id, last in last_states.items() if last[1] is not None}
+    # states are kept with monotonic time of receiving
+    monotonic_shift = time.monotonic_ns() - time.time_ns()
+    for b_source_id, (received_ns, num, b_state) in sorted(last_states.items(), key=lambda it: it[1][0]):
+        sources_store.update_state(
+            source_id=str(b_source_id, encoding='ascii'),
+            serial_num=num,
+            state=source_protocol.state_translate[b_state],
+            last_received=received_ns + monotonic_shift,
+        )
+    return len(last_states)
+
+
+def compact(path: str, sources_store=None) -> int:
+    """
+    Replaces all segments of the journal by a single one with the state
+    of every source of the store, which has to be restored from the journal first.
+    The new segment is in place before old ones are deleted, so a crash meanwhile loses nothing.
+    :return: count of deleted segments
+    """
+    if sources_store is None:
+        sources_store = store.SourcesStore
+    if not os.path.isdir(path):
+        return 0
+    names = _segment_names(path)
+    if not names:
+        return 0
+    index = max((index for worker_id, index in map(_parse_segment_name, names) if worker_id == 0), default=0) + 1
+    name = f'{0:03d}-{index:08d}{SEGMENT_SUFFIX}'
+    wall_shift = time.time_ns() - time.monotonic_ns()
+    buffer = bytearray()
+    for source in sources_store.get_all():
+        frame = source_protocol.HEADER_STRUCT.pack(
+            0x01, source.serial_num, source.id_.encode('ascii'), _state_codes[source.state], 0)
+        buffer += _record_header_struct.pack(source.last_received + wall_shift, len(frame))
+        buffer += frame
+    # a segment without the suffix is ignored until it's complete
+    tmp_path = os.path.join(path, name + '.tmp')
+    with open(tmp_path, 'wb') as fh:
+        fh.write(buffer)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, os.path.join(path, name))
+    for old_name in names:
+        os.remove(os.path.join(path, old_name))
+    return len(names)
+
+
+def _scan_segment(segment_path: str) -> Iterator[Tuple[int, mmap.mmap, int, int]]:
+    """ :return: (received_ns, mapped segment, start of a frame, end of the frame) for every record """
+    with open(segment_path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    header_size = _record_header_struct.size
+    unpack_from = _record_header_struct.unpack_from
+    size = len(mapped)
+    offset = 0
+    try:
+        while offset + header_size <= size:
+            received_ns, frame_size = unpack_from(mapped, offset)
+            start = offset + header_size
+            offset = start + frame_size
+            if offset > size:
+                logging.warning('torn record at the end of journal segment %s', segment_path)
+                break
+            yield received_ns, mapped, start, offset
+    finally:
+        mapped.close()
+
+
+def _segment_names(path: str) -> List[str]:
+    return sorted(name for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX))
+
+
+def _parse_segment_name(name: str) -> Tuple[int, int]:
+    """
+    >>> _parse_segment_name('002-00000015.journal')
+    (2, 15)
+    """
+    worker_id, index = name[:-len(SEGMENT_SUFFIX)].split('-')
+    return int(worker_id), int(index)
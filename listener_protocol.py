@@ -0,0 +1,145 @@
+"""
+This module is used to communicate with a listener
+
+Listeners receive text lines by default. A binary listener receives:
+frames of sources exactly as they were received from sources (header 0x01),
+so records of a frame are (8 bytes name, 4 bytes value, 1 byte XOR),
+and statuses of sources (header 0x02):
+1 byte - header
+8 bytes - identifier of the source
+2 bytes - number of the last message of the source
+1 byte - state of the source as it's sent by the source
+4 bytes - time since the last message of the source in milliseconds
+"""
+import collections
+import struct
+from typing import Callable, Optional
+
+import source_protocol
+
+MAX_HANDSHAKE_SIZE = 1024
+
+TEXT = 'text'
+BINARY = 'binary'
+formats = {TEXT, BINARY}
+
+BINARY_FRAME = 0x01
+BINARY_STATUS = 0x02
+
+# header, source_id, serial_num, state, ms since the last message
+_status_struct = struct.Struct('>B8sHBI')
+_state_codes = {state: code for code, state in source_protocol.state_translate.items()}
+_record_size = source_protocol.RECORD_STRUCT.size
+_header_size = source_protocol.HEADER_STRUCT.size
+
+# replay_last - count of recent messages to replay
+# replay_seconds - replay messages received during last seconds
+# sources, prefixes - ids and prefixes of ids of sources to receive messages of
+# fields - shell-style patterns of names of fields to receive
+# states - states of sources to receive messages in, statuses of sources in other states are still sent
+# format - TEXT or BINARY
+# Options, which are not given, are None
+Handshake = collections.namedtuple('Handshake', 'replay_last replay_seconds sources prefixes fields states format')
+
+
+def parse_handshake(line: Optional[bytes]) -> Handshake:
+    """
+    A listener may send a line of space separated options right after connect:
+    last=<count> or since=<seconds> to replay recent messages,
+    sources=<id>,<id> prefixes=<prefix>,<prefix> fields=<pattern>,<pattern> states=<state>,<state>
+    to receive only the messages it's interested in,
+    format=binary to receive binary messages instead of text.
+    >>> parse_handshake(b'last=100\\r\\n')
+    Handshake(replay_last=100, replay_seconds=None, sources=None, prefixes=None, fields=None, states=None, format=None)
+    >>> parse_handshake(b'since=2.5 prefixes=ab,cd fields=temp* states=IDLE format=binary\\n')
+    Handshake(replay_last=None, replay_seconds=2.5, sources=None, prefixes=['ab', 'cd'], fields=[b'temp*'], states=['IDLE'], format='binary')
+    >>> parse_handshake(None)
+    Handshake(replay_last=None, replay_seconds=None, sources=None, prefixes=None, fields=None, states=None, format=None)
+    >>> parse_handshake(b'last=-1\\n')
+    Traceback (most recent call last):
+    ...
+    ValueError: last has to be positive
+    >>> parse_handshake(b'states=SLEEPING\\n')
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown states ['SLEEPING']
+    """
+    options = {}
+    if line is not None:
+        for option in line.decode('ascii').split():
+            key, _, value = option.partition('=')
+            options[key] = value
+    replay_last = replay_seconds = None
+    if 'last' in options:
+        replay_last = int(options.pop('last'))
+        if replay_last <= 0:
+            raise ValueError('last has to be positive')
+    if 'since' in options:
+        replay_seconds = float(options.pop('since'))
+        if replay_seconds <= 0:
+            raise ValueError('since has to be positive')
+    sources, prefixes, fields, states = (
+        _pop_list(options, key) for key in ('sources', 'prefixes', 'fields', 'states')
+    )
+    if fields is not None:
+        fields = [field.encode('ascii') for field in fields]
+    if states is not None:
+        unknown = sorted(set(states) - set(source_protocol.state_translate.values()))
+        if unknown:
+            raise ValueError(f'unknown states {unknown}')
+    format_ = options.pop('format', None)
+    if format_ is not None and format_ not in formats:
+        raise ValueError(f'unknown format {format_}')
+    if options:
+        raise ValueError(f'unknown options {sorted(options)}')
+    return Handshake(
+        replay_last=replay_last,
+        replay_seconds=replay_seconds,
+        sources=sources,
+        prefixes=prefixes,
+        fields=fields,
+        states=states,
+        format=format_,
+    )
+
+
+def _pop_list(options: dict, key: str):
+    if key not in options:
+        return None
+    return [it for it in options.pop(key).split(',') if it]
+
+
+def gen_binary_status(source_id: str, serial_num: int, state: str, ms_since_last_msg: float) -> bytes:
+    """
+    >>> gen_binary_status('asdfghjk', 2, 'ACTIVE', 15.3).hex()
+    '026173646667686a6b0002020000000f'
+    >>> gen_binary_status('asdfghjk', 2, 'ACTIVE', -1.0).hex()
+    '026173646667686a6b00020200000000'
+    """
+    return _status_struct.pack(
+        BINARY_STATUS,
+        source_id.encode('ascii'),
+        serial_num,
+        _state_codes[state],
+        # the age is negative if the wall clock stepped back since times were restored from the journal
+        max(0, min(int(ms_since_last_msg), 0xffffffff)),
+    )
+
+
+def filter_frame(frame: bytes, match_field: Callable[[bytes], bool]) -> bytes:
+    """
+    Leaves only records of a validated source frame, names of which match.
+    :return: the frame itself if all records match
+    >>> frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x02]) + b'temp0001' + bytes(5) + b'humidity' + bytes(5)
+    >>> filtered = filter_frame(frame, lambda name: name.startswith(b'temp'))
+    >>> filtered[12], filtered[13:21]
+    (1, b'temp0001')
+    """
+    records = [
+        frame[start:start + _record_size]
+        for start in range(_header_size, len(frame), _record_size)
+        if match_field(frame[start:start + 8])
+    ]
+    if len(records) == frame[_header_size - 1]:
+        return frame
+    return frame[:_header_size - 1] + bytes([len(records)]) + b''.join(records)
@@ -0,0 +1,172 @@
+"""
+This module collects metrics of the system and exposes them
+in Prometheus text format.
+"""
+import bisect
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+LATENCY_BUCKETS = (
+    1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0,
+)
+
+
+class Counter:
+    """
+    >>> counter = Counter('frames_total', 'Frames')
+    >>> counter.inc()
+    >>> counter.inc(2)
+    >>> print(counter.render())
+    # HELP frames_total Frames
+    # TYPE frames_total counter
+    frames_total 3
+    """
+
+    def __init__(self, name: str, help_: str):
+        self.name = name
+        self.help = help_
+        self.value = 0
+
+    def inc(self, value: int = 1):
+        self.value += value
+
+    def render(self) -> str:
+        return '\n'.join((
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} counter',
+            f'{self.name} {self.value}',
+        ))
+
+
+class Gauge:
+    """
+    Value of the gauge is taken from callback at the moment of rendering.
+    The callback returns either a number or a dict of {label value: number}.
+    type_ may be set to 'counter' for values, which only grow, but are kept elsewhere.
+    >>> gauge = Gauge('queue_depth', 'Depth', lambda: {'0': 3, '1': 0}, label='listener')
+    >>> print(gauge.render())
+    # HELP queue_depth Depth
+    # TYPE queue_depth gauge
+    queue_depth{listener="0"} 3
+    queue_depth{listener="1"} 0
+    """
+
+    def __init__(self,
+                 name: str,
+                 help_: str,
+                 callback: Callable[[], Union[float, Dict[str, float]]],
+                 label: str = None,
+                 type_: str = 'gauge'):
+        self.name = name
+        self.help = help_
+        self._callback = callback
+        self._label = label
+        self._type = type_
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self._type}',
+        ]
+        value = self._callback()
+        if self._label is None:
+            lines.append(f'{self.name} {value}')
+        else:
+            lines.extend(
+                f'{self.name}{{{self._label}="{label_value}"}} {it}'
+                for label_value, it in value.items()
+            )
+        return '\n'.join(lines)
+
+
+class Histogram:
+    """
+    >>> histogram = Histogram('parse_seconds', 'Parse time', buckets=(0.1, 1.0))
+    >>> histogram.observe(0.05)
+    >>> histogram.observe(0.5)
+    >>> print(histogram.render())
+    # HELP parse_seconds Parse time
+    # TYPE parse_seconds histogram
+    parse_seconds_bucket{le="0.1"} 1
+    parse_seconds_bucket{le="1.0"} 2
+    parse_seconds_bucket{le="+Inf"} 2
+    parse_seconds_sum 0.55
+    parse_seconds_count 2
+    """
+
+    def __init__(self, name: str, help_: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_
+        self._buckets = tuple(buckets)
+        # the last one is +Inf bucket
+        self._counts = [0] * (len(self._buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """ :return: cumulative counts of values per upper bound of buckets """
+        res = []
+        cumulative = 0
+        for bound, count in zip((*self._buckets, float('inf')), self._counts):
+            cumulative += count
+            res.append((bound, cumulative))
+        return res
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} histogram',
+        ]
+        for bound, count in self.buckets():
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {count}')
+        lines.append(f'{self.name}_sum {round(self.sum, 9)}')
+        lines.append(f'{self.name}_count {self.count}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    """
+    Keeps all metrics of the process.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help_: str) -> Counter:
+        return self._register(Counter(name, help_))
+
+    def histogram(self, name: str, help_: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_, buckets))
+
+    def gauge(self, name: str, help_: str, callback, label: str = None, type_: str = 'gauge') -> Gauge:
+        return self._register(Gauge(name, help_, callback, label, type_))
+
+    def render(self) -> str:
+        return ''.join(f'{metric.render()}\n' for metric in self._metrics.values())
+
+    def _register(self, metric):
+        # metrics of a replaced object (e.g. a new Dispatcher) override old ones
+        self._metrics[metric.name] = metric
+        return metric
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port: int, address: str = '127.0.0.1', registry: Registry = REGISTRY):
+    """ Serves metrics at http://<address>:<port>/metrics on the current IOLoop """
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+
+        def get(self):
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write(registry.render())
+
+    app = tornado.web.Application([('/metrics', MetricsHandler)])
+    return app.listen(port, address=address)
@@ -0,0 +1,70 @@
+"""
+This module parses big frames of sources out of the event loop.
+"""
+import concurrent.futures
+import multiprocessing
+import time
+from typing import List, Optional, Sequence
+
+from tornado.ioloop import IOLoop
+
+import metrics
+import source_protocol
+
+THREAD = 'thread'
+PROCESS = 'process'
+executors = {THREAD, PROCESS}
+
+
+class ParsePool:
+    """
+    Parses frames of min_size bytes and bigger in a pool of workers,
+    so a burst of big frames doesn't hold answers to other sources.
+
+    Big frames of a batch read from a source are sent to the pool
+    as a single job, and their results come back to the IOLoop at once.
+    A source isn't read until its batch is handled, so its frames stay in order.
+    A process pool parses in parallel with the loop, a thread pool
+    only interleaves parsing with it, as parsing holds the GIL.
+    """
+
+    def __init__(self, min_size: int, executor: str = PROCESS, workers: int = 2):
+        if executor not in executors:
+            raise ValueError(f'unknown executor {executor}')
+        self.min_size = min_size
+        if executor == PROCESS:
+            # forked workers would inherit listening sockets of the app and keep them after it exits
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # jobs submitted and not returned yet
+        self.depth = 0
+        self._offload_seconds = metrics.REGISTRY.histogram(
+            'dispatcher_parse_offload_seconds', 'Time from submitting frames to the parse pool till their results')
+        metrics.REGISTRY.gauge(
+            'dispatcher_parse_offload_queue_depth', 'Jobs in the parse pool', lambda: self.depth)
+
+    def is_big(self, frame: bytes) -> bool:
+        return len(frame) >= self.min_size
+
+    async def parse(self, frames: Sequence[bytes]) -> List[Optional[source_protocol.SourceFrame]]:
+        """ :return: parsed frames or None for corrupted ones, in order of frames """
+        self.depth += 1
+        started = time.perf_counter()
+        try:
+            return await IOLoop.current().run_in_executor(self._executor, _parse_frames, frames)
+        finally:
+            self.depth -= 1
+            self._offload_seconds.observe(time.perf_counter() - started)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _parse_frames(frames: Sequence[bytes]) -> List[Optional[source_protocol.SourceFrame]]:
+    """
+    >>> [parsed.source_id for parsed in _parse_frames([bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00])])]
+    ['asdfghjk']
+    """
+    return [source_protocol.parse_source_frame(frame) for frame in frames]
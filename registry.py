@@ -0,0 +1,85 @@
+"""
+This module tracks connections of the system.
+"""
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Tuple
+
+
+class Registry:
+    """
+    Two-way index between ids and streams of connections.
+    Every id belongs to one stream, a stream can have several ids.
+    on_remove is called for every removed id, so other stores can be kept in sync.
+    >>> removed = []
+    >>> registry = Registry(on_remove=lambda id_, value: removed.append(id_))
+    >>> registry.add('asdfqwer', 'stream1')
+    >>> registry.add('asdfqwes', 'stream1')
+    >>> registry.add(0, 'stream2', value='queue')
+    >>> registry[0]
+    'queue'
+    >>> 'asdfqwer' in registry, len(registry)
+    (True, 3)
+    >>> registry.remove_stream('stream1')
+    ['asdfqwer', 'asdfqwes']
+    >>> registry.remove_stream('stream1')
+    []
+    >>> registry.remove(0)
+    >>> removed, len(registry)
+    (['asdfqwer', 'asdfqwes', 0], 0)
+    """
+
+    def __init__(self, on_remove: Callable[[Hashable, Any], Any] = None):
+        self._values: Dict[Hashable, Any] = {}
+        self._streams: Dict[Hashable, Any] = {}
+        # ids of a stream are kept as keys of dict to preserve their order
+        self._ids_by_stream: Dict[Any, Dict[Hashable, None]] = {}
+        self._on_remove = on_remove
+
+    def __contains__(self, id_) -> bool:
+        return id_ in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, id_):
+        return self._values[id_]
+
+    def get(self, id_, default=None):
+        return self._values.get(id_, default)
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        return iter(self._values.items())
+
+    def add(self, id_, stream, value=None):
+        """
+        Binds id_ to stream. value is stream itself if not given.
+        If id_ was bound to another stream - it's moved to the new one.
+        """
+        old_stream = self._streams.get(id_)
+        if old_stream is not None and old_stream is not stream:
+            self._discard_id(old_stream, id_)
+        self._values[id_] = stream if value is None else value
+        self._streams[id_] = stream
+        self._ids_by_stream.setdefault(stream, {})[id_] = None
+
+    def remove(self, id_):
+        stream = self._streams.pop(id_)
+        self._discard_id(stream, id_)
+        value = self._values.pop(id_)
+        if self._on_remove is not None:
+            self._on_remove(id_, value)
+
+    def remove_stream(self, stream) -> List[Hashable]:
+        """
+        Removes all ids of the stream
+        :return: removed ids
+        """
+        ids = list(self._ids_by_stream.get(stream, ()))
+        for id_ in ids:
+            self.remove(id_)
+        return ids
+
+    def _discard_id(self, stream, id_):
+        ids = self._ids_by_stream[stream]
+        ids.pop(id_, None)
+        if not ids:
+            del self._ids_by_stream[stream]
@@ -0,0 +1,66 @@
+"""
+This module keeps recent messages for listeners, so a new listener
+can catch up before receiving live messages.
+"""
+import collections
+import itertools
+import time
+from typing import Callable, Deque, List, Tuple
+
+MatchSource = Callable[[str], bool]
+
+
+class ReplayBuffer:
+    """
+    Ring of rendered messages limited by their total size.
+    Messages are kept as they are sent to text and binary listeners,
+    so they are replayed without re-encoding.
+    >>> buffer = ReplayBuffer(max_bytes=14)
+    >>> for i, msg in enumerate((b'aaaa', b'bbbb', b'cccc')):
+    ...     buffer.append(msg, msg[:3], source_id='source%02d' % (i % 2), received_ns=i * 10 ** 9)
+    >>> buffer.last(5)
+    [b'bbbb', b'cccc']
+    >>> buffer.last(5, match_source=lambda source_id: source_id == 'source00', binary=True)
+    [b'ccc']
+    >>> buffer.since(2 * 10 ** 9)
+    [b'cccc']
+    >>> len(buffer), buffer.size
+    (2, 14)
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        # (received_ns, source_id, text msg, binary msg)
+        self._msgs: Deque[Tuple[int, str, bytes, bytes]] = collections.deque()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def append(self, msg: bytes, binary_msg: bytes, source_id: str, received_ns: int = None):
+        if received_ns is None:
+            received_ns = time.monotonic_ns()
+        self._msgs.append((received_ns, source_id, msg, binary_msg))
+        self.size += len(msg) + len(binary_msg)
+        while self.size > self._max_bytes:
+            _, _, msg, binary_msg = self._msgs.popleft()
+            self.size -= len(msg) + len(binary_msg)
+
+    def last(self, count: int, match_source: MatchSource = None, binary: bool = False) -> List[bytes]:
+        msgs = (
+            it[3 if binary else 2] for it in reversed(self._msgs)
+            if match_source is None or match_source(it[1])
+        )
+        msgs = list(itertools.islice(msgs, count))
+        msgs.reverse()
+        return msgs
+
+    def since(self, received_ns: int, match_source: MatchSource = None, binary: bool = False) -> List[bytes]:
+        """ :return: messages received at received_ns or later """
+        msgs = [
+            it[3 if binary else 2]
+            for it in itertools.takewhile(lambda it: it[0] >= received_ns, reversed(self._msgs))
+            if match_source is None or match_source(it[1])
+        ]
+        msgs.reverse()
+        return msgs
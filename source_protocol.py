@@ -1,7 +1,12 @@
 """
 This module is used to communicate with a source
 """
+import collections
 import functools
+import importlib.util
+import itertools
+import struct
+from typing import List, Optional, Sequence, Tuple, Union
 
 
 BYTE_ORDER = 'big'
@@ -12,6 +17,26 @@ state_translate = {
     0x03: 'RECHARGE',
 }
 
+# header, num, source_id, source_state, numfields
+HEADER_STRUCT = struct.Struct('>BH8sBB')
+# name, value, xor
+RECORD_STRUCT = struct.Struct('>8sIB')
+
+MAX_FRAME_SIZE = HEADER_STRUCT.size + 0xff * RECORD_STRUCT.size
+
+# header, serial num, xor
+_answer_struct = struct.Struct('>BHB')
+# XOR of 0x12 0x00 0x00 is 0x12
+FAILURE_ANSWER = _answer_struct.pack(0x12, 0, 0x12)
+
+# parse_source_frames needs numpy, and it's faster than parsing frames one by one
+# only from this many records in a burst on, see bench.batch
+BATCH_AVAILABLE = importlib.util.find_spec('numpy') is not None
+BATCH_MIN_RECORDS = 255
+
+SourceFrame = collections.namedtuple('SourceFrame', 'num source_id source_state msgs')
+SourceFramesBatch = collections.namedtuple('SourceFramesBatch', 'ok frames consumed')
+
 
 def gen_answer_to_source(success: bool, serial_num: int = None) -> bytes:
     """
@@ -20,15 +45,17 @@ def gen_answer_to_source(success: bool, serial_num: int = None) -> bytes:
     2 bytes - serial num or 0x00 0x00 if not succeeded
     1 byte - XOR of the message
     """
-    if success:
-        b_serial_num = serial_num.to_bytes(2, byteorder=BYTE_ORDER)
-    else:
-        b_serial_num = bytes([0x00, 0x00])
-    res = bytes([
-        0x11 if success else 0x12,
-        *b_serial_num,
-    ])
-    return bytes([*res, *xor(res)])
+    if not success:
+        return FAILURE_ANSWER
+    return gen_success_answer(serial_num)
+
+
+def gen_success_answer(serial_num: int) -> bytes:
+    """
+    >>> gen_success_answer(0x0102).hex()
+    '11010212'
+    """
+    return _answer_struct.pack(0x11, serial_num, 0x11 ^ (serial_num >> 8) ^ (serial_num & 0xff))
 
 
 def parse_source_bytes(bytes_obj: bytes) -> dict:
@@ -42,40 +69,173 @@ def parse_source_bytes(bytes_obj: bytes) -> dict:
         msgs=Sequence[Tuple[str, int]], # every item is pair of (name, value) or None if message is corrupted
     )
     """
-    if len(bytes_obj) < 13 or bytes_obj[0] != 0x01:
+    frame = parse_source_frame(bytes_obj)
+    if frame is None:
         return {}
-    num = int.from_bytes(bytes_obj[1:3], byteorder=BYTE_ORDER, signed=False)
-    source_id = str(bytes_obj[3:11], encoding='ascii')
-    source_state = state_translate.get(bytes_obj[11])
+    return dict(header=0x01, **frame._asdict())
+
+
+def parse_source_frame(bytes_obj: bytes) -> Optional[SourceFrame]:
+    """
+    Transforms bytes received from source to SourceFrame in a single pass.
+    Accepts the same frames as parse_source_bytes.
+    :return: SourceFrame or None if message is corrupted
+    """
+    if len(bytes_obj) < HEADER_STRUCT.size:
+        return None
+    header, num, b_source_id, b_state, num_of_msgs = HEADER_STRUCT.unpack_from(bytes_obj)
+    if header != 0x01:
+        return None
+    source_id = str(b_source_id, encoding='ascii')
+    source_state = state_translate.get(b_state)
     if source_state is None:
-        return {}
-    num_of_msgs = int.from_bytes(bytes([bytes_obj[12]]), byteorder=BYTE_ORDER, signed=False)
-    byte_msgs = bytes_obj[13:]
-    if len(byte_msgs) != num_of_msgs*13:
-        return {}
-    msgs = [msg for msg in _iter_source_msgs(byte_msgs)]
-    if any(it is None for it in msgs):
-        return {}
-    return dict(
-        header=0x01,
+        return None
+    if len(bytes_obj) != HEADER_STRUCT.size + num_of_msgs * RECORD_STRUCT.size:
+        return None
+    msgs = []
+    for name, value, xor_byte in RECORD_STRUCT.iter_unpack(memoryview(bytes_obj)[HEADER_STRUCT.size:]):
+        if _xor_record(name, value) != xor_byte:
+            return None
+        msgs.append((name, value))
+    return SourceFrame(
         num=num,
         source_id=source_id,
         source_state=source_state,
-        msgs=[msg for msg in _iter_source_msgs(byte_msgs)],
+        msgs=msgs,
     )
 
 
-def _iter_source_msgs(byte_msgs: bytes):
-    cur_pos = 0
-    while cur_pos+8 < len(byte_msgs):
-        name = byte_msgs[cur_pos:cur_pos+8]
-        value = int.from_bytes(byte_msgs[cur_pos+8:cur_pos+12], byteorder=BYTE_ORDER)
-        xor_byte = xor(byte_msgs[cur_pos:cur_pos+12])
-        if xor_byte != bytes([byte_msgs[cur_pos+12]]):
-            yield None
-        else:
-            yield (name, value)
-        cur_pos += 13
+def _xor_record(name: bytes, value: int) -> int:
+    """ Returns XOR of 8 bytes of name and 4 bytes of value as int """
+    res = int.from_bytes(name, byteorder=BYTE_ORDER) ^ value
+    res ^= res >> 32
+    res ^= res >> 16
+    res ^= res >> 8
+    return res & 0xff
+
+
+def count_records(frames: Sequence[bytes]) -> int:
+    """
+    :return: count of records declared by headers of frames
+    >>> count_records([bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x02]), b'\x01'])
+    2
+    """
+    return sum(frame[12] for frame in frames if len(frame) >= HEADER_STRUCT.size)
+
+
+def is_batch_faster(frames: Sequence[bytes]) -> bool:
+    """ :return: whether parse_source_frames is available and faster for frames than parsing them one by one """
+    return BATCH_AVAILABLE and count_records(frames) >= BATCH_MIN_RECORDS
+
+
+def parse_source_frames(frames: Union[bytes, Sequence[bytes]]) -> SourceFramesBatch:
+    """
+    Validates many frames at once with numpy.
+    Accepts either a sequence of frames or one contiguous buffer of frames.
+    In the latter case frames are split by their numfields and an incomplete
+    frame at the end of the buffer is left unconsumed.
+    Accepts the same frames as parse_source_frame, except that a frame with
+    non-ascii source id is rejected instead of raising.
+    :return: SourceFramesBatch(
+        ok=numpy.ndarray,  # bool flag per frame
+        frames=List[Optional[SourceFrame]],  # None for rejected frames
+        consumed=int,  # number of bytes of the buffer which were split to frames
+    )
+    """
+    import numpy as np
+
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        buffer = frames
+        starts, sizes = _split_frames(buffer)
+        lengths = sizes
+    else:
+        buffer = b''.join(frames)
+        lengths = [len(frame) for frame in frames]
+        starts = list(itertools.accumulate(lengths, initial=0))[:-1]
+        sizes = [
+            HEADER_STRUCT.size + buffer[start + 12] * RECORD_STRUCT.size
+            if length >= HEADER_STRUCT.size else -1
+            for start, length in zip(starts, lengths)
+        ]
+    consumed = sum(lengths)
+    arr = np.frombuffer(buffer, dtype=np.uint8, count=consumed)
+    starts = np.array(starts, dtype=np.int64)
+    ok = np.array(sizes, dtype=np.int64) == np.array(lengths, dtype=np.int64)
+
+    # indexes and (k, 13) headers of frames with correct size
+    idx = np.flatnonzero(ok)
+    headers = arr[starts[idx, None] + np.arange(HEADER_STRUCT.size)]
+    correct_headers = (headers[:, 0] == 0x01) & np.isin(headers[:, 11], list(state_translate))
+    idx = idx[correct_headers]
+    headers = headers[correct_headers]
+
+    # (n, 13) records of these frames
+    counts = headers[:, 12].astype(np.int64)
+    frame_of_record = np.repeat(np.arange(len(idx)), counts)
+    first_record = np.cumsum(counts) - counts
+    record_in_frame = np.arange(counts.sum()) - np.repeat(first_record, counts)
+    record_starts = (
+        starts[idx][frame_of_record] + HEADER_STRUCT.size + record_in_frame * RECORD_STRUCT.size
+    )
+    records = arr[record_starts[:, None] + np.arange(RECORD_STRUCT.size)]
+    xor_ok = np.bitwise_xor.reduce(records[:, :12], axis=1) == records[:, 12]
+    correct_records = np.bincount(frame_of_record[~xor_ok], minlength=len(idx)) == 0
+
+    names = records[:, :8].tobytes()
+    values = records[:, 8:12].copy().view('>u4').ravel().tolist()
+    nums = (headers[:, 1].astype(np.int64) << 8 | headers[:, 2]).tolist()
+    source_ids = headers[:, 3:11].tobytes()
+    states = headers[:, 11].tolist()
+    first_record = first_record.tolist()
+    counts = counts.tolist()
+    idx = idx.tolist()
+    ok[:] = False
+    res = [None] * len(starts)
+    for k in np.flatnonzero(correct_records).tolist():
+        try:
+            source_id = str(source_ids[k * 8:k * 8 + 8], encoding='ascii')
+        except UnicodeDecodeError:
+            continue
+        first = first_record[k]
+        i = idx[k]
+        ok[i] = True
+        res[i] = SourceFrame(
+            num=nums[k],
+            source_id=source_id,
+            source_state=state_translate[states[k]],
+            msgs=[
+                (names[j * 8:j * 8 + 8], values[j])
+                for j in range(first, first + counts[k])
+            ],
+        )
+    return SourceFramesBatch(ok=ok, frames=res, consumed=consumed)
+
+
+def split_frames(buffer: bytes) -> Tuple[List[bytes], int]:
+    """
+    Cuts complete frames out of contiguous buffer.
+    :return: (frames, number of consumed bytes)
+    """
+    starts, sizes = _split_frames(buffer)
+    frames = [bytes(buffer[start:start + size]) for start, size in zip(starts, sizes)]
+    return frames, sum(sizes)
+
+
+def _split_frames(buffer: bytes):
+    """
+    Splits contiguous buffer to complete frames by their numfields.
+    :return: (starts, sizes) of frames
+    """
+    starts, sizes = [], []
+    pos = 0
+    while pos + HEADER_STRUCT.size <= len(buffer):
+        size = HEADER_STRUCT.size + buffer[pos + 12] * RECORD_STRUCT.size
+        if pos + size > len(buffer):
+            break
+        starts.append(pos)
+        sizes.append(size)
+        pos += size
+    return starts, sizes
 
 
 def xor(bytes_obj: bytes) -> bytes:
@@ -2,34 +2,108 @@
 This module represents a store of the system.
 """
 
+import array
+import bisect
 import collections
 import datetime
 import itertools
-from typing import Dict, Sequence
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-Source = collections.namedtuple('Source', 'id_ serial_num state last_received')
-Listener = collections.namedtuple('Listener', 'id_ sources_notified')
+# seq is a number of registration of a source, it grows with every new source
+Source = collections.namedtuple('Source', 'id_ serial_num state last_received seq')
+# every source with seq <= notified_seq is known to the listener
+Listener = collections.namedtuple('Listener', 'id_ notified_seq')
+
+
+class _SeqLog:
+    """
+    Ids of sources in order of their seqs, so sources can be iterated lazily
+    while the store changes: updates move sources within the store and removals
+    reorder it, but sources are only appended here.
+    Entries of removed sources are skipped, they are dropped once there are many of them.
+    An iteration keeps its position as the last seq it has reached, so dropping
+    entries doesn't disturb it, and a stalled one doesn't hold the log from shrinking.
+    >>> log = _SeqLog()
+    >>> for seq, source_id in enumerate('abcd', start=1):
+    ...     log.append(source_id, seq)
+    >>> chunks = log.iter(max_seq=3, chunk_size=1)
+    >>> list(next(chunks))
+    [('a', 1)]
+    >>> log.compact({'c': 3, 'd': 4}.get)
+    >>> [list(chunk) for chunk in chunks]
+    [[('c', 3)]]
+    """
+
+    def __init__(self):
+        self._ids: List[str] = []
+        self._seqs = array.array('Q')
+        self._removed = 0
+
+    def append(self, source_id: str, seq: int):
+        self._ids.append(source_id)
+        self._seqs.append(seq)
+
+    def on_remove(self, seq_of: Callable[[str], Optional[int]]):
+        """ :param seq_of: current seq of a source id or None if the source is removed """
+        self._removed += 1
+        if self._removed > len(self._ids) // 2 + 64:
+            self.compact(seq_of)
+
+    def compact(self, seq_of: Callable[[str], Optional[int]]):
+        """ Drops entries of removed sources """
+        live = [(id_, seq) for id_, seq in zip(self._ids, self._seqs) if seq_of(id_) == seq]
+        self._ids = [id_ for id_, _ in live]
+        self._seqs = array.array('Q', (seq for _, seq in live))
+        self._removed = 0
+
+    def iter(self, max_seq: int, chunk_size: int = 1024) -> Iterator[Iterable[Tuple[str, int]]]:
+        """ :return: chunks of (id, seq) of entries up to max_seq, removed ones included """
+        last_seq = 0
+        while last_seq < max_seq:
+            # the log may be compacted between steps, so the position is found again by seq
+            start = bisect.bisect_right(self._seqs, last_seq)
+            stop = min(start + chunk_size, bisect.bisect_right(self._seqs, max_seq))
+            if start >= stop:
+                return
+            ids, seqs = self._ids[start:stop], self._seqs[start:stop]
+            last_seq = seqs[-1]
+            yield zip(ids, seqs)
 
 
 class _SourcesStore:
     """
     Represents store for state of sources.
+    Sources are kept in order of their updates, so the least recently updated come first.
     >>> import datetime
     >>> store = _SourcesStore()
     >>> store.get_all()
     ()
     >>> store.update_state('asdfqwer', 23, 4, datetime.datetime(2000, 1, 1))
     >>> store.get_all()
-    (Source(id_='asdfqwer', serial_num=23, state=4, last_received=datetime.datetime(2000, 1, 1, 0, 0)),)
+    (Source(id_='asdfqwer', serial_num=23, state=4, last_received=datetime.datetime(2000, 1, 1, 0, 0), seq=1),)
     >>> store.get_state('asdfqwer')
-    Source(id_='asdfqwer', serial_num=23, state=4, last_received=datetime.datetime(2000, 1, 1, 0, 0))
+    Source(id_='asdfqwer', serial_num=23, state=4, last_received=datetime.datetime(2000, 1, 1, 0, 0), seq=1)
     >>> store.update_state('asdfqwer', 30, 4, datetime.datetime(2000, 1, 5))
     >>> store.get_state('asdfqwer')
-    Source(id_='asdfqwer', serial_num=30, state=4, last_received=datetime.datetime(2000, 1, 5, 0, 0))
+    Source(id_='asdfqwer', serial_num=30, state=4, last_received=datetime.datetime(2000, 1, 5, 0, 0), seq=1)
+    >>> store.update_state('asdfqwes', 1, 4, datetime.datetime(2000, 1, 5))
+    >>> store.last_seq
+    2
+    >>> store.get_oldest(1)
+    [('asdfqwer', datetime.datetime(2000, 1, 5, 0, 0))]
+    >>> store.remove_source('asdfqwer'), store.remove_source('asdfqwer')
+    (True, False)
+    >>> store.update_state('asdfqwer', 31, 4, datetime.datetime(2000, 1, 6))
+    >>> store.get_state('asdfqwer').seq
+    3
+    >>> [source.id_ for source in store.iter_sources(max_seq=3)]
+    ['asdfqwes', 'asdfqwer']
     """
 
     def __init__(self):
         self._sources: Dict[str, Source] = {}
+        self._seq_log = _SeqLog()
+        self.last_seq = 0
 
     def update_state(self,
                      source_id: str,
@@ -38,13 +112,56 @@ class _SourcesStore:
                      last_received: datetime.datetime
                      ):
         """ Creates or update state of source """
+        # the source is moved to the end
+        source = self._sources.pop(source_id, None)
+        if source is None:
+            self.last_seq += 1
+            seq = self.last_seq
+            self._seq_log.append(source_id, seq)
+        else:
+            seq = source.seq
         self._sources[source_id] = Source(
             id_=source_id,
             serial_num=serial_num,
             state=state,
             last_received=last_received,
+            seq=seq,
         )
 
+    def remove_source(self, source_id: str) -> bool:
+        """
+        Forgets the source, it gets a new seq once it's updated again
+        :return: whether the source was known
+        """
+        if self._sources.pop(source_id, None) is None:
+            return False
+        self._seq_log.on_remove(self._get_seq)
+        return True
+
+    def get_oldest(self, count: int) -> List[Tuple[str, Any]]:
+        """ :return: (id, last_received) of up to count least recently updated sources """
+        return [(source.id_, source.last_received) for source in itertools.islice(self._sources.values(), count)]
+
+    def iter_sources(self, max_seq: int) -> Iterator[Source]:
+        """
+        Iterates lazily over sources registered up to max_seq in order of their seqs.
+        The store may change between steps: every source is taken as it is at its step,
+        and sources removed meanwhile are skipped.
+        """
+        sources = self._sources
+        for chunk in self._seq_log.iter(max_seq):
+            for source_id, seq in chunk:
+                source = sources.get(source_id)
+                if source is not None and source.seq == seq:
+                    yield source
+
+    def _get_seq(self, source_id: str) -> Optional[int]:
+        source = self._sources.get(source_id)
+        return None if source is None else source.seq
+
+    def __len__(self):
+        return len(self._sources)
+
     def get_state(self, source_id: str) -> Source:
         return self._sources.get(source_id)
 
@@ -52,22 +169,208 @@ class _SourcesStore:
         return tuple(self._sources.values())
 
 
+class _ArraySourcesStore:
+    """
+    Represents store for state of sources kept in preallocated arrays.
+    Every source id is mapped to a slot, which is updated in place.
+    Slots are dense: a removed source is replaced with the last one.
+    Ids are kept in order of their updates, so the least recently updated come first.
+    last_received is expected to be an int, e.g. time.monotonic_ns().
+    >>> store = _ArraySourcesStore(initial_capacity=1)
+    >>> len(store.get_all())
+    0
+    >>> store.update_state('asdfqwer', 23, 'IDLE', 1000)
+    >>> store.update_state('asdfqwes', 24, 'ACTIVE', 2000)
+    >>> list(store.get_all())
+    [Source(id_='asdfqwer', serial_num=23, state='IDLE', last_received=1000, seq=1), \
+Source(id_='asdfqwes', serial_num=24, state='ACTIVE', last_received=2000, seq=2)]
+    >>> store.update_state('asdfqwer', 30, 'RECHARGE', 3000)
+    >>> store.get_state('asdfqwer')
+    Source(id_='asdfqwer', serial_num=30, state='RECHARGE', last_received=3000, seq=1)
+    >>> store.get_state('unknown') is None
+    True
+    >>> store.get_oldest(5)
+    [('asdfqwes', 2000), ('asdfqwer', 3000)]
+    >>> store.remove_source('asdfqwes'), store.remove_source('unknown')
+    (True, False)
+    >>> list(store.get_all())
+    [Source(id_='asdfqwer', serial_num=30, state='RECHARGE', last_received=3000, seq=1)]
+    >>> store.update_state('asdfqwet', 1, 'IDLE', 4000)
+    >>> sources = store.iter_sources(max_seq=3)
+    >>> next(sources).id_
+    'asdfqwer'
+    >>> store.remove_source('asdfqwer')
+    True
+    >>> [source.id_ for source in sources]
+    ['asdfqwet']
+    """
+
+    def __init__(self, initial_capacity: int = 1024):
+        self._index: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._serial_nums = array.array('H', bytes(2 * initial_capacity))
+        self._state_codes = array.array('B', bytes(initial_capacity))
+        self._last_received = array.array('q', bytes(8 * initial_capacity))
+        self._seqs = array.array('Q', bytes(8 * initial_capacity))
+        self._seq_log = _SeqLog()
+        self.last_seq = 0
+        # states are interned to one byte codes
+        self._states: List[Any] = []
+        self._states_codes: Dict[Any, int] = {}
+
+    def update_state(self,
+                     source_id: str,
+                     serial_num: int,
+                     state: Any,
+                     last_received: int,
+                     ):
+        """ Creates or update state of source """
+        # the source is moved to the end of the index
+        slot = self._index.pop(source_id, None)
+        if slot is None:
+            slot = self._add(source_id)
+        self._index[source_id] = slot
+        state_code = self._states_codes.get(state)
+        if state_code is None:
+            state_code = self._states_codes[state] = len(self._states)
+            self._states.append(state)
+        self._serial_nums[slot] = serial_num
+        self._state_codes[slot] = state_code
+        self._last_received[slot] = last_received
+
+    def remove_source(self, source_id: str) -> bool:
+        """
+        Forgets the source, it gets a new seq once it's updated again
+        :return: whether the source was known
+        """
+        slot = self._index.pop(source_id, None)
+        if slot is None:
+            return False
+        last = len(self._ids) - 1
+        if slot != last:
+            last_id = self._ids[last]
+            self._ids[slot] = last_id
+            for values in (self._serial_nums, self._state_codes, self._last_received, self._seqs):
+                values[slot] = values[last]
+            # assignment to an existing key keeps the order of the index
+            self._index[last_id] = slot
+        self._ids.pop()
+        self._seq_log.on_remove(self._get_seq)
+        return True
+
+    def get_oldest(self, count: int) -> List[Tuple[str, int]]:
+        """ :return: (id, last_received) of up to count least recently updated sources """
+        last_received = self._last_received
+        return [(id_, last_received[slot]) for id_, slot in itertools.islice(self._index.items(), count)]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_state(self, source_id: str) -> Source:
+        slot = self._index.get(source_id)
+        if slot is None:
+            return None
+        return Source(
+            id_=source_id,
+            serial_num=self._serial_nums[slot],
+            state=self._states[self._state_codes[slot]],
+            last_received=self._last_received[slot],
+            seq=self._seqs[slot],
+        )
+
+    def iter_sources(self, max_seq: int) -> Iterator[Source]:
+        """
+        Iterates lazily over sources registered up to max_seq in order of their seqs.
+        The store may change between steps: every source is taken as it is at its step,
+        and sources removed meanwhile are skipped.
+        """
+        # arrays are extended in place, so they can be kept between steps
+        index, seqs, states = self._index, self._seqs, self._states
+        serial_nums, state_codes, last_received = self._serial_nums, self._state_codes, self._last_received
+        for chunk in self._seq_log.iter(max_seq):
+            for source_id, seq in chunk:
+                slot = index.get(source_id)
+                if slot is not None and seqs[slot] == seq:
+                    yield Source(source_id, serial_nums[slot], states[state_codes[slot]], last_received[slot], seq)
+
+    def _get_seq(self, source_id: str) -> Optional[int]:
+        slot = self._index.get(source_id)
+        return None if slot is None else self._seqs[slot]
+
+    def get_all(self) -> 'SourcesSnapshot':
+        count = len(self._ids)
+        return SourcesSnapshot(
+            ids=self._ids[:],
+            serial_nums=self._serial_nums[:count],
+            state_codes=self._state_codes[:count],
+            last_received=self._last_received[:count],
+            seqs=self._seqs[:count],
+            states=self._states[:],
+        )
+
+    def _add(self, source_id: str) -> int:
+        slot = len(self._ids)
+        if slot == len(self._serial_nums):
+            # double capacity of the arrays
+            self._serial_nums.extend(array.array('H', bytes(2 * slot)))
+            self._state_codes.extend(array.array('B', bytes(slot)))
+            self._last_received.extend(array.array('q', bytes(8 * slot)))
+            self._seqs.extend(array.array('Q', bytes(8 * slot)))
+        self.last_seq += 1
+        self._seqs[slot] = self.last_seq
+        self._seq_log.append(source_id, self.last_seq)
+        self._ids.append(source_id)
+        return slot
+
+
+class SourcesSnapshot:
+    """
+    Copy of state of all sources made by _ArraySourcesStore.
+    Source tuples are created only while iterating.
+    """
+
+    def __init__(self,
+                 ids: List[str],
+                 serial_nums: array.array,
+                 state_codes: array.array,
+                 last_received: array.array,
+                 seqs: array.array,
+                 states: List[Any]):
+        self._ids = ids
+        self._serial_nums = serial_nums
+        self._state_codes = state_codes
+        self._last_received = last_received
+        self._seqs = seqs
+        self._states = states
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[Source]:
+        states = self._states
+        for id_, serial_num, state_code, last_received, seq in zip(
+                self._ids, self._serial_nums, self._state_codes, self._last_received, self._seqs):
+            yield Source(id_, serial_num, states[state_code], last_received, seq)
+
+
 class _ListenersStore:
     """
     Represents store for listeners.
     Helps track which listeners were notified about which sources.
+    Sources are notified about in order of their registration,
+    so a listener keeps only seq of the last source it knows about.
     >>> listener = _ListenersStore()
     >>> listener.get_all()
     ()
-    >>> listener.add_listener()
+    >>> listener.add_listener(notified_seq=3)
     0
-    >>> listener.is_notified(0, 'asdfqwer')
-    False
-    >>> listener.set_notified(0, 'asdfqwer')
-    >>> listener.is_notified(0, 'asdfqwer')
+    >>> listener.is_notified(0, 3), listener.is_notified(0, 4)
+    (True, False)
+    >>> listener.set_notified(0, 4)
+    >>> listener.is_notified(0, 4)
     True
     >>> listener.get_all()
-    (Listener(id_=0, sources_notified={'asdfqwer'}),)
+    (Listener(id_=0, notified_seq=4),)
     >>> listener.remove_listener(0)
     >>> listener.get_all()
     ()
@@ -76,28 +379,47 @@ class _ListenersStore:
     def __init__(self):
         self._listeners: Dict[int: Listener] = {}
         self._counter = itertools.count()
+        self._removed = 0
 
-    def add_listener(self) -> int:
+    def add_listener(self, notified_seq: int = 0) -> int:
         """
         Creates new listener obj.
+        :param notified_seq: seq of the last source the listener is notified about
         :return: id_ of listener
         """
         id_ = next(self._counter)
-        self._listeners[id_] = Listener(id_=id_, sources_notified=set())
+        self._listeners[id_] = Listener(id_=id_, notified_seq=notified_seq)
         return id_
 
     def remove_listener(self, id_):
         self._listeners.pop(id_)
+        # dict doesn't shrink on removal and iterates over removed entries too,
+        # so after mass disconnects it is rebuilt
+        self._removed += 1
+        if self._removed > 2 * len(self._listeners) + 64:
+            self._listeners = dict(self._listeners)
+            self._removed = 0
 
-    def set_notified(self, id_, source_id):
-        self._listeners[id_].sources_notified.add(source_id)
+    def set_notified(self, id_, seq):
+        self._listeners[id_] = self._listeners[id_]._replace(notified_seq=seq)
 
-    def is_notified(self, id_, source_id):
-        return source_id in self._listeners[id_].sources_notified
+    def is_notified(self, id_, seq):
+        return seq <= self._listeners[id_].notified_seq
 
     def get_all(self) -> Sequence[Listener]:
         return tuple(self._listeners.values())
 
 
+sources_backends = {
+    'dict': _SourcesStore,
+    'array': _ArraySourcesStore,
+}
+
 ListenersStore = _ListenersStore()
 SourcesStore = _SourcesStore()
+
+
+def init_sources_store(backend: str):
+    """ Replaces SourcesStore with an empty store of given backend """
+    global SourcesStore
+    SourcesStore = sources_backends[backend]()
@@ -0,0 +1,168 @@
+"""
+This module decides which listeners are interested in messages of a source.
+"""
+import collections
+import fnmatch
+from typing import Dict, Iterable, Optional, Tuple
+
+import listener_protocol
+
+# source_ids - frozenset of ids or None if not filtered by ids
+# prefixes - tuple of prefixes of ids or None if not filtered by prefixes
+# states - frozenset of states or None if not filtered by states
+# fields - FieldsFilter or None if not filtered by fields
+# binary - the listener receives binary messages instead of text
+# A source matches if it matches any of source_ids and prefixes.
+Subscription = collections.namedtuple('Subscription', 'source_ids prefixes states fields binary')
+
+ALL = Subscription(source_ids=None, prefixes=None, states=None, fields=None, binary=False)
+
+
+class FieldsFilter:
+    """
+    Matches names of fields against shell-style patterns.
+    Results are cached, as sources send the same names over and over.
+    >>> fields = FieldsFilter((b'temp*', b'hum'))
+    >>> fields(b'temp_001'), fields(b'hum'), fields(b'humidity')
+    (True, True, False)
+    >>> fields.filter([(b'temp_001', 1), (b'pressure', 2)])
+    [(b'temp_001', 1)]
+    """
+    MAX_CACHED = 10000
+
+    def __init__(self, patterns: Iterable[bytes]):
+        self.patterns = tuple(patterns)
+        self._cache: Dict[bytes, bool] = {}
+
+    def __call__(self, name: bytes) -> bool:
+        res = self._cache.get(name)
+        if res is None:
+            res = any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+            if len(self._cache) >= self.MAX_CACHED:
+                self._cache.clear()
+            self._cache[name] = res
+        return res
+
+    def filter(self, msgs: Iterable[Tuple[bytes, int]]):
+        return [(name, value) for name, value in msgs if self(name)]
+
+
+def match_source(subscription: Subscription, source_id: str) -> bool:
+    """
+    >>> subscription = ALL._replace(source_ids=frozenset({'asdfghjk'}), prefixes=('qw',))
+    >>> match_source(subscription, 'asdfghjk'), match_source(subscription, 'qwertyui')
+    (True, True)
+    >>> match_source(subscription, 'zxcvbnma'), match_source(ALL, 'zxcvbnma')
+    (False, True)
+    """
+    if not is_filtered_by_source(subscription):
+        return True
+    if subscription.source_ids is not None and source_id in subscription.source_ids:
+        return True
+    return subscription.prefixes is not None and source_id.startswith(subscription.prefixes)
+
+
+def match_state(subscription: Subscription, state: str) -> bool:
+    return subscription.states is None or state in subscription.states
+
+
+class SubscriptionIndex:
+    """
+    Index from source id to subscriptions of interested listeners,
+    so a message of a source costs only as much as there are listeners of it.
+    >>> index = SubscriptionIndex()
+    >>> index.add(0, ALL)
+    >>> index.add(1, ALL._replace(source_ids=frozenset({'asdfghjk'}), prefixes=('as', 'asd')))
+    >>> index.add(2, ALL._replace(prefixes=('qw',)))
+    >>> sorted(id_ for id_, _ in index.subscribers('asdfghjk'))
+    [0, 1]
+    >>> sorted(id_ for id_, _ in index.subscribers('qwertyui'))
+    [0, 2]
+    >>> index.remove(0)
+    >>> sorted(id_ for id_, _ in index.subscribers('zxcvbnma'))
+    []
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[int, Subscription] = {}
+        # listeners without filters by source
+        self._everyone: Dict[int, Subscription] = {}
+        self._by_source: Dict[str, Dict[int, Subscription]] = {}
+        self._by_prefix: Dict[str, Dict[int, Subscription]] = {}
+        # lengths of known prefixes, so only they are looked up
+        self._prefix_lengths: Dict[int, int] = collections.Counter()
+        # filters with the same patterns are shared, so a message is rendered once for all of them
+        self._fields_filters: Dict[Tuple[bytes, ...], FieldsFilter] = {}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def add(self, listener_id: int, subscription: Subscription):
+        if subscription.fields is not None:
+            fields = self._fields_filters.setdefault(subscription.fields.patterns, subscription.fields)
+            subscription = subscription._replace(fields=fields)
+        self._subscriptions[listener_id] = subscription
+        if not is_filtered_by_source(subscription):
+            self._everyone[listener_id] = subscription
+            return
+        for source_id in subscription.source_ids or ():
+            self._by_source.setdefault(source_id, {})[listener_id] = subscription
+        for prefix in set(subscription.prefixes or ()):
+            self._by_prefix.setdefault(prefix, {})[listener_id] = subscription
+            self._prefix_lengths[len(prefix)] += 1
+
+    def remove(self, listener_id: int):
+        subscription = self._subscriptions.pop(listener_id)
+        if not is_filtered_by_source(subscription):
+            del self._everyone[listener_id]
+            return
+        for source_id in subscription.source_ids or ():
+            _discard(self._by_source, source_id, listener_id)
+        for prefix in set(subscription.prefixes or ()):
+            _discard(self._by_prefix, prefix, listener_id)
+            self._prefix_lengths[len(prefix)] -= 1
+            if not self._prefix_lengths[len(prefix)]:
+                del self._prefix_lengths[len(prefix)]
+
+    def get(self, listener_id: int) -> Optional[Subscription]:
+        return self._subscriptions.get(listener_id)
+
+    def subscribers(self, source_id: str) -> Iterable[Tuple[int, Subscription]]:
+        """ :return: pairs of (listener id, subscription) of listeners of the source """
+        matched = []
+        by_source = self._by_source.get(source_id)
+        if by_source:
+            matched.append(by_source)
+        for length in self._prefix_lengths:
+            by_prefix = self._by_prefix.get(source_id[:length])
+            if by_prefix:
+                matched.append(by_prefix)
+        if not matched:
+            return self._everyone.items()
+        # a listener may match by several ids and prefixes, but has to get a message once
+        merged = dict(self._everyone)
+        for it in matched:
+            merged.update(it)
+        return merged.items()
+
+
+def is_filtered_by_source(subscription: Subscription) -> bool:
+    return subscription.source_ids is not None or subscription.prefixes is not None
+
+
+def from_handshake(handshake: listener_protocol.Handshake,
+                   default_format: str = listener_protocol.TEXT) -> Subscription:
+    return Subscription(
+        source_ids=None if handshake.sources is None else frozenset(handshake.sources),
+        prefixes=None if handshake.prefixes is None else tuple(handshake.prefixes),
+        states=None if handshake.states is None else frozenset(handshake.states),
+        fields=None if handshake.fields is None else FieldsFilter(handshake.fields),
+        binary=(handshake.format or default_format) == listener_protocol.BINARY,
+    )
+
+
+def _discard(index: Dict[str, Dict[int, Subscription]], key: str, listener_id: int):
+    listeners = index[key]
+    del listeners[listener_id]
+    if not listeners:
+        del index[key]
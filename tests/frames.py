@@ -0,0 +1,18 @@
+"""
+Frames of sources for tests.
+"""
+from typing import Sequence, Tuple
+
+import source_protocol
+
+
+def gen_frame(source_id: bytes = b'asdfghjk',
+              num: int = 1,
+              state: int = 0x01,
+              records: Sequence[Tuple[bytes, int]] = ()) -> bytes:
+    """ :return: valid frame of a source with records of (8 bytes name, value) """
+    frame = source_protocol.HEADER_STRUCT.pack(0x01, num, source_id, state, len(records))
+    for name, value in records:
+        record = name + value.to_bytes(4, byteorder=source_protocol.BYTE_ORDER)
+        frame += record + source_protocol.xor(record)
+    return frame
@@ -0,0 +1,36 @@
+"""
+Streams for tests, which keep written data instead of sending it.
+"""
+from tornado.concurrent import Future
+
+
+class FakeStream:
+
+    def __init__(self):
+        self.written = []
+        self.is_closed = False
+
+    def write(self, data):
+        self.written.append(data)
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def closed(self):
+        return self.is_closed
+
+    def close(self):
+        self.is_closed = True
+
+
+class SlowStream(FakeStream):
+    """ Writes of the stream are finished by the test """
+
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def write(self, data):
+        self.written.append(data)
+        self.writes.append(Future())
+        return self.writes[-1]
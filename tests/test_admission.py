@@ -0,0 +1,66 @@
+import time
+
+from tornado.testing import AsyncTestCase, gen_test
+
+import admission
+import fanout
+import source_protocol
+from frames import gen_frame
+
+
+def frame(source_id='asdfghjk', records=1):
+    return source_protocol.parse_source_frame(gen_frame(source_id.encode(), records=[(b'name0001', 1)] * records))
+
+
+class TestRateLimiter(AsyncTestCase):
+
+    def test_source_msgs(self):
+        limiter = admission.RateLimiter(source_msgs_per_s=2)
+        admitted = limiter.admit('conn', [frame(), None, frame(), frame(), frame('qwertyui')], 0, now=0.0)
+        assert [it and it.source_id for it in admitted] == ['asdfghjk', None, 'asdfghjk', None, 'qwertyui']
+        assert limiter.throttled[admission.SOURCE] == 1
+        assert limiter.admit('conn', [frame()], 0, now=0.5)[0] is not None
+
+    def test_connection_records(self):
+        limiter = admission.RateLimiter(connection_records_per_s=300)
+        admitted = limiter.admit('conn', [frame(records=200), frame('qwertyui', records=200)], 0, now=0.0)
+        assert admitted[1] is None and limiter.throttled[admission.CONNECTION] == 1
+        # a frame throttled by the connection doesn't take tokens of its source
+        assert limiter.admit('other', [frame('qwertyui', records=200)], 0, now=0.0)[0] is not None
+
+    def test_inflight(self):
+        limiter = admission.RateLimiter(max_inflight_bytes=100)
+        assert limiter.admit('conn', [frame()], 99, now=0.0)[0] is not None
+        assert limiter.admit('conn', [frame(), frame()], 100, now=0.0) == [None, None]
+        assert limiter.throttled[admission.INFLIGHT] == 2
+
+    def test_forget_keeps_debt(self):
+        limiter = admission.RateLimiter(source_msgs_per_s=1, connection_msgs_per_s=1)
+        limiter.admit('conn', [frame()], 0, now=0.0)
+        limiter.forget('conn', ['asdfghjk'], now=0.5)
+        assert limiter.admit('reconnected', [frame()], 0, now=0.5) == [None]
+        limiter.forget('reconnected', ['asdfghjk'], now=2.0)
+        assert limiter.admit('reconnected', [frame()], 0, now=2.0)[0] is not None
+
+    def test_sweep_drops_limits_within_them(self):
+        limiter = admission.RateLimiter(source_msgs_per_s=1, connection_msgs_per_s=1)
+        ids = ['source%02d' % i for i in range(3)]
+        admitted = limiter.admit('conn', [frame(source_id) for source_id in ids], 0, now=0.0)
+        # ids rejected by the connection limit get no limits of their own
+        assert [it and it.source_id for it in admitted] == ['source00', None, None]
+        assert list(limiter._by_source) == ['source00']
+        assert limiter.sweep(now=0.5) == 0
+        assert limiter.sweep(now=1.0) == 1 and not limiter._by_source
+
+    @gen_test
+    async def test_hold(self):
+        limiter = admission.RateLimiter(source_msgs_per_s=100, policy=admission.PAUSE)
+        inflight = fanout.InflightBytes()
+        started = time.monotonic()
+        await limiter.hold('conn', [frame()] * 105, inflight)
+        assert time.monotonic() - started >= 0.04
+        assert limiter.throttled[admission.SOURCE] == 1 and limiter.paused_seconds >= 0.04
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            admission.RateLimiter(policy='drop')
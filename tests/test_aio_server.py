@@ -0,0 +1,121 @@
+import asyncio
+
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+import aio_server
+
+
+class TestSourcesServer(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = []
+        self.closed = []
+        self.release = None
+        self.server = aio_server.SourcesServer(
+            on_connect=self._on_connect,
+            on_msgs=self._on_msgs,
+            on_close=self._on_close,
+        )
+        sock, self.port = bind_unused_port()
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    async def _on_connect(self, stream):
+        pass
+
+    async def _on_msgs(self, stream, msgs, trace):
+        self.received.append(msgs)
+        if self.release is not None:
+            await self.release
+        await stream.write(b''.join(b'%d' % len(msg) for msg in msgs))
+
+    async def _on_close(self, stream):
+        self.closed.append(stream)
+
+    @gen_test
+    async def test_pipelined_frames(self):
+        frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x01, *range(13)])
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.write(frame * 3 + frame[:5])
+        answer = await stream.read_bytes(6)
+        assert answer == b'262626', f'got {answer}'
+        assert self.received == [[frame] * 3], f'got {self.received}'
+        await stream.write(frame[5:])
+        answer = await stream.read_bytes(2)
+        assert self.received[-1] == [frame], f'got {self.received}'
+        stream.close()
+        while not self.closed:
+            await asyncio.sleep(0.01)
+
+    @gen_test
+    async def test_frames_are_handled_in_order(self):
+        frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00])
+        self.release = asyncio.get_running_loop().create_future()
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.write(frame)
+        while not self.received:
+            await asyncio.sleep(0.01)
+        await stream.write(frame * 2)
+        await asyncio.sleep(0.05)
+        # the source isn't read until its previous frames are handled
+        assert self.received == [[frame]], f'got {self.received}'
+        self.release.set_result(None)
+        answer = await stream.read_bytes(4)
+        assert answer == b'1313', f'got {answer}'
+        assert self.received == [[frame], [frame] * 2], f'got {self.received}'
+        stream.close()
+
+
+class TestListenersServer(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handshakes = []
+        self.closed = []
+        self.server = aio_server.ListenersServer(
+            on_connect=self._on_connect,
+            on_close=self._on_close,
+            handshake_timeout_ms=50,
+        )
+        sock, self.port = bind_unused_port()
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    async def _on_connect(self, stream, handshake):
+        self.handshakes.append(handshake)
+        await stream.write(b'ok\r\n')
+
+    async def _on_close(self, stream):
+        self.closed.append(stream)
+
+    @gen_test
+    async def test_handshake_is_optional(self):
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.write(b'since=1\r\n')
+        await stream.read_until(b'\r\n')
+        stream.close()
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.read_until(b'\r\n')
+        stream.close()
+        assert self.handshakes == [b'since=1\r\n', None], f'got {self.handshakes}'
+
+    @gen_test
+    async def test_write_after_close(self):
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.read_until(b'\r\n')
+        stream.close()
+        while not self.closed:
+            await asyncio.sleep(0.01)
+        listener = self.closed[0]
+        assert listener.closed()
+        with self.assertRaises(StreamClosedError):
+            listener.write(b'late\r\n')
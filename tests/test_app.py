@@ -0,0 +1,316 @@
+import importlib.util
+import time
+import unittest
+
+from tornado import gen
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+import admission
+import app
+import metrics
+import offload
+import source_protocol
+import store
+from frames import gen_frame
+from streams import FakeStream, SlowStream
+
+
+class TestGenListenerMsg(unittest.TestCase):
+
+    def test_empty(self):
+        res = app._gen_listener_msg('asdfghjk', [])
+        assert res == b'', f'got {res}'
+
+    def test_several_msgs(self):
+        res = app._gen_listener_msg('asdfghjk', [(b'uierwuie', 2344), (b'uierwuis', 0)])
+        expected = b'[asdfghjk] uierwuie | 2344\r\n[asdfghjk] uierwuis | 0\r\n'
+        assert res == expected, f'got {res}'
+
+
+class TestSourcesServer(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = []
+        self.server = app.SourcesServer(
+            on_connect=self._on_connect,
+            on_msgs=self._on_msgs,
+            on_close=self._on_connect,
+        )
+        sock, self.port = bind_unused_port()
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    async def _on_connect(self, stream):
+        pass
+
+    async def _on_msgs(self, stream, msgs, trace):
+        self.received.append(msgs)
+        await stream.write(b''.join(b'%d' % len(msg) for msg in msgs))
+
+    @gen_test
+    async def test_pipelined_frames(self):
+        frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x01, *range(13)])
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.write(frame * 3 + frame[:5])
+        answer = await stream.read_bytes(6)
+        assert answer == b'262626', f'got {answer}'
+        assert self.received == [[frame] * 3], f'got {self.received}'
+        await stream.write(frame[5:])
+        answer = await stream.read_bytes(2)
+        assert self.received[-1] == [frame], f'got {self.received}'
+        stream.close()
+
+
+class TestDispatcherConnections(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store.ListenersStore = store._ListenersStore()
+        store.init_sources_store('dict')
+        self.disp = app.Dispatcher()
+
+    @gen_test
+    async def test_listener_close_removes_listener(self):
+        streams = [FakeStream() for _ in range(3)]
+        for stream in streams:
+            await self.disp._on_listener_connect(stream)
+        await self.disp._on_listener_close(streams[1])
+        ids = [listener.id_ for listener in store.ListenersStore.get_all()]
+        assert ids == [0, 2], f'got {ids}'
+        frame = gen_frame()
+        await self.disp._on_source_msgs(FakeStream(), [frame])
+
+    @gen_test
+    async def test_listener_metrics(self):
+        self.disp = app.Dispatcher(
+            listener_queue_size=1, listener_overflow_policy='drop_newest', listener_flush_delay_us=1000)
+        stream = FakeStream()
+        await self.disp._on_listener_connect(stream)
+        frame = gen_frame(records=[(b'asdfqwer', 1)])
+        # the first message doesn't fit to the queue after the announcement of its source
+        for _ in range(2):
+            await self.disp._on_source_msgs(FakeStream(), [frame])
+            await gen.sleep(0.01)
+        rendered = metrics.REGISTRY.render()
+        assert 'dispatcher_listener_flushes_total{listener="0"} 2\n' in rendered, rendered
+        assert 'dispatcher_listener_flushed_msgs_total{listener="0"} 2\n' in rendered, rendered
+        assert 'dispatcher_listener_dropped_total{listener="0"} 1\n' in rendered, rendered
+
+    @gen_test
+    async def test_source_close_removes_all_its_ids(self):
+        stream = FakeStream()
+        frames = [
+            gen_frame(source_id)
+            for source_id in (b'asdfghjk', b'asdfghjl')
+        ]
+        await self.disp._on_source_msgs(stream, frames)
+        assert len(self.disp._sources_connects) == 2
+        await self.disp._on_source_close(stream)
+        assert len(self.disp._sources_connects) == 0
+
+    @gen_test
+    async def test_snapshot_is_streamed_by_chunks(self):
+        self.disp = app.Dispatcher(snapshot_chunk_size=2)
+        source_ids = [b'source%02d' % i for i in range(5)]
+        await self.disp._on_source_msgs(FakeStream(), [
+            gen_frame(source_id)
+            for source_id in source_ids
+        ])
+        stream = FakeStream()
+        await self.disp._on_listener_connect(stream)
+        await gen.sleep(0)
+        # a message of a source, which is not streamed yet, and of a new source
+        await self.disp._on_source_msgs(FakeStream(), [
+            gen_frame(source_id, num=2, records=[(b'asdfqwer', 1)])
+            for source_id in (source_ids[4], b'source05')
+        ])
+        await gen.sleep(0.05)
+        lines = b''.join(stream.written).decode().splitlines()
+        announced = [line.split(']')[0][1:] for line in lines if ' | IDLE | ' in line]
+        assert announced == [f'source{i:02}' for i in range(6)], f'got {lines}'
+        assert len(stream.written[0].splitlines()) == 2, f'got {stream.written}'
+        assert lines[-1] == '[source05] asdfqwer | 1', f'got {lines}'
+
+    @gen_test
+    async def test_replay_before_live_messages(self):
+        self.disp = app.Dispatcher(replay_buffer_bytes=1024)
+        records = [(b'asdfqwer', 1)]
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(num=num, records=records) for num in range(1, 4)])
+        stream = FakeStream()
+        await self.disp._on_listener_connect(stream, b'last=2\r\n')
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(num=4, records=records)])
+        await gen.sleep(0.05)
+        lines = b''.join(stream.written).decode().splitlines()
+        # the snapshot reads the store as it's written, so it has the state after the live message
+        assert lines[0].startswith('[asdfghjk] 4 | IDLE | '), f'got {lines}'
+        assert lines[1:] == ['[asdfghjk] asdfqwer | 1'] * 3, f'got {lines}'
+
+    @gen_test
+    async def test_subscription_filters(self):
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'qwertyui')])
+        everyone, subscribed = FakeStream(), FakeStream()
+        await self.disp._on_listener_connect(everyone)
+        await self.disp._on_listener_connect(subscribed, b'prefixes=as,zx states=ACTIVE fields=temp*\r\n')
+        await self.disp._on_source_msgs(FakeStream(), [
+            gen_frame(b'asdfghjk', state=0x02, records=[(b'temp0001', 1), (b'humidity', 1)]),
+            gen_frame(b'asdfghjl', state=0x01, records=[(b'temp0001', 1)]),
+            gen_frame(b'qwertyui', state=0x02, records=[(b'temp0001', 1)]),
+        ])
+        await gen.sleep(0.05)
+        lines = b''.join(subscribed.written).decode().splitlines()
+        assert len(lines) == 3 and lines[0].startswith('[asdfghjk] 1 | ACTIVE | '), f'got {lines}'
+        assert lines[1] == '[asdfghjk] temp0001 | 1', f'got {lines}'
+        # a source of another state is announced, though its messages are filtered out
+        assert lines[2].startswith('[asdfghjl] 1 | IDLE | '), f'got {lines}'
+        lines = b''.join(everyone.written).decode().splitlines()
+        assert len(lines) == 7, f'got {lines}'
+        await self.disp._on_listener_close(subscribed)
+        assert len(self.disp._subscriptions) == 1
+
+    @gen_test
+    async def test_source_is_announced_before_state_matches(self):
+        records = [(b'temp0001', 1)]
+        stream = FakeStream()
+        await self.disp._on_listener_connect(stream, b'states=ACTIVE\r\n')
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'asdfghjk', 1, 0x01, records)])
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'qwertyui', 1, 0x02, records)])
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'asdfghjk', 2, 0x02, records)])
+        await gen.sleep(0.05)
+        lines = b''.join(stream.written).decode().splitlines()
+        assert lines[0].startswith('[asdfghjk] 1 | IDLE | '), f'got {lines}'
+        assert lines[1].startswith('[qwertyui] 1 | ACTIVE | '), f'got {lines}'
+        assert lines[2:] == ['[qwertyui] temp0001 | 1', '[asdfghjk] temp0001 | 1'], f'got {lines}'
+
+    @gen_test
+    async def test_replay_is_filtered(self):
+        self.disp = app.Dispatcher(replay_buffer_bytes=1024)
+        idle = gen_frame(num=2, state=0x01, records=[(b'temp0002', 1)])
+        await self.disp._on_source_msgs(FakeStream(), [
+            gen_frame(num=1, state=0x02, records=[(b'temp0001', 1)]),
+            idle,
+            gen_frame(num=3, state=0x02, records=[(b'humidity', 1)]),
+        ])
+        stream, binary_stream = FakeStream(), FakeStream()
+        await self.disp._on_listener_connect(stream, b'last=3 states=ACTIVE fields=temp*\r\n')
+        await self.disp._on_binary_listener_connect(binary_stream, b'last=3 states=IDLE\r\n')
+        await gen.sleep(0.05)
+        lines = b''.join(stream.written).decode().splitlines()
+        assert lines[1:] == ['[asdfghjk] temp0001 | 1'], f'got {lines}'
+        written = b''.join(binary_stream.written)
+        assert written.endswith(idle), f'got {written}'
+        assert written.count(b'asdfghjk') == 2, f'got {written}'
+
+    @gen_test
+    async def test_binary_listener(self):
+        frame = gen_frame(state=0x02, records=[(b'asdfqwer', 1)])
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'qwertyui')])
+        stream = FakeStream()
+        await self.disp._on_binary_listener_connect(stream)
+        await self.disp._on_source_msgs(FakeStream(), [frame])
+        await gen.sleep(0.05)
+        written = b''.join(stream.written)
+        assert written[:12] == bytes([0x02, *b'qwertyui', 0x00, 0x01, 0x01]), f'got {written}'
+        assert written[16:28] == bytes([0x02, *b'asdfghjk', 0x00, 0x01, 0x02]), f'got {written}'
+        assert written[32:] == frame, f'got {written}'
+
+    @gen_test
+    async def test_binary_status_of_source_from_future(self):
+        # times restored from the journal are ahead if the wall clock stepped back
+        store.SourcesStore.update_state('asdfghjk', 1, 'IDLE', time.monotonic_ns() + 10 ** 9)
+        stream = FakeStream()
+        await self.disp._on_binary_listener_connect(stream)
+        await self.disp._on_source_msgs(FakeStream(), [gen_frame(b'qwertyui', num=2)])
+        await gen.sleep(0.05)
+        written = b''.join(stream.written)
+        assert written[:16] == bytes([0x02, *b'asdfghjk', 0x00, 0x01, 0x01, 0, 0, 0, 0]), f'got {written}'
+
+    @gen_test
+    async def test_answers_are_not_awaited(self):
+        self.disp = app.Dispatcher(ack_await_write=False)
+        stream = SlowStream()
+        frame = gen_frame()
+        await self.disp._on_source_msgs(stream, [frame, frame[:-1]])
+        assert stream.written == [bytes([0x11, 0x00, 0x01, 0x10, 0x12, 0x00, 0x00, 0x12])], f'got {stream.written}'
+        assert store.SourcesStore.get_state('asdfghjk') is not None
+        # the next answer waits for the previous one
+        handling = gen.convert_yielded(self.disp._on_source_msgs(stream, [frame]))
+        await gen.sleep(0.01)
+        assert not handling.done() and len(stream.written) == 1
+        stream.writes[0].set_result(None)
+        await handling
+        assert len(stream.written) == 2
+
+    @gen_test
+    async def test_big_frames_are_parsed_in_pool(self):
+        self.disp = app.Dispatcher(parse_pool=offload.ParsePool(min_size=26, executor=offload.THREAD))
+        big = gen_frame(num=2, records=[(b'asdfqwer', 1)])
+        small = gen_frame(b'asdfghjl', num=3)
+        corrupted = big[:-1] + bytes([big[-1] ^ 0xff])
+        stream = FakeStream()
+        await self.disp._on_source_msgs(stream, [big, small, corrupted])
+        expected = bytes([0x11, 0x00, 0x02, 0x13, 0x11, 0x00, 0x03, 0x12, 0x12, 0x00, 0x00, 0x12])
+        assert stream.written == [expected], f'got {stream.written}'
+        assert store.SourcesStore.get_state('asdfghjk') is not None
+        assert self.disp._parse_pool.depth == 0
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    @gen_test
+    async def test_bursts_of_many_records_are_parsed_at_once(self):
+        big = gen_frame(num=2, records=[(b'asdfqwer', 1)] * 255)
+        corrupted = big[:-1] + bytes([big[-1] ^ 0xff])
+        assert source_protocol.is_batch_faster([big, corrupted])
+        stream = FakeStream()
+        await self.disp._on_source_msgs(stream, [big, corrupted])
+        assert stream.written == [bytes([0x11, 0x00, 0x02, 0x13, 0x12, 0x00, 0x00, 0x12])], f'got {stream.written}'
+        assert self.disp._frames_parsed.value == 1 and self.disp._frames_rejected.value == 1
+
+    @gen_test
+    async def test_frames_over_limits_are_rejected(self):
+        self.disp = app.Dispatcher(rate_limiter=admission.RateLimiter(source_msgs_per_s=1))
+        stream = FakeStream()
+        frame = gen_frame()
+        await self.disp._on_source_msgs(stream, [frame, frame])
+        expected = bytes([0x11, 0x00, 0x01, 0x10, 0x12, 0x00, 0x00, 0x12])
+        assert stream.written == [expected], f'got {stream.written}'
+        assert self.disp._rate_limiter.throttled[admission.SOURCE] == 1
+
+
+class TestListenersServerHandshake(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handshakes = []
+        self.server = app.ListenersServer(
+            on_connect=self._on_connect,
+            on_close=self._on_close,
+            handshake_timeout_ms=50,
+        )
+        sock, self.port = bind_unused_port()
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    async def _on_connect(self, stream, handshake):
+        self.handshakes.append(handshake)
+        await stream.write(b'ok\r\n')
+
+    async def _on_close(self, stream):
+        pass
+
+    @gen_test
+    async def test_handshake_is_optional(self):
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.write(b'since=1\r\n')
+        await stream.read_until(b'\r\n')
+        stream.close()
+        stream = await TCPClient().connect('localhost', self.port)
+        await stream.read_until(b'\r\n')
+        stream.close()
+        assert self.handshakes == [b'since=1\r\n', None], f'got {self.handshakes}'
@@ -0,0 +1,58 @@
+import tempfile
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+import bus
+
+
+class TestBus(AsyncTestCase):
+
+    @gen_test
+    async def test_publish(self):
+        received = {0: [], 1: []}
+        with tempfile.TemporaryDirectory() as path:
+            buses = [
+                bus.Bus(path, worker_id, 2, on_msgs=received[worker_id].extend)
+                for worker_id in (0, 1)
+            ]
+            await gen.multi([it.start() for it in buses])
+            frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00])
+            buses[0].publish(frame * 2)
+            await gen.sleep(0.05)
+            assert received == {0: [], 1: [frame, frame]}, f'got {received}'
+
+    @gen_test
+    async def test_restarted_worker_is_reconnected(self):
+        received = []
+        with tempfile.TemporaryDirectory() as path:
+            first = bus.Bus(path, 0, 2, on_msgs=lambda msgs: None)
+            second = bus.Bus(path, 1, 2, on_msgs=lambda msgs: None)
+            await gen.multi([first.start(), second.start()])
+            second.stop()
+            second = bus.Bus(path, 1, 2, on_msgs=received.extend)
+            await second.start()
+            await gen.sleep(bus.CONNECT_RETRY_DELAY * 2)
+            frame = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00])
+            first.publish(frame)
+            await gen.sleep(0.05)
+            assert received == [frame], f'got {received}'
+            first.stop()
+            second.stop()
+
+    @gen_test
+    async def test_stalled_worker_drops_frames(self):
+        with tempfile.TemporaryDirectory() as path:
+            buses = [
+                bus.Bus(path, worker_id, 2, on_msgs=lambda msgs: None, max_write_buffer_size=1024)
+                for worker_id in (0, 1)
+            ]
+            await gen.multi([it.start() for it in buses])
+            # the peer doesn't read until the loop runs, so socket buffers are filled up
+            frames = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00]) * 5000
+            for _ in range(100):
+                buses[0].publish(frames)
+            assert buses[0].dropped_bytes > 0
+            assert buses[0].dropped_bytes % len(frames) == 0, f'got {buses[0].dropped_bytes}'
+            for it in buses:
+                it.stop()
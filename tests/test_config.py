@@ -0,0 +1,59 @@
+import json
+import os
+import tempfile
+import unittest
+
+import config
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'config.json')
+        self._write(sources_port=9000, debug=True)
+
+    def tearDown(self):
+        config._config = config._config_path = None
+        self.tmp_dir.cleanup()
+
+    def _write(self, **options):
+        with open(self.path, 'w') as fh:
+            json.dump(options, fh)
+
+    def test_defaults_and_env_overrides(self):
+        conf = config.load(self.path, environ={'DISPATCHER_WORKERS': '4', 'DISPATCHER_SOURCES_STORE': 'array'})
+        assert (conf.sources_port, conf.debug, conf.workers, conf.sources_store) == (9000, True, 4, 'array'), conf
+        assert conf.listeners_port == 8889 and conf.journal_path is None
+
+    def test_wrong_options(self):
+        self._write(sources_prot=9000)
+        with self.assertRaisesRegex(ValueError, 'unknown options'):
+            config.load(self.path, environ={})
+        self._write()
+        with self.assertRaisesRegex(ValueError, 'debug has to be bool'):
+            config.load(self.path, environ={'DISPATCHER_DEBUG': '1'})
+
+    def test_loaded_once_and_reloaded(self):
+        conf = config.get_config(self.path)
+        assert config.get_config() is conf
+        with self.assertRaises(AttributeError):
+            conf.debug = False
+        self._write(sources_port=9001, debug=False, listener_queue_size=10)
+        reloaded = config.reload()
+        assert config.get_config() is conf
+        assert config.changed(conf, reloaded) == ['sources_port', 'debug', 'listener_queue_size']
+        applied = config.set_config(reloaded)
+        assert config.get_config() is applied
+        # options needing a restart keep the values the app runs with
+        assert config.changed(conf, applied) == ['debug', 'listener_queue_size']
+
+    def test_wrong_values(self):
+        self._write(listener_queue_size=0)
+        with self.assertRaisesRegex(ValueError, 'listener_queue_size has to be positive'):
+            config.load(self.path, environ={})
+        self._write(listener_overflow_policy='drop_all')
+        with self.assertRaisesRegex(ValueError, 'listener_overflow_policy has to be one of'):
+            config.load(self.path, environ={})
+        self._write(max_sources=None, listener_flush_delay_us=0)
+        config.load(self.path, environ={})
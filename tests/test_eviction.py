@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+
+from tornado.testing import AsyncTestCase, gen_test
+from tornado import gen
+
+import eviction
+import journal
+import store
+
+
+class TestEvictor(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store.init_sources_store('array')
+
+    def _add_sources(self, count, age_s=0.0):
+        first = len(store.SourcesStore)
+        for i in range(first, first + count):
+            source_id = 'source%02d' % i
+            store.SourcesStore.update_state(source_id, 1, 'IDLE', time.monotonic_ns() - int(age_s * 1e9))
+
+    def test_ttl(self):
+        self._add_sources(3, age_s=10)
+        self._add_sources(2)
+        evictor = eviction.Evictor(ttl_s=5)
+        assert evictor.sweep() == 3
+        assert [id_ for id_, _ in store.SourcesStore.get_oldest(5)] == ['source03', 'source04']
+        assert evictor.evicted[eviction.TTL] == 3
+
+    def test_max_sources_oldest_first(self):
+        self._add_sources(5)
+        store.SourcesStore.update_state('source00', 2, 'IDLE', time.monotonic_ns())
+        evictor = eviction.Evictor(max_sources=3)
+        assert evictor.sweep() == 2
+        assert [id_ for id_, _ in store.SourcesStore.get_oldest(5)] == ['source03', 'source04', 'source00']
+        assert evictor.evicted[eviction.MAX_SOURCES] == 2
+
+    @gen_test
+    async def test_sweep_is_incremental(self):
+        self._add_sources(25, age_s=10)
+        evictor = eviction.Evictor(ttl_s=5, batch_size=10)
+        assert evictor.sweep() == 10
+        assert len(store.SourcesStore) == 15
+        await gen.sleep(0.01)
+        assert len(store.SourcesStore) == 0
+
+    def test_evict_on_close(self):
+        self._add_sources(2)
+        evictor = eviction.Evictor(evict_on_close=True)
+        evictor.on_source_close(['source00', 'unknown'])
+        assert store.SourcesStore.get_state('source00') is None
+        assert evictor.evicted[eviction.CLOSE] == 1
+
+    def test_evicted_sources_are_journaled(self):
+        self._add_sources(3, age_s=10)
+        with tempfile.TemporaryDirectory() as path:
+            sources_journal = journal.Journal(os.path.join(path, 'journal'))
+            sources_journal.start()
+            evictor = eviction.Evictor(ttl_s=5, evict_on_close=True, sources_journal=sources_journal)
+            evictor.on_source_close(['source00'])
+            evictor.sweep()
+            sources_journal.close()
+            removed = [frame for _, frame in journal.read_records(os.path.join(path, 'journal'))]
+            assert removed == [b'source00', b'source01', b'source02'], f'got {removed}'
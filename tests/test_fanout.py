@@ -0,0 +1,102 @@
+from tornado.testing import AsyncTestCase, gen_test
+from tornado import gen
+
+import fanout
+from streams import FakeStream
+
+
+class TestListenerQueue(AsyncTestCase):
+
+    def _queue(self, policy):
+        stream = FakeStream()
+        queue = fanout.ListenerQueue(stream, maxsize=2, overflow_policy=policy)
+        return stream, queue
+
+    @gen_test
+    async def test_delivers_in_order(self):
+        stream, queue = self._queue(fanout.DROP_OLDEST)
+        queue.start()
+        for it in (b'a', b'b', b'c'):
+            queue.put(it)
+            await gen.sleep(0.01)
+        assert stream.written == [b'a', b'b', b'c'], f'got {stream.written}'
+
+    @gen_test
+    async def test_drop_oldest(self):
+        stream, queue = self._queue(fanout.DROP_OLDEST)
+        for it in (b'a', b'b', b'c'):
+            queue.put(it)
+        queue.start()
+        await gen.sleep(0.01)
+        assert stream.written == [b'b', b'c'], f'got {stream.written}'
+        assert queue.dropped == 1
+
+    @gen_test
+    async def test_inflight_bytes(self):
+        inflight = fanout.InflightBytes()
+        stream = FakeStream()
+        queue = fanout.ListenerQueue(stream, maxsize=2, overflow_policy=fanout.DROP_OLDEST, inflight=inflight)
+        for it in (b'a', b'bb', b'ccc'):
+            queue.put(it)
+        assert inflight.value == 5
+        queue.start()
+        await gen.sleep(0.01)
+        assert inflight.value == 0
+        queue.put(b'dddd')
+        queue.close()
+        assert inflight.value == 0
+
+    @gen_test
+    async def test_configure(self):
+        stream, queue = self._queue(fanout.DROP_OLDEST)
+        queue.configure(maxsize=3, overflow_policy=fanout.DROP_NEWEST, flush_delay_us=0, flush_bytes=65536)
+        for it in (b'a', b'b', b'c', b'd'):
+            queue.put(it)
+        queue.start()
+        await gen.sleep(0.01)
+        assert stream.written == [b'a', b'b', b'c'], f'got {stream.written}'
+        with self.assertRaises(ValueError):
+            queue.configure(maxsize=3, overflow_policy='drop_all', flush_delay_us=0, flush_bytes=65536)
+
+    @gen_test
+    async def test_drop_newest(self):
+        stream, queue = self._queue(fanout.DROP_NEWEST)
+        for it in (b'a', b'b', b'c'):
+            queue.put(it)
+        queue.start()
+        await gen.sleep(0.01)
+        assert stream.written == [b'a', b'b'], f'got {stream.written}'
+        assert queue.dropped == 1
+
+    @gen_test
+    async def test_disconnect(self):
+        stream, queue = self._queue(fanout.DISCONNECT)
+        for it in (b'a', b'b', b'c'):
+            queue.put(it)
+        assert stream.closed()
+        assert len(queue) == 0
+
+    @gen_test
+    async def test_coalesce_by_delay(self):
+        stream = FakeStream()
+        queue = fanout.ListenerQueue(stream, maxsize=10, flush_delay_us=20000, flush_bytes=100)
+        queue.start()
+        queue.put(b'a')
+        queue.put(b'b')
+        await gen.sleep(0.005)
+        assert stream.written == [], f'got {stream.written}'
+        await gen.sleep(0.03)
+        assert stream.written == [b'ab'], f'got {stream.written}'
+        stats = queue.flush_stats.as_dict()
+        assert stats['flushes'] == 1 and stats['items'] == 2, f'got {stats}'
+        assert 0.02 <= stats['max_latency'] < 0.1, f'got {stats}'
+
+    @gen_test
+    async def test_coalesce_by_bytes(self):
+        stream = FakeStream()
+        queue = fanout.ListenerQueue(stream, maxsize=10, flush_delay_us=10 ** 6, flush_bytes=3)
+        queue.start()
+        for it in (b'a', b'b', b'c', b'd'):
+            queue.put(it)
+        await gen.sleep(0.01)
+        assert stream.written == [b'abcd'], f'got {stream.written}'
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import time
+
+from tornado.testing import AsyncTestCase
+
+import journal
+import store
+from frames import gen_frame
+
+
+_records = [(b'field001', 7)]
+
+
+class TestJournal(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'journal')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def test_restore_last_states(self):
+        sources_journal = journal.Journal(self.path, segment_size=50, buffer_size=1)
+        sources_journal.start()
+        now = time.time_ns()
+        sources_journal.append([gen_frame(b'asdfghjk', 1, 0x01, _records), gen_frame(b'qwertyui', 1, 0x02, _records)], now - 10 ** 9)
+        sources_journal.append([gen_frame(b'asdfghjk', 2, 0x03, _records)], now)
+        sources_journal.close()
+        assert len(os.listdir(self.path)) > 1, 'segments are not rotated'
+        frames = [frame for _, frame in journal.read_records(self.path)]
+        assert frames[-1] == gen_frame(b'asdfghjk', 2, 0x03, _records), f'got {frames}'
+
+        sources_store = store._SourcesStore()
+        assert journal.restore_sources(self.path, sources_store) == 2
+        source = sources_store.get_state('asdfghjk')
+        assert (source.serial_num, source.state, source.seq) == (2, 'RECHARGE', 2), f'got {source}'
+        age = time.monotonic_ns() - sources_store.get_state('qwertyui').last_received
+        assert 10 ** 9 <= age < 2 * 10 ** 9, f'got {age}'
+
+    def test_torn_tail_and_next_run(self):
+        sources_journal = journal.Journal(self.path)
+        sources_journal.start()
+        sources_journal.append([gen_frame(b'asdfghjk', 1, 0x01, _records)], time.time_ns())
+        sources_journal.close()
+        segment = os.path.join(self.path, os.listdir(self.path)[0])
+        with open(segment, 'ab') as fh:
+            frame = gen_frame(b'qwertyui', 1, 0x01, _records)
+            fh.write(journal._record_header_struct.pack(time.time_ns(), len(frame)) + frame[:20])
+
+        sources_journal = journal.Journal(self.path)
+        sources_journal.start()
+        sources_journal.append([gen_frame(b'qwertyui', 2, 0x01, _records)], time.time_ns())
+        sources_journal.close()
+        assert sorted(os.listdir(self.path)) == ['000-00000001.journal', '000-00000002.journal']
+        records = list(journal.read_records(self.path))
+        assert [frame[3:11] for _, frame in records] == [b'asdfghjk', b'qwertyui'], f'got {records}'
+
+    def test_removed_sources_and_compaction(self):
+        sources_journal = journal.Journal(self.path, segment_size=50, buffer_size=1)
+        sources_journal.start()
+        now = time.time_ns()
+        sources_journal.append([gen_frame(b'asdfghjk', 1, 0x01, _records), gen_frame(b'qwertyui', 1, 0x02, _records)], now - 10 ** 9)
+        sources_journal.remove(['asdfghjk'], now)
+        sources_journal.append([gen_frame(b'zxcvbnma', 3, 0x03, _records)], now)
+        sources_journal.close()
+
+        sources_store = store._SourcesStore()
+        assert journal.restore_sources(self.path, sources_store) == 2
+        assert sources_store.get_state('asdfghjk') is None
+        segments = len(os.listdir(self.path))
+        assert journal.compact(self.path, sources_store) == segments
+        assert os.listdir(self.path) == [f'000-{segments + 1:08d}.journal'], f'got {os.listdir(self.path)}'
+
+        restored_store = store._SourcesStore()
+        assert journal.restore_sources(self.path, restored_store) == 2
+        # last_received is shifted between monotonic and wall clocks, which move apart a bit meanwhile
+        states = [source._replace(last_received=None) for source in restored_store.get_all()]
+        assert states == [source._replace(last_received=None) for source in sources_store.get_all()], f'got {states}'
+
+        sources_journal = journal.Journal(self.path)
+        sources_journal.start()
+        sources_journal.append([gen_frame(b'asdfghjk', 2, 0x01, _records)], time.time_ns())
+        sources_journal.close()
+        assert len(os.listdir(self.path)) == 2
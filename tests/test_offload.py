@@ -0,0 +1,24 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+import offload
+import source_protocol
+
+
+class TestParsePool(AsyncTestCase):
+
+    @gen_test
+    async def test_process_pool_keeps_order(self):
+        pool = offload.ParsePool(min_size=13, executor=offload.PROCESS, workers=1)
+        try:
+            frames = [bytes([0x01, 0x00, num, *b'asdfghjk', 0x01, 0x00]) for num in range(1, 4)]
+            frames.insert(1, frames[0][:-1])
+            parsed = await pool.parse(frames)
+            assert [it and it.num for it in parsed] == [1, None, 2, 3], f'got {parsed}'
+            assert isinstance(parsed[0], source_protocol.SourceFrame)
+            assert pool.depth == 0
+        finally:
+            pool.close()
+
+    def test_unknown_executor(self):
+        with self.assertRaises(ValueError):
+            offload.ParsePool(min_size=13, executor='fiber')
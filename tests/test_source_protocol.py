@@ -1,3 +1,4 @@
+import importlib.util
 import unittest
 from itertools import chain
 
@@ -86,3 +87,79 @@ class TestGenAnswerToSource(unittest.TestCase):
     def test_succes(self):
         res = source_protocol.gen_answer_to_source(True, 2)
         assert res == with_xor(bytes([0x11, 0x00, 0x02])), f'got {res}'
+
+
+class TestParseSourceFrame(unittest.TestCase):
+
+    def setUp(self):
+        self.meta = 0x01, 0x00, 0x05, *b'asdfghjk', 0x02
+        self.record = with_xor(bytes([*b'uierwuie', *(2344).to_bytes(4, byteorder='big')]))
+
+    def test_incorrect_cases(self):
+        incorrect_cases = (
+            bytes(),
+            bytes([0x00]),
+            bytes([0x02, *self.meta[1:], 0x00]),
+            bytes([*self.meta[:-1], 0x04, 0x00]),
+            bytes([*self.meta, 0x02, *self.record]),
+            bytes([*self.meta, 0x01, *self.record[:-1], self.record[-1] ^ 0x01]),
+        )
+        for inp in incorrect_cases:
+            res = source_protocol.parse_source_frame(inp)
+            assert res is None, f'received {res} for {inp}'
+
+    def test_correct(self):
+        inp = bytes([*self.meta, 0x02, *self.record, *self.record])
+        res = source_protocol.parse_source_frame(inp)
+        expected = source_protocol.SourceFrame(
+            num=5,
+            source_id='asdfghjk',
+            source_state='ACTIVE',
+            msgs=[(b'uierwuie', 2344), (b'uierwuie', 2344)],
+        )
+        assert res == expected, f'got {res}'
+
+
+class TestSplitFrames(unittest.TestCase):
+
+    def test_split(self):
+        record = with_xor(bytes([*b'uierwuie', *(2344).to_bytes(4, byteorder='big')]))
+        frame1 = bytes([0x01, 0x00, 0x01, *b'asdfghjk', 0x01, 0x00])
+        frame2 = bytes([0x01, 0x00, 0x02, *b'asdfghjk', 0x01, 0x02, *record, *record])
+        tail = frame2[:20]
+        frames, consumed = source_protocol.split_frames(frame1 + frame2 + tail)
+        assert frames == [frame1, frame2], f'got {frames}'
+        assert consumed == len(frame1) + len(frame2), f'got {consumed}'
+
+
+@unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+class TestParseSourceFrames(unittest.TestCase):
+
+    def setUp(self):
+        meta = 0x01, 0x00, 0x05, *b'asdfghjk', 0x02
+        record = with_xor(bytes([*b'uierwuie', *(2344).to_bytes(4, byteorder='big')]))
+        corrupted = bytes([*record[:-1], record[-1] ^ 0x01])
+        self.frames = [
+            bytes([*meta, 0x00]),
+            bytes([*meta, 0x02, *record, *record]),
+            bytes([*meta, 0x02, *record, *corrupted]),
+            bytes([0x00, *meta[1:], 0x01, *record]),
+            bytes([*meta[:-1], 0x04, 0x01, *record]),
+            bytes([*meta, 0x02, *record]),
+            bytes([0x01]),
+            bytes([*meta, 0x01, *record]),
+        ]
+
+    def test_sequence_of_frames(self):
+        res = source_protocol.parse_source_frames(self.frames)
+        expected = [source_protocol.parse_source_frame(frame) for frame in self.frames]
+        assert res.frames == expected, f'got {res.frames}'
+        assert res.ok.tolist() == [it is not None for it in expected], f'got {res.ok}'
+
+    def test_contiguous_buffer(self):
+        frames = self.frames[:5]
+        tail = self.frames[-1][:7]
+        res = source_protocol.parse_source_frames(b''.join([*frames, tail]))
+        expected = [source_protocol.parse_source_frame(frame) for frame in frames]
+        assert res.frames == expected, f'got {res.frames}'
+        assert res.consumed == sum(len(frame) for frame in frames), f'got {res.consumed}'
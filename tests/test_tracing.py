@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+
+import tracing
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dump_path = os.path.join(self.tmp_dir.name, 'trace.jsonl')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_disabled(self):
+        tracer = tracing.Tracer()
+        assert tracer.begin() is None
+
+    def test_sampled_dumps(self):
+        tracer = tracing.Tracer(enabled=True, sample_every=2, dump_path=self.dump_path)
+        for _ in range(5):
+            trace = tracer.begin()
+            for stage in tracing.STAGES:
+                trace.mark(stage)
+            trace.frames = 3
+            tracer.finish(trace)
+        tracer.toggle()
+        assert tracer.begin() is None
+        with open(f'{self.dump_path}.{os.getpid()}') as fh:
+            dumps = [json.loads(line) for line in fh]
+        assert len(dumps) == 2, f'got {dumps}'
+        assert dumps[0]['frames'] == 3, f'got {dumps}'
+        assert all(dumps[0][f'{stage}_ns'] >= 0 for stage in tracing.STAGES), f'got {dumps}'
+        assert tracer._histograms['parse'].count == 5
+
+    def test_skip_excludes_gap(self):
+        trace = tracing.Trace()
+        trace.mark('read')
+        trace.skip()
+        trace.mark('ack')
+        assert trace.durations['parse'] == 0
+        assert trace.durations['read'] >= 0 and trace.durations['ack'] >= 0
+
+    def test_toggle_profiling(self):
+        tracer = tracing.Tracer(profile_path=os.path.join(self.tmp_dir.name, 'disp.prof'))
+        tracer.toggle_profiling()
+        sum(range(1000))
+        tracer.toggle_profiling()
+        assert os.path.exists(os.path.join(self.tmp_dir.name, f'disp.prof.{os.getpid()}'))
@@ -0,0 +1,106 @@
+"""
+This module measures time of stages of handling messages from sources.
+"""
+import cProfile
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import metrics
+
+# read - cutting frames out of data read from a source
+# parse - parsing frames
+# store - updating state of sources
+# fanout - putting messages to queues of listeners
+# ack - writing answers to a source
+STAGES = ('read', 'parse', 'store', 'fanout', 'ack')
+
+
+class Trace:
+    """
+    Timings of stages of a batch of frames read from a source at once.
+    Every mark adds time passed since the previous mark to the stage.
+    """
+    __slots__ = ('_last', 'frames', 'durations')
+
+    def __init__(self):
+        self._last = time.perf_counter_ns()
+        self.frames = 0
+        self.durations = dict.fromkeys(STAGES, 0)
+
+    def mark(self, stage: str):
+        now = time.perf_counter_ns()
+        self.durations[stage] += now - self._last
+        self._last = now
+
+    def skip(self):
+        """ Excludes time passed since the previous mark from all stages """
+        self._last = time.perf_counter_ns()
+
+
+class Tracer:
+    """
+    Aggregates traces to per-stage histograms and dumps every
+    sample_every-th of them to a file as a json line.
+    Files are suffixed with pid, so workers don't mix their dumps.
+    Also switches cProfile on and off at runtime.
+    """
+
+    def __init__(self,
+                 enabled: bool = False,
+                 sample_every: int = 0,
+                 dump_path: str = 'trace.jsonl',
+                 profile_path: str = 'dispatcher.prof'):
+        self.enabled = enabled
+        self._sample_every = sample_every
+        self._dump_path = dump_path
+        self._dump_file = None
+        self._finished = 0
+        self._profile_path = profile_path
+        self._profile: Optional[cProfile.Profile] = None
+        self._histograms = {
+            stage: metrics.REGISTRY.histogram(
+                f'trace_{stage}_seconds', f'Time of {stage} stage of a batch of frames')
+            for stage in STAGES
+        }
+
+    def begin(self) -> Optional[Trace]:
+        """ :return: new trace or None if tracing is disabled """
+        if not self.enabled:
+            return None
+        return Trace()
+
+    def finish(self, trace: Trace):
+        for stage, duration in trace.durations.items():
+            self._histograms[stage].observe(duration / 1e9)
+        self._finished += 1
+        if self._sample_every and self._finished % self._sample_every == 0:
+            if self._dump_file is None:
+                self._dump_file = open(f'{self._dump_path}.{os.getpid()}', 'a', buffering=1)
+            self._dump_file.write(json.dumps(dict(
+                time=time.time(),
+                frames=trace.frames,
+                **{f'{stage}_ns': duration for stage, duration in trace.durations.items()},
+            )) + '\n')
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if not self.enabled and self._dump_file is not None:
+            self._dump_file.close()
+            self._dump_file = None
+        logging.info('tracing %s', 'enabled' if self.enabled else 'disabled')
+
+    def toggle_profiling(self):
+        """ Starts cProfile or stops it and dumps its stats to profile_path """
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            logging.info('profiling enabled')
+            return
+        self._profile.disable()
+        path = f'{self._profile_path}.{os.getpid()}'
+        self._profile.dump_stats(path)
+        self._profile = None
+        logging.info('profiling disabled, stats are dumped to %s', path)